@@ -0,0 +1,359 @@
+# Setup
+# Importing required libraries
+import asyncio, os, time, inspect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from Lazy_Import import lazyImport
+from Http_Cache import openCache, HTTP_TIMEOUT
+from Data_Mining import (makeSession, fetchPage, writeSnapshot, snapshotCompression, getMongoURI, connectMongoDB,
+                         syncChunk, syncOps, addSyncCounts, typedColumns, HASH_PROJECTION,
+                         RAW_FIELDS, LANDINGS_URL, SNAPSHOT_FILE, SQLITE_DB, TABLE_NAME,
+                         LANDING_KEYS)
+from Sqlite_Store import bulkLoadSqlite, commitStaging, dropStaging, landingIndexes, LANDING_COLUMNS
+from Stage_Metrics import stageTimer
+pymongo = lazyImport("pymongo")
+
+# Overlapped fetch -> snapshot / MongoDB / SQLite pipeline
+# testAndRun runs every stage to completion before the next one starts. Here
+# the stages run at the same time, one page at a time, joined by queues:
+#
+#                +-> snapshot queue -> writeSnapshot           (writer thread)
+#   fetch pages -+-> mongo queue    -> async upserts
+#                +-> extract queue  -> typed rows -> rows queue -> bulkLoadSqlite  (writer thread)
+#
+# Every queue holds at most queueSize pages. A slow stage fills its queue and
+# the fetch waits on it, so memory stays bounded and the run takes about as
+# long as the slowest stage instead of the sum of all of them.
+# The stages run in one asyncio.TaskGroup: the first stage to fail cancels the
+# others. The writer threads get an abort marker instead of the end marker,
+# so writeSnapshot removes its temp file and bulkLoadSqlite drops its staging
+# table. A writer that already finished only leaves a pending snapshot and a
+# staging table, they replace the last snapshot and the SQLite table after
+# every stage succeeded, so a failed run leaves both as they were.
+# Mongo upserts are idempotent, pages synced before a failure stay synced.
+# SQLite rows come from the pages themselves (same filter and defaults as
+# extractMDB on the synced collection), so loading never waits for MongoDB.
+
+# Stage names in pipeline order
+PIPELINE_STAGES = ("fetch", "snapshot", "mongo", "extract", "sqlite")
+
+# Queue markers, END after the last page, ABORT when another stage failed
+END = None
+ABORT = "abort"
+
+# Empty per-stage counters
+# busy: seconds spent on the stage's own work, not waiting on its neighbours
+# Returns: dict
+def stageStats():
+    return {"pages": 0, "records": 0, "busy": 0.0}
+
+# Async MongoDB client, pymongo's AsyncMongoClient (pymongo 4.10+) or motor
+# Args: uri: str
+# Returns: client, None if neither driver is installed
+def asyncMongoClient(uri):
+    if hasattr(pymongo, "AsyncMongoClient"):
+        return pymongo.AsyncMongoClient(uri)
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient
+    except ImportError:
+        return None
+    return AsyncIOMotorClient(uri)
+
+# Connects to MongoDB with the async driver, the blocking pymongo client
+# (upserts on a worker thread) when no async driver is installed
+# Args: uri: str
+# Returns: client, None if the connection fails
+async def connectMongoAsync(uri):
+    client = asyncMongoClient(uri)
+    if client is None:
+        print("No async MongoDB driver installed, upserts run on a worker thread")
+        return await asyncio.to_thread(connectMongoDB, uri)
+    try:
+        await client.admin.command('ping')
+        print("Pinged MongoDB deployment. Connection successful.")
+    except Exception:
+        # Prints error statement and returns none if connection fails
+        print("MongoDB connection Failed")
+        await closeMongoAsync(client)
+        return None
+    return client
+
+# Closes a client from connectMongoAsync
+# AsyncMongoClient.close is a coroutine, motor's and the blocking pymongo client's are not
+# Args: client: pymongo, motor or mongomock client
+async def closeMongoAsync(client):
+    closed = client.close()
+    if inspect.isawaitable(closed):
+        await closed
+
+# Whether a collection comes from an async driver
+# Args: coll: pymongo, motor or mongomock collection
+# Returns: bool
+def isAsyncCollection(coll):
+    return type(coll).__module__.startswith(("pymongo.asynchronous", "motor"))
+
+# Sends a page to every downstream queue, waits while any of them is full
+# Args: queues: list of asyncio.Queue, page: list of json objects or END
+async def broadcast(queues, page):
+    for q in queues:
+        await q.put(page)
+
+# Empties a queue and leaves only the abort marker in it
+# Args: q: asyncio.Queue
+def abortQueue(q):
+    while not q.empty():
+        q.get_nowait()
+    q.put_nowait(ABORT)
+
+# fetch: downloads pages with inFlight requests ahead, in page order
+# Same paging as Data_Mining.scrapeConcurrent, but a failed page raises so the
+# other stages stop instead of loading a partial dataset
+# Args: url: str, queues: list of asyncio.Queue fed every page, stats: dict stage counters,
+#       pageSize: int records per page, inFlight: int pages requested ahead,
+#       cache: optional dict from Http_Cache.openCache, timeout: (connect, read) seconds
+async def fetchStage(url, queues, stats, pageSize=1000, inFlight=8, cache=None, timeout=HTTP_TIMEOUT):
+    session = makeSession(poolSize=inFlight)
+    pending = deque()
+    nextOffset = 0
+
+    def request():
+        nonlocal nextOffset
+        task = asyncio.create_task(asyncio.to_thread(fetchPage, session, url, nextOffset, pageSize, cache, timeout))
+        pending.append((nextOffset, task))
+        nextOffset += pageSize
+
+    try:
+        for _ in range(inFlight):
+            request()
+        while pending:
+            offset, task = pending.popleft()
+            start = time.perf_counter()
+            fetched = await task
+            stats["busy"] += time.perf_counter() - start
+            if fetched is None:
+                raise RuntimeError(f"download failed at offset {offset}")
+            page, size = fetched
+            if len(page) > 0:
+                stats["pages"] += 1
+                stats["records"] += len(page)
+                await broadcast(queues, page)
+            # A short (or empty) page means the end of the dataset
+            if len(page) < pageSize:
+                print(f"Retrieved {offset + len(page)} documents from {url}")
+                break
+            request()
+    finally:
+        # drops requests past the end of the dataset, or all of them on cancel
+        for _, task in pending:
+            task.cancel()
+    await broadcast(queues, END)
+
+# Drains an asyncio queue from a worker thread as one record stream
+# Args: loop: the event loop that owns pages, pages: asyncio.Queue of record lists,
+#       stats: dict stage counters, waiting: dict seconds blocked on an empty queue
+# Yields: records until END, raises RuntimeError on ABORT
+def queueRecords(loop, pages, stats, waiting):
+    while True:
+        start = time.perf_counter()
+        page = asyncio.run_coroutine_threadsafe(pages.get(), loop).result()
+        waiting["seconds"] += time.perf_counter() - start
+        if page is END:
+            return
+        if page == ABORT:
+            raise RuntimeError("pipeline cancelled")
+        stats["pages"] += 1
+        stats["records"] += len(page)
+        yield from page
+
+# snapshot / sqlite: runs a writer on its own thread, fed from an asyncio queue
+# The writer sees the queue as one record iterable, e.g. writeSnapshot or
+# bulkLoadSqlite, and owns its file or connection for the whole run
+# Args: name: str stage name, pages: asyncio.Queue of record lists, stats: dict stage counters,
+#       write: function taking the record iterable, returns None if it fails
+# Returns: the writer's result
+async def threadStage(name, pages, stats, write):
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+    # time blocked on an empty queue is not the writer's own work
+    waiting = {"seconds": 0.0}
+    start = time.perf_counter()
+    future = loop.run_in_executor(pool, write, queueRecords(loop, pages, stats, waiting))
+    try:
+        # shielded so a cancel doesn't orphan the thread, see below
+        result = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # another stage failed, the writer cleans up before the cancel goes on
+        abortQueue(pages)
+        await asyncio.wait([future])
+        raise
+    finally:
+        pool.shutdown(wait=False)
+        stats["busy"] = time.perf_counter() - start - waiting["seconds"]
+    if result is None:
+        raise RuntimeError(f"{name} stage failed")
+    return result
+
+# Syncs one page with the async driver, same upserts as Data_Mining.syncChunk
+# Args: coll: async collection, page: list of json objects, counts: dict updated in place
+async def syncChunkAsync(coll, page, counts):
+    latest = {rec["id"]: rec for rec in page}
+    cursor = coll.find({"id": {"$in": list(latest)}}, HASH_PROJECTION)
+    stored = {doc["id"]: doc.get("_contentHash") for doc in await cursor.to_list(length=None)}
+    ops = syncOps(latest, stored, counts)
+    if ops:
+        addSyncCounts(counts, await coll.bulk_write(ops, ordered=False))
+
+# mongo: upserts each page as it arrives, like Data_Mining.mdbSync one page per chunk
+# A blocking collection (pymongo, mongomock) is synced on a worker thread
+# Args: coll: async or blocking collection, pages: asyncio.Queue, stats: dict stage counters
+# Returns: dict counts of inserted, updated and unchanged documents
+async def mongoStage(coll, pages, stats):
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    asyncDriver = isAsyncCollection(coll)
+    if asyncDriver:
+        await coll.create_index("id", unique=True)
+    else:
+        await asyncio.to_thread(coll.create_index, "id", unique=True)
+    while (page := await pages.get()) is not END:
+        start = time.perf_counter()
+        if asyncDriver:
+            await syncChunkAsync(coll, page, counts)
+        else:
+            await asyncio.to_thread(syncChunk, coll, page, counts)
+        stats["busy"] += time.perf_counter() - start
+        stats["pages"] += 1
+        stats["records"] += len(page)
+    print(f"Synced {coll.name}: {counts['inserted']} inserted, "
+          f"{counts['updated']} updated, {counts['unchanged']} unchanged.")
+    return counts
+
+# Typed SQLite rows for the landings in one page
+# Keeps the records LANDING_FILTER selects (mass present, fall not "Found")
+# and converts them with typedColumns, so the rows match extractMDB
+# Args: page: list of json objects
+# Returns: list of dicts with the LANDING_COLUMNS fields
+def pageLandings(page):
+    kept = [rec for rec in page if "mass" in rec and rec.get("fall") != "Found"]
+    if not kept:
+        return []
+    cols = typedColumns({fld: [rec.get(fld) for rec in kept] for fld in RAW_FIELDS})
+    # tolist gives plain python values for sqlite3
+    return [dict(zip(LANDING_COLUMNS, row)) for row in zip(*(cols[c].tolist() for c in LANDING_COLUMNS))]
+
+# extract: converts each page to typed rows on a worker thread
+# Args: pages: asyncio.Queue of pages, rows: asyncio.Queue for the sqlite stage,
+#       stats: dict stage counters
+async def extractStage(pages, rows, stats):
+    while (page := await pages.get()) is not END:
+        start = time.perf_counter()
+        landings = await asyncio.to_thread(pageLandings, page)
+        stats["busy"] += time.perf_counter() - start
+        stats["pages"] += 1
+        stats["records"] += len(landings)
+        if landings:
+            await rows.put(landings)
+    await rows.put(END)
+
+# Runs the overlapped pipeline
+# Args: url: str dataset url, snapshotFile: str, coll: async or blocking collection,
+#       None skips MongoDB, sqliteDB: str SQLite DB Name, tableName: str Table name,
+#       pageSize: int records per page, inFlight: int pages requested ahead,
+#       queueSize: int pages each queue holds before the stage feeding it waits,
+#       cache: optional dict from Http_Cache.openCache
+# Returns: dict with seconds, loaded rows, snapshot records, mongo counts and
+#          per-stage stats, raises the stage errors as an ExceptionGroup
+async def overlappedLoad(url, snapshotFile, coll, sqliteDB, tableName, pageSize=1000,
+                         inFlight=8, queueSize=4, cache=None):
+    # a skipped MongoDB stage is left out of the stats
+    stats = {name: stageStats() for name in PIPELINE_STAGES if name != "mongo" or coll is not None}
+    queues = {name: asyncio.Queue(maxsize=queueSize) for name in ("snapshot", "mongo", "extract", "sqlite")}
+    fanOut = [queues["snapshot"], queues["extract"]] + ([queues["mongo"]] if coll is not None else [])
+    # written next to the snapshot, renamed over it once the whole run succeeded
+    pendingFile = snapshotFile + ".pending"
+    start = time.perf_counter()
+    try:
+        async with asyncio.TaskGroup() as group:
+            group.create_task(fetchStage(url, fanOut, stats["fetch"], pageSize, inFlight, cache))
+            snapshot = group.create_task(threadStage(
+                "snapshot", queues["snapshot"], stats["snapshot"],
+                lambda records: writeSnapshot(records, pendingFile, snapshotCompression(snapshotFile))))
+            mongo = group.create_task(mongoStage(coll, queues["mongo"], stats["mongo"])) if coll is not None else None
+            group.create_task(extractStage(queues["extract"], queues["sqlite"], stats["extract"]))
+            # loaded into the staging table only, swapped in below
+            loaded = group.create_task(threadStage(
+                "sqlite", queues["sqlite"], stats["sqlite"],
+                lambda rows: bulkLoadSqlite(sqliteDB, tableName, LANDING_KEYS, rows, swap=False)))
+    except BaseException:
+        # a writer that finished before another stage failed left its output pending
+        if os.path.exists(pendingFile):
+            os.remove(pendingFile)
+        if os.path.exists(sqliteDB):
+            await asyncio.to_thread(dropStaging, sqliteDB, tableName)
+        raise
+    # every stage succeeded, indexes and summary tables are built once in the swap
+    swapStart = time.perf_counter()
+    swapped = await asyncio.to_thread(commitStaging, sqliteDB, tableName, landingIndexes(tableName),
+                                      summaries=True, spatial=True)
+    stats["sqlite"]["busy"] += time.perf_counter() - swapStart
+    if swapped is None:
+        os.remove(pendingFile)
+        raise RuntimeError("sqlite swap failed")
+    os.replace(pendingFile, snapshotFile)
+    return {"seconds": time.perf_counter() - start, "loaded": loaded.result(),
+            "snapshot": snapshot.result(), "mongo": mongo.result() if mongo is not None else None,
+            "stages": stats}
+
+# Prints the busy time of every stage against the wall time of the run
+# Args: result: dict from overlappedLoad
+def reportPipeline(result):
+    stages = result["stages"]
+    print(f"{'stage':>10} {'pages':>7} {'records':>9} {'busy s':>8}")
+    for name, s in stages.items():
+        print(f"{name:>10} {s['pages']:>7} {s['records']:>9} {s['busy']:>8.2f}")
+    slowest = max(stages, key=lambda name: stages[name]["busy"])
+    print(f"{result['seconds']:.2f}s wall, slowest stage {slowest} {stages[slowest]['busy']:.2f}s, "
+          f"stages sum {sum(s['busy'] for s in stages.values()):.2f}s")
+
+async def pipelineMain(url, snapshotFile, credFile, sqliteDB, tableName, pageSize, inFlight,
+                       queueSize, cacheDir, mongo):
+    client = coll = None
+    if mongo:
+        muri = getMongoURI(credFile)
+        if not muri:
+            return None
+        client = await connectMongoAsync(muri)
+        if client is None:
+            return None
+        coll = client.meteorite_data.meteorite_landings
+    cache = openCache(cacheDir) if cacheDir else None
+    try:
+        return await overlappedLoad(url, snapshotFile, coll, sqliteDB, tableName, pageSize,
+                                    inFlight, queueSize, cache)
+    finally:
+        # closed on success and when a stage fails
+        if client is not None:
+            await closeMongoAsync(client)
+
+# Downloads the dataset into the snapshot, MongoDB and SQLite in one overlapped run
+# Args: url: str dataset url, snapshotFile: str, credFile: str MongoDB credentials file,
+#       sqliteDB: str SQLite DB Name, tableName: str Table name,
+#       pageSize: int records per page, inFlight: int pages requested ahead,
+#       queueSize: int pages per queue, cacheDir: optional str HTTP cache directory,
+#       mongo: bool sync MongoDB too
+# Returns: dict from overlappedLoad, None if any stage fails
+def runPipeline(url=LANDINGS_URL, snapshotFile=SNAPSHOT_FILE, credFile="pwProj.txt",
+                sqliteDB=SQLITE_DB, tableName=TABLE_NAME, pageSize=1000, inFlight=8,
+                queueSize=4, cacheDir="http_cache", mongo=True):
+    with stageTimer("asyncPipeline") as record:
+        try:
+            result = asyncio.run(pipelineMain(url, snapshotFile, credFile, sqliteDB, tableName,
+                                              pageSize, inFlight, queueSize, cacheDir, mongo))
+        except Exception as e:
+            # Prints every stage error and returns None
+            for err in (e.exceptions if isinstance(e, BaseExceptionGroup) else [e]):
+                print(f"Pipeline stage failed: {err}")
+            return None
+        if result is not None:
+            record["rowsOut"] = result["loaded"]
+            reportPipeline(result)
+        return result
@@ -0,0 +1,427 @@
+# Setup
+# Importing required libraries
+import os, sys, asyncio, json, time, argparse, tempfile, threading, platform, subprocess, shutil, resource, numbers
+import numpy as np
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Benchmark harness for the pipeline stages
+# Seeded synthetic meteorite records, local stand-ins for every external
+# service (a mock Socrata HTTP server, mongomock or a local mongod, temp SQLite
+# files), wall time and peak memory per stage, results saved as JSON.
+#   python Benchmark_Suite.py --sizes 1000 100000 1000000 --out bench.json
+#   python Benchmark_Suite.py --compare old.json new.json
+# Stage functions are imported when the benchmark runs, so the generator can be
+# imported on its own.
+
+# Meteorite classes weighted roughly like the NASA dataset
+RECCLASSES = np.array(["L6", "H5", "L5", "H6", "H4", "LL5", "LL6", "L4", "H4/5", "CM2",
+                       "H3", "Iron, IIIAB", "CO3", "Ureilite", "EH3"])
+RECCLASS_WEIGHTS = np.array([0.19, 0.17, 0.15, 0.12, 0.07, 0.06, 0.05, 0.03, 0.03, 0.03,
+                             0.03, 0.03, 0.02, 0.01, 0.01])
+
+# Fields that can be missing in generated records
+OPTIONAL_FIELDS = ("mass", "year", "reclat", "reclong")
+
+# Stages in pipeline order
+STAGES = ("scraper", "scrapeConcurrent", "writeSnapshot", "mdbInsert", "mdbSync",
+          "extractMDB", "extractMDBColumnar", "insertSqlite", "bulkLoadSqlite", "asyncPipeline", "sqlToDataframe",
+          "scrub_a_dub", "writeColumnar", "streamStats", "groupAggregates", "gridTiles")
+
+# Stages that talk to the mock HTTP server or to Mongo, capped separately
+# because the stand-ins don't scale like the real services
+HTTP_STAGES = ("scraper", "scrapeConcurrent", "asyncPipeline")
+MONGO_STAGES = ("mdbInsert", "mdbSync", "extractMDB", "extractMDBColumnar")
+
+# Same query as testAndRun
+MONGO_FILTER = {"mass": {"$exists": True}, "fall": {"$ne": "Found"}}
+MONGO_PROJECTION = {"_id": 0, "id": 1, "name": 1, "mass": 1, "year": 1, "reclat": 1, "reclong": 1}
+
+# Nullable landings schema so injected missing values reach the cleaning stage
+BENCH_KEYS = '''id INTEGER PRIMARY KEY, name TEXT, mass REAL, year INTEGER,
+    reclat REAL, reclong REAL'''
+
+# Generates typed landing columns with injected data problems
+# Args: n: int rows, seed: int, start: int first id - 1,
+#       missingRate: float share of missing values per optional field,
+#       dupRate: float share of rows that repeat an earlier row (same id),
+#       outOfRangeRate: float share of rows with one value outside the cleaning bounds
+# Returns: dict column -> numpy array, plus "missing" dict of bool masks per optional field
+def generateColumns(n, seed=0, start=0, missingRate=0.02, dupRate=0.01, outOfRangeRate=0.01):
+    rng = np.random.default_rng([seed, start])
+    cols = {
+        "id": np.arange(start + 1, start + n + 1, dtype=np.int64),
+        # log-normal masses, median around 30 g with a long tail
+        "mass": np.round(rng.lognormal(3.5, 2.5, n), 2),
+        "year": np.clip(np.round(2016 - rng.exponential(40, n)), 861, 2016).astype(np.int64),
+        # landings cluster toward the poles (Antarctic finds) and mid latitudes
+        "reclat": np.round(np.where(rng.random(n) < 0.3, rng.uniform(-90, -60, n), rng.uniform(-60, 75, n)), 5),
+        "reclong": np.round(rng.uniform(-180, 180, n), 5),
+        "recclass": rng.choice(RECCLASSES, n, p=RECCLASS_WEIGHTS / RECCLASS_WEIGHTS.sum()),
+        "fall": np.where(rng.random(n) < 0.03, "Fell", "Found"),
+    }
+    # out of range values, one column per affected row
+    bad = np.flatnonzero(rng.random(n) < outOfRangeRate)
+    which = rng.integers(0, 4, len(bad))
+    cols["reclat"][bad[which == 0]] = rng.uniform(90.5, 120, (which == 0).sum()) * rng.choice([-1, 1], (which == 0).sum())
+    cols["reclong"][bad[which == 1]] = rng.uniform(180.5, 250, (which == 1).sum()) * rng.choice([-1, 1], (which == 1).sum())
+    cols["year"][bad[which == 2]] = rng.integers(2100, 2500, (which == 2).sum())
+    cols["mass"][bad[which == 3]] = rng.uniform(1e6, 6e7, (which == 3).sum())
+    # missing values per optional field
+    cols["missing"] = {fld: rng.random(n) < missingRate for fld in OPTIONAL_FIELDS}
+    # duplicates copy every field of an earlier row
+    dups = np.flatnonzero(rng.random(n) < dupRate)
+    dups = dups[dups > 0]
+    sources = (rng.random(len(dups)) * dups).astype(np.int64)
+    for key, arr in cols.items():
+        if key == "missing":
+            for mask in arr.values():
+                mask[dups] = mask[sources]
+        else:
+            arr[dups] = arr[sources]
+    return cols
+
+# Generates records shaped like the Socrata JSON feed (all values strings,
+# missing fields left out)
+# Args: n, seed, start, missingRate, dupRate, outOfRangeRate: see generateColumns
+# Returns: list of dicts
+def generateRecords(n, seed=0, start=0, missingRate=0.02, dupRate=0.01, outOfRangeRate=0.01):
+    cols = generateColumns(n, seed, start, missingRate, dupRate, outOfRangeRate)
+    ids = cols["id"].astype(str)
+    mass = cols["mass"].astype(str)
+    year = np.char.add(cols["year"].astype(str), "-01-01T00:00:00.000")
+    lat = cols["reclat"].astype(str)
+    long = cols["reclong"].astype(str)
+    missing = cols["missing"]
+    records = []
+    for i in range(n):
+        rec = {"name": "Synthetic " + ids[i], "id": ids[i], "nametype": "Valid",
+               "recclass": cols["recclass"][i], "fall": cols["fall"][i]}
+        if not missing["mass"][i]:
+            rec["mass"] = mass[i]
+        if not missing["year"][i]:
+            rec["year"] = year[i]
+        if not (missing["reclat"][i] or missing["reclong"][i]):
+            rec["reclat"] = lat[i]
+            rec["reclong"] = long[i]
+            rec["geolocation"] = {"latitude": lat[i], "longitude": long[i]}
+        records.append(rec)
+    return records
+
+# Yields generated records in batches, for sizes that don't fit in memory at once
+# Args: n: int total rows, batchSize: int, other args: see generateColumns
+# Yields: list of dicts
+def generateRecordBatches(n, batchSize=100000, seed=0, **rates):
+    for start in range(0, n, batchSize):
+        yield generateRecords(min(batchSize, n - start), seed, start, **rates)
+
+# Generates a typed landings frame like sqlToDataframe returns (indexed by id,
+# nullable Int64 year, NaN for missing values)
+# Args: n, seed, start, missingRate, dupRate, outOfRangeRate: see generateColumns
+# Returns: pd.DataFrame
+def generateFrame(n, seed=0, start=0, missingRate=0.02, dupRate=0.01, outOfRangeRate=0.01):
+    cols = generateColumns(n, seed, start, missingRate, dupRate, outOfRangeRate)
+    missing = cols["missing"]
+    df = pd.DataFrame({
+        "id": cols["id"],
+        "name": pd.array(np.char.add("Synthetic ", cols["id"].astype(str)), dtype="string"),
+        "mass": np.where(missing["mass"], np.nan, cols["mass"]),
+        "year": pd.array(np.where(missing["year"], 0, cols["year"]), dtype="Int64"),
+        "reclat": np.where(missing["reclat"], np.nan, cols["reclat"]),
+        "reclong": np.where(missing["reclong"], np.nan, cols["reclong"])})
+    df.loc[missing["year"], "year"] = pd.NA
+    return df.set_index("id")
+
+# Resident set size of this process in bytes
+def rssBytes():
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # no /proc, peak RSS so far is the best available number
+        maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxRss if sys.platform == "darwin" else maxRss * 1024
+
+# Samples RSS on a background thread until stopped
+# Args: interval: float seconds between samples
+# Returns: dict sampler state for stopSampler
+def startSampler(interval=0.005):
+    sampler = {"start": rssBytes(), "peak": 0, "stop": threading.Event()}
+    sampler["peak"] = sampler["start"]
+    def sample():
+        while not sampler["stop"].wait(interval):
+            sampler["peak"] = max(sampler["peak"], rssBytes())
+    sampler["thread"] = threading.Thread(target=sample, daemon=True)
+    sampler["thread"].start()
+    return sampler
+
+# Stops a sampler
+# Returns: tuple (peak RSS bytes, peak growth over the start in bytes)
+def stopSampler(sampler):
+    sampler["stop"].set()
+    sampler["thread"].join()
+    peak = max(sampler["peak"], rssBytes())
+    return peak, peak - sampler["start"]
+
+# Runs and measures one stage
+# Args: results: list the result dict is appended to, stage: str, rows: int input rows,
+#       fn: function with no arguments, returns the stage output
+# Returns: stage output, None if the stage failed
+def runStage(results, stage, rows, fn):
+    sampler = startSampler()
+    cpuStart = time.process_time()
+    start = time.perf_counter()
+    status, output = "ok", None
+    try:
+        output = fn()
+    except Exception as e:
+        status = f"error: {e}"
+    seconds = time.perf_counter() - start
+    cpu = time.process_time() - cpuStart
+    peak, growth = stopSampler(sampler)
+    if isinstance(output, numbers.Number):
+        rowsOut = int(output)
+    else:
+        rowsOut = len(output) if hasattr(output, "__len__") else None
+    result = {"stage": stage, "rows": rows, "rowsOut": rowsOut, "seconds": round(seconds, 6),
+              "cpuSeconds": round(cpu, 6), "rowsPerSec": round(rows / seconds) if seconds > 0 else None,
+              "peakRssMB": round(peak / 1e6, 1), "rssGrowthMB": round(growth / 1e6, 1), "status": status}
+    results.append(result)
+    print(f"{stage:>20} {rows:>11} rows {seconds:9.3f}s {result['peakRssMB']:9.1f} MB peak  {status}")
+    return output
+
+# Records a stage that was not run
+def skipStage(results, stage, rows, reason):
+    results.append({"stage": stage, "rows": rows, "status": f"skipped: {reason}"})
+    print(f"{stage:>20} {rows:>11} rows  skipped: {reason}")
+
+# Mock Socrata endpoint, serves the records list with $limit/$offset paging
+# (no parameters returns everything)
+class MockSocrataHandler(BaseHTTPRequestHandler):
+    records = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        offset = int(query.get("$offset", [0])[0])
+        limit = int(query.get("$limit", [len(self.records)])[0])
+        body = json.dumps(self.records[offset:offset + limit]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# Starts the mock server on a free local port
+# Args: records: list of dicts to serve
+# Returns: tuple (str url, server), call server.shutdown() when done
+def startMockServer(records):
+    handler = type("BoundMockSocrataHandler", (MockSocrataHandler,), {"records": records})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/resource/y77d-th95.json", server
+
+# Mongo stand-in: a local mongod when BENCH_MONGO_URI is set, mongomock otherwise
+# Returns: pymongo/mongomock database, None if neither is available
+def benchDatabase():
+    uri = os.environ.get("BENCH_MONGO_URI")
+    if uri:
+        import pymongo
+        return pymongo.MongoClient(uri).meteorite_bench
+    try:
+        import mongomock
+    except ImportError:
+        return None
+    return mongomock.MongoClient().meteorite_bench
+
+# Runs every selected stage at one size
+# Args: n: int rows, workDir: str temp directory, stages: list of stage names,
+#       seed: int, rates: dict generator rates, maxHttpRows, maxMongoRows: int caps,
+#       compact: bool run the frame stages on the compact Dtype_Plan dtypes like the pipeline
+# Returns: list of result dicts
+def benchmarkSize(n, workDir, stages, seed, rates, maxHttpRows, maxMongoRows, compact=True):
+    import Data_Mining as dm
+    from Sqlite_Store import bulkLoadSqlite, readLandings
+    from Dtype_Plan import compactFrame, LANDING_DTYPES
+    from Cleaning_Plan import compilePlan, runPlan, landingSpec
+    from Columnar_IO import writeColumnar
+    from Stream_Stats import streamStats
+    from Parallel_Agg import groupAggregates
+    from Spatial_Grid import gridTiles
+    from Async_Pipeline import overlappedLoad
+
+    results = []
+    server = None
+    db = None
+    needsRecords = [s for s in stages if s in HTTP_STAGES + MONGO_STAGES + ("writeSnapshot",)]
+    records = generateRecords(n, seed, **rates) if needsRecords else None
+    frame = generateFrame(n, seed, **rates)
+    if compact:
+        frame = compactFrame(frame, LANDING_DTYPES, show=False)[0]
+    # rows for the SQLite loaders, missing values as None so they bind as NULL
+    loadFrame = frame.reset_index().astype(object)
+    loadFrame = loadFrame.where(loadFrame.notna(), None)
+    for stage in stages:
+        if stage in HTTP_STAGES and n > maxHttpRows:
+            skipStage(results, stage, n, f"above --max-http-rows {maxHttpRows}")
+            continue
+        if stage in MONGO_STAGES and n > maxMongoRows:
+            skipStage(results, stage, n, f"above --max-mongo-rows {maxMongoRows}")
+            continue
+
+        if stage in HTTP_STAGES:
+            # one server per size, it stays up for the requests scrapeConcurrent
+            # sends past the end of the data
+            if server is None:
+                url, server = startMockServer(records)
+            if stage == "asyncPipeline":
+                # overlapped fetch -> snapshot / Mongo / SQLite, Mongo only below its cap
+                coll = None
+                if n <= maxMongoRows:
+                    db = db or benchDatabase()
+                    if db is not None:
+                        db.meteorite_landings.drop()
+                        coll = db.meteorite_landings
+                runStage(results, stage, n, lambda: asyncio.run(overlappedLoad(
+                    url, os.path.join(workDir, "pipeline.ndjson.gz"), coll,
+                    os.path.join(workDir, "pipeline.sqlite"), "meteorite_landings"))["loaded"])
+            elif stage == "scraper":
+                runStage(results, stage, n, lambda: dm.scraper(url))
+            else:
+                runStage(results, stage, n,
+                         lambda: list(dm.iterRecords(dm.scrapeConcurrent(url, pageSize=1000, workers=8))))
+        elif stage == "writeSnapshot":
+            runStage(results, stage, n, lambda: dm.writeSnapshot(records, os.path.join(workDir, "snapshot.ndjson.gz")))
+        elif stage in MONGO_STAGES:
+            db = db or benchDatabase()
+            if db is None:
+                skipStage(results, stage, n, "no mongomock and no BENCH_MONGO_URI")
+                continue
+            if stage == "mdbInsert":
+                # insert_many adds _id to the dicts, the generator's copies stay clean
+                runStage(results, stage, n, lambda: n if dm.mdbInsert([dict(r) for r in records], db) else None)
+            elif stage == "mdbSync":
+                db.meteorite_landings.drop()
+                runStage(results, stage, n, lambda: sum(dm.mdbSync(records, db.meteorite_landings).values()))
+            else:
+                if db.meteorite_landings.estimated_document_count() == 0:
+                    dm.mdbSync(records, db.meteorite_landings)
+                extract = dm.extractMDB if stage == "extractMDB" else dm.extractMDBColumnar
+                runStage(results, stage, n, lambda: extract(db.meteorite_landings, MONGO_FILTER, MONGO_PROJECTION))
+        elif stage == "insertSqlite":
+            dbName = os.path.join(workDir, "legacy.sqlite")
+            rows = loadFrame.to_dict("records")
+            def legacyLoad():
+                dm.createSqliteDB(dbName, "meteorite_landings", BENCH_KEYS)
+                conn = dm.sqlite3.connect(dbName)
+                dm.insertSqlite(conn.cursor(), "meteorite_landings", rows)
+                conn.commit()
+                conn.close()
+                return n
+            runStage(results, stage, n, legacyLoad)
+        elif stage == "bulkLoadSqlite":
+            dbName = os.path.join(workDir, "bench.sqlite")
+            runStage(results, stage, n, lambda: bulkLoadSqlite(dbName, "meteorite_landings", BENCH_KEYS, loadFrame))
+        elif stage == "sqlToDataframe":
+            dbName = os.path.join(workDir, "bench.sqlite")
+            if not os.path.exists(dbName):
+                bulkLoadSqlite(dbName, "meteorite_landings", BENCH_KEYS, loadFrame)
+            conn = dm.sqlite3.connect(dbName)
+            try:
+                runStage(results, stage, n, lambda: readLandings(conn, "meteorite_landings",
+                                                                     dtypes=LANDING_DTYPES if compact else None))
+            finally:
+                conn.close()
+        elif stage == "scrub_a_dub":
+            runStage(results, stage, n, lambda: runPlan(frame, compilePlan(landingSpec(), frame))[0])
+        elif stage == "writeColumnar":
+            path = os.path.join(workDir, "clean.parquet")
+            runStage(results, stage, n, lambda: n if writeColumnar(frame, path) else None)
+        elif stage == "streamStats":
+            runStage(results, stage, n, lambda: streamStats([frame])["n"].max())
+        elif stage == "groupAggregates":
+            runStage(results, stage, n, lambda: groupAggregates(frame, keys=("year",), value="mass"))
+        elif stage == "gridTiles":
+            runStage(results, stage, n, lambda: gridTiles(frame, value="mass"))
+    if server is not None:
+        server.shutdown()
+    return results
+
+# Environment details stored with the results
+def benchmarkMeta(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit or None,
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "platform": platform.platform(), "cpus": os.cpu_count(), "seed": args.seed,
+            "missingRate": args.missing, "dupRate": args.dups, "outOfRangeRate": args.out_of_range,
+            "compactDtypes": not args.wide_dtypes}
+
+# Compares two result files stage by stage
+# Args: oldFile, newFile: str JSON files from a benchmark run
+# Returns: pd.DataFrame with seconds and peak memory of both runs and the ratios
+def compareBenchmarks(oldFile, newFile):
+    frames = []
+    for fileName in (oldFile, newFile):
+        with open(fileName, 'r') as f:
+            results = pd.DataFrame(json.load(f)["results"])
+        results = results[results["status"] == "ok"].set_index(["stage", "rows"])
+        frames.append(results[["seconds", "peakRssMB"]])
+    report = frames[0].join(frames[1], lsuffix="Old", rsuffix="New", how="inner")
+    report["timeRatio"] = report["secondsNew"] / report["secondsOld"]
+    report["memoryRatio"] = report["peakRssMBNew"] / report["peakRssMBOld"]
+    print(report.round(3).to_string())
+    return report
+
+# Command line entry point
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the meteorite pipeline on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="row counts to run (10^3 to 10^8)")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--missing", type=float, default=0.02, help="missing rate per optional field")
+    parser.add_argument("--dups", type=float, default=0.01, help="duplicate row rate")
+    parser.add_argument("--out-of-range", type=float, default=0.01, help="out of range row rate")
+    parser.add_argument("--max-http-rows", type=int, default=1000000)
+    parser.add_argument("--max-mongo-rows", type=int, default=None,
+                        help="1000 with mongomock (its upserts scan the collection), 10^6 with BENCH_MONGO_URI")
+    parser.add_argument("--wide-dtypes", action="store_true",
+                        help="run the frame stages on int64/float64/object columns instead of the compact ones")
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files instead of running")
+    args = parser.parse_args(argv)
+    if args.compare:
+        compareBenchmarks(*args.compare)
+        return 0
+
+    if args.max_mongo_rows is None:
+        args.max_mongo_rows = 1000000 if os.environ.get("BENCH_MONGO_URI") else 1000
+    rates = {"missingRate": args.missing, "dupRate": args.dups, "outOfRangeRate": args.out_of_range}
+    # pipeline output is printed by the stages, the benchmark lines are what matter
+    results = []
+    start = time.perf_counter()
+    for n in args.sizes:
+        workDir = tempfile.mkdtemp(prefix=f"meteorite_bench_{n}_")
+        try:
+            print(f"--- {n} rows ---")
+            results += benchmarkSize(n, workDir, args.stages, args.seed, rates,
+                                     args.max_http_rows, args.max_mongo_rows, not args.wide_dtypes)
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+    output = {"meta": benchmarkMeta(args), "results": results,
+              "totalSeconds": round(time.perf_counter() - start, 3)}
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=1)
+    print(f"Results for {len(results)} stage runs written to {args.out}")
+    return 0 if all(not r["status"].startswith("error") for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,25 @@
 # Importing required libraries
-import pymongo, sqlite3, datetime
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from IPython.display import display, HTML
+import sqlite3, datetime, os, re, sys
+from Lazy_Import import lazyImport
+from Stage_Metrics import instrumented, metricsFromEnv, reportMetrics
+# matplotlib, IPython and the analytics modules are imported by the stages that
+# use them and pandas on first use, so importing the cleaning helpers is cheap
+pd = lazyImport("pandas")
+
+# Displays a titled table, as HTML in a notebook and as plain text in a terminal
+# Args: title: str HTML title, table: optional DataFrame, Series or other displayable
+def showTable(title, table=None):
+    ipython = sys.modules.get("IPython")
+    if ipython is not None and ipython.get_ipython() is not None:
+        from IPython.display import display, HTML
+        display(HTML(title))
+        if table is not None:
+            display(table)
+    else:
+        # strips the HTML tags from the title
+        print("\n" + re.sub(r"<[^>]+>", "", title))
+        if table is not None:
+            print(table)
 
 # Opens connection to SQLite database 
 # Args : dbName = str SQLite DB Name, 
@@ -19,20 +35,31 @@ def connectSqlite(dbName):
         return None
 
 # Extract data from SQLite table and loads into pd.DataFrame
-# Args: conn: sqlite3.Connection obj, tableName: str: name of SQLite table
-# Returns: pd.DataFrame obj, if successfule, None if extraxction fails
-def sqlToDataframe(conn, tableName) :
+# Column list and filters are pushed into the SQL so only the needed data is read
+# Args: conn: sqlite3.Connection obj, tableName: str: name of SQLite table,
+#       columns: optional list of columns, yearRange / massRange: optional (min, max),
+#       bbox: optional (latMin, latMax, longMin, longMax),
+#       chunksize: optional int, returns an iterator of DataFrames for out-of-core work,
+#       show: bool display the first rows (skipped for headless batch jobs),
+#       compact: bool cast to the compact Dtype_Plan.LANDING_DTYPES (int16 year,
+#       float32 mass and coordinates, Arrow strings) as the data is read
+# Returns: pd.DataFrame obj (or iterator of them), if successfule, None if extraxction fails
+@instrumented(rowsArg=None)
+def sqlToDataframe(conn, tableName, columns=None, yearRange=None, massRange=None, bbox=None,
+                   chunksize=None, show=True, compact=True) :
     
     try :
+        from Sqlite_Store import readLandings
+        from Dtype_Plan import LANDING_DTYPES
         # read sqlite3 data from tableName table, assigns to dataframe obj 
-        meteoriteDF = pd.read_sql(f"SELECT * FROM {tableName}", conn, index_col="id",  dtype={'year': 'Int64'})
-        # Displays first 3 rows of DataFrame as verification
-        # Create title using HTML
-        title = '<h3>First 3 Rows of Data</h3>'
-
-        # Display the title and the DataFrame
-        display(HTML(title))
-        display(meteoriteDF.head(3))
+        meteoriteDF = readLandings(conn, tableName, columns, yearRange, massRange, bbox, chunksize,
+                                   dtypes=LANDING_DTYPES if compact else None)
+        if chunksize is not None :
+            # chunks are read lazily by the caller
+            return meteoriteDF
+        if show :
+            # Displays first 3 rows of DataFrame as verification
+            showTable('<h3>First 3 Rows of Data</h3>', meteoriteDF.head(3))
         # returns dataframe if successful
         return meteoriteDF
     except Exception as e :
@@ -41,332 +68,251 @@ def sqlToDataframe(conn, tableName) :
         print(f"Error: {e}")        
         return None
 
-# SQLite Database Extraction
-try:
-    # SQL database and table name
-    sqliteDB = "MeteoriteData.sqlite"
-    tableNameSQL = "meteorite_landings"
-    
-    # Connect to SQLite DB 
-    conn = connectSqlite(sqliteDB)
-    assert conn is not None
-    assert isinstance(conn, sqlite3.Connection)
-    
-    # Extract from sqlite db, load to df
-    df = sqlToDataframe(conn, tableNameSQL)
-    assert df is not None
-    assert isinstance(df, pd.DataFrame)
-    conn.close()
-    print(f"{len(df.index)} records extracted from SQLite table (tableNameSQL) successfully.")
-except Exception as e:
-    conn.close()
-    print(f"Error: {e}")
-    print("Failure with SQLite DB")
-
-
-# Get the 3 largest meteorite landings by mass, before cleaning up the data and removing outliers
-# title for output
-title = "<h3>3 Largest Meteorite Landings by Mass</h3>"
-biggestLandings = df.sort_values(by='mass', ascending=False).head(3)
-display(HTML(title))
-display(biggestLandings)
-
-# Checks for and deals with missing values 
-# In the event of needing to remove some missing vals and replace others
-# replace values first, then delete the remaining ones
-# Args: df: Dataframe obj, delete: Boolean delete all missing vals if True
-# Returns: True: missing values found and replaced or deleted, 
-#          False: no missing values found 
-def missingVal(df, delete=False) :
-    # sums the missing values for each column
-    missingCount = df.isnull().sum()
-    # Displays series showing where missing values are
-    print("Missing Values: \n", missingCount)
-    # Checks if any missing values were found
-    if missingCount.any() :       
-        if delete :
-            # Drops all missing values if delete == True
-            df.dropna(inplace=True)
-        else :
-            # Iterates through missingCount series, 
-            # gets value and index for each entry
-            for col in df.columns :
-                if pd.api.types.is_numeric_dtype(df[col]) :
-                    # Replaces missing value with the mean value for the column
-                    # if a value is missing and the column is numeric
-                    df[col].fillna(df[col].mean(), inplace=True)
-        # Verification that missing values have been deleted/replaced
-        print("Missing Values After: \n", df.null().sum())
-        return True
-    else :
-        # No missing values
-          return False
-
-# Looks for duplicate values and removes them if found
-# Args: df: Dataframe
-# Returns: True: If duplicates found, False: If no duplicates
-def duplicateVals(df) :
-    # gets duplicate rows
-    duplicates = df[df.duplicated(keep=False)]
-    # Checks if duplicates were found
-    if not duplicates.empty:
-        # print statement for verification
-        print("Duplicates found: \n", duplicates)
-        # deletes duplicate rows
-        df.drop_duplicates(inplace=True)
-        print("Duplicates dropped")
-        # Returns true, duplicates were found
-        return True
-    # No duplicates, returns false
-    print("No duplicates found.")
-    return False
-
-# Looks for values that are outside of a given range (inclusive) and 
-# replaces/deletes them; Replaces values with either rangeMin (below minimmum) 
-# or rangeMax (Above maximum)
-# Args: df: DataFrame obj, rangeMin: minimum value for acceptible range,
-#       rangeMax: Maximum value for acceptible range, 
-#       delete: Boolean: True: delete values, False: replace values
-# Returns: DataFrame: If out-of-bounds values found and replaced/removed
-#          False: If no out-of-bound values are found
-def outOfRange(df, column, rangeMin, rangeMax, delete=False) :
-    # Error Handling if duplicates are present
-    try : 
-        # Store original length to know how many rows were deleted
-        origLength = len(df)
-        if delete :
-            # Gets rows where column values are within range given replaces df
-            # with dataframe of only those values
-            df = df[(df[column] >= rangeMin) & (df[column] <= rangeMax)]
-            # Calculates how many rows deleted
-            print(f"Deleted {origLength - len(df)} rows from column '{column}' outside range [{rangeMin}, {rangeMax}]")
-        else:
-            # gets the number of out of range values to be replaced
-            count = df[(df[column] < rangeMin) | (df[column] > rangeMax)].shape[0]
-            # replaces the values that are outside the lower and upper limits with those values.
-            df[column] = df[column].clip(lower=rangeMin, upper=rangeMax)
-            # Print statement for verification
-            print(f"Replaced {count} out-of-range values in column '{column}' with range [{rangeMin}, {rangeMax}]")
-        return df
-    except Exception as e :
-        # print error statements and returns false
-        print("Error checking out-of-bounds values in DataFrame. Check for duplicates first.")
-        print(f"Error: {e}")
-        return False
-        
 # Method to drive cleaning data
 # Args: df: DataFrame
 # Returns: temp: DataFrame of cleaned data
+@instrumented()
 def scrub_a_dub(df) :
-    # Create title using HTML
-    title = '<h3>Cleaning data...</h3>'
-
-    # Display the title and the DataFrame
-    display(HTML(title))
-    # min and max range values
-    bounds = {
-        "reclong" : (-180.000, 180.000),
-        "reclat" : (-90.000, 90.000),
-        "year" : (861, 2016), 
-        "mass" : (0, 750000)}
-    
-    # Check for and handle missing values
-    missingVal(df, False)
-    
-    # Checks for and handles duplicates
-    duplicateVals(df)
-    
-    # Checks for and handles values that are out of range
-    for col, (min, max) in bounds.items() :
-        # calls out of range for each item in bounds, delete = true if column is 'year'
-        df = outOfRange(df, col, min, max, delete=(col=="year")) 
+    from Cleaning_Plan import compilePlan, runPlan, landingSpec
+    showTable('<h3>Cleaning data...</h3>')
+    # Cleaning rules run as one plan, in order fill -> dedup -> bounds:
+    # missing numeric values replaced with the column mean, whole-row duplicates
+    # dropped, out of range values clipped, except 'year' rows which are deleted
+    # min and max range values are in Cleaning_Plan.LANDING_BOUNDS
+    spec = landingSpec()
+    df, report = runPlan(df, compilePlan(spec, df))
+    # Displays how many rows each rule touched
+    showTable('<h3>Cleaning Report</h3>', report)
     return df
 
 
-# Create title using HTML
-title = '<h3>Maximum Values</h3>'
-# Display the title and the DataFrame
-display(HTML(title))
-display(df.max(numeric_only=True))
-# Create title using HTML
-title = '<h3>Minimum Values</h3>'
-
-# Display the title and the DataFrame
-display(HTML(title))
-display(df.min(numeric_only=True))
-
-# Clean the data
-df = scrub_a_dub(df)
-assert df is not None
-assert df is not False
-assert isinstance(df, pd.DataFrame)
-
-# Generate timestamped filename for version control
-timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-filename = f"meteorite_clean_{timestamp}.csv"
-
-# saving cleaned data to CSV file
-df.to_csv(filename)
+# SQLite Database Extraction
+# Args: sqliteDB: str SQLite DB Name, tableName: str Table name
+# Returns: tuple (pd.DataFrame, str content fingerprint keying the cached raw statistics),
+#          None if extraction fails
+def extractLandings(sqliteDB="MeteoriteData.sqlite", tableName="meteorite_landings"):
+    from Result_Cache import frameFingerprint
+    # Connect to SQLite DB
+    conn = connectSqlite(sqliteDB)
+    if conn is None:
+        return None
+    try:
+        # Extract from sqlite db, load to df
+        df = sqlToDataframe(conn, tableName)
+        if df is None:
+            return None
+    except Exception as e:
+        print(f"Error: {e}")
+        print("Failure with SQLite DB")
+        return None
+    finally:
+        conn.close()
+    print(f"{len(df.index)} records extracted from SQLite table {tableName} successfully.")
+    # checksum over every row of the loaded frame, keys the cached raw statistics
+    return df, frameFingerprint(df)
+
+# Cleans the raw landings and saves them to a timestamped Parquet file
+# Args: df: pd.DataFrame raw landings, rawFingerprint: str from extractLandings,
+#       resultCache: dict from Result_Cache.openResultCache, outDir: str directory for the file,
+#       dedupIndex: optional dict from Dedup_Index.openDedupIndex, only rows not cleaned
+#       in an earlier run are written, so each file holds the new batch. The rows are
+#       recorded in the index after the file is verified
+# Returns: tuple (all cleaned rows as a pd.DataFrame, str Parquet file name or None when
+#          the dedup index found no new rows), None if cleaning or the write fails
+def cleanLandings(df, rawFingerprint, resultCache, outDir=".", dedupIndex=None):
+    from Columnar_IO import writeColumnar, verifyColumnar
+    from Result_Cache import cachedResult
+    from Stream_Stats import streamStats, statsMin, statsMax
+
+    # Get the 3 largest meteorite landings by mass, before cleaning up the data and removing outliers
+    showTable("<h3>3 Largest Meteorite Landings by Mass</h3>",
+              df.sort_values(by='mass', ascending=False).head(3))
+
+    # One pass statistics accumulator over the raw data, min and max come from it
+    rawStats = cachedResult(resultCache, rawFingerprint, "rawStats", {}, lambda: streamStats([df]))
+    showTable('<h3>Maximum Values</h3>', statsMax(rawStats))
+    showTable('<h3>Minimum Values</h3>', statsMin(rawStats))
+
+    # Clean the data
+    df = scrub_a_dub(df)
+    if df is None or df is False:
+        print("Error cleaning data.")
+        return None
 
-# Verifying data written to CSV file
-# read from csv file, explicitly assigning data types to keep different types from returning false on comparison 
-dfVerify = pd.read_csv(filename, index_col='id', dtype={'id': 'int64','mass': float, 'year': 'Int64', 'reclat': float, 'reclong': float, 'name': str})
-# asserting that dataframe written to csv and dataframe read from csv are equal
-assert df.equals(dfVerify)
+    # incremental runs only write the landings not cleaned before
+    batch, newHashes = df, None
+    if dedupIndex is not None:
+        from Dedup_Index import dedupBatch
+        batch, counts, newHashes = dedupBatch(dedupIndex, df)
+        print(f"{counts['new']} new landings, {counts['seenBefore']} cleaned in an earlier run, "
+              f"{counts['inBatch']} repeated in this batch")
+        if batch.empty:
+            print("No new landings, nothing written.")
+            return df, None
+
+    # Generate timestamped filename for version control
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = os.path.join(outDir, f"meteorite_clean_{timestamp}.parquet")
+
+    # saving cleaned data to a typed, compressed Parquet file, one row group per year
+    # Verifying data written to Parquet file
+    # row count and checksum stored in the file footer, no re-parse of the data
+    if not writeColumnar(batch, filename) or not verifyColumnar(filename, batch):
+        return None
+    if dedupIndex is not None:
+        # only now are the rows stored, a failed write leaves them new for the next run
+        from Dedup_Index import commitBatch
+        commitBatch(dedupIndex, newHashes)
+    return df, filename
 
 # Perform data analysis
-# Create title using HTML
-title = '<h3>Standard Deviation</h3>'
-
-# Display the title and the DataFrame
-display(HTML(title))
-display(df.std(numeric_only=True))
-## mass has a wide distribution, could sanitize the data by standardizing it
-## month looks to be a rather useless variable, it could be dropped from the dataset before further analysis
-## year, reclat and reclong look to have a good distribution in terms of std deviation
-
-# Create title using HTML
-title = '<h3>Skewness Values</h3>'
-
-# Display the title and the DataFrame
-display(HTML(title))
-display(df.skew(numeric_only=True))
-
-# Create title using HTML
-title = '<h3>Summary Statistics</h3>'
-
-# Display the title and the DataFrame
-display(HTML(title))
-display(df.describe())
-
-# Create title using HTML
-title = '<h3>Average Mass by Year</h3>'
-
-# Display the title and the DataFrame
-display(HTML(title))
-avgMassByYear = df.groupby("year")["mass"].mean()
-display(avgMassByYear)
+# std, skew, describe and corr all come from one pass over the cleaned data,
+# the accumulator can be stored so new landings can be merged in with updateStats
+# the content fingerprint of the cleaned data keys the cached cleaned-data results
+# Args: df: pd.DataFrame cleaned landings, cleanFingerprint: str fingerprint of df,
+#       e.g. Result_Cache.fileFingerprint of its cleaned file or frameFingerprint,
+#       resultCache: dict from Result_Cache.openResultCache,
+#       statsFile: optional str, the accumulator is saved there
+# Returns: dict with stats, aggregates, tiles and corr
+def analyzeLandings(df, cleanFingerprint, resultCache, statsFile=None):
+    from Parallel_Agg import groupAggregates, groupMean
+    from Spatial_Grid import gridTiles, bandProfile
+    from Result_Cache import cachedResult, tileCacheDir
+    from Stream_Stats import streamStats, saveStats, statsStd, statsSkew, statsDescribe, statsCorr
+
+    stats = cachedResult(resultCache, cleanFingerprint, "stats", {}, lambda: streamStats([df]))
+    if statsFile is not None:
+        saveStats(stats, statsFile)
+
+    showTable('<h3>Standard Deviation</h3>', statsStd(stats))
+    ## mass has a wide distribution, could sanitize the data by standardizing it
+    ## month looks to be a rather useless variable, it could be dropped from the dataset before further analysis
+    ## year, reclat and reclong look to have a good distribution in terms of std deviation
+    showTable('<h3>Skewness Values</h3>', statsSkew(stats))
+    showTable('<h3>Summary Statistics</h3>', statsDescribe(stats))
+
+    # mass by year and landings per year, one parallel pass
+    aggregates = cachedResult(resultCache, cleanFingerprint, "groupAggregates", {"keys": ["year"], "value": "mass"},
+                              lambda: groupAggregates(df, keys=("year",), value="mass"))
+    # mass over lat/long grid cells at several zoom levels, gridTiles keeps its
+    # own Parquet tile cache inside the result cache directory under the same size cap
+    tiles = gridTiles(df, value="mass", cacheDir=tileCacheDir(resultCache),
+                      maxBytes=resultCache["maxBytes"] if resultCache else 0)
+
+    showTable('<h3>Average Mass by Year</h3>', groupMean(aggregates, "year"))
+    showTable('<h3>Average Mass by Latitude (1 degree bands)</h3>', bandProfile(tiles[1.0], "lat")["mean"])
+    showTable('<h3>Average Mass by Longitude (1 degree bands)</h3>', bandProfile(tiles[1.0], "long")["mean"])
+    ## There might be a pattern with avg by lat, larger hits closer to equator?
+    showTable('<h3>Average Mass by 10 Degree Latitude Band</h3>', bandProfile(tiles[10.0], "lat"))
+
+    corr = statsCorr(stats)
+    showTable('<h3>Correlation Matrix</h3>', corr)
+    return {"stats": stats, "aggregates": aggregates, "tiles": tiles, "corr": corr}
 
-# Create title using HTML
-title = '<h3>Average Mass by Latitude</h3>'
-
-# Display the title and the DataFrame
-display(HTML(title))
-avgMassByLat = df.groupby("reclat")["mass"].mean()
-display(avgMassByLat)
-
-# Create title using HTML
-title = '<h3>Average Mass by Longitude</h3>'
-
-# Display the title and the DataFrame
-display(HTML(title))
-avgMassByLong = df.groupby("reclong")["mass"].mean()
-display(avgMassByLong)
-## There might be a pattern with avg by lat, larger hits closer to equator?
-
-# Create title using HTML
-title = '<h3>Correlation Matrix</h3>'
+# Visualizations
+# Figures are drawn by Figure_Report, the same code renders them headless
+# and in parallel for batch runs: python Figure_Report.py <cleaned parquet> [outDir]
+# Args: df: pd.DataFrame cleaned landings, analysis: dict from analyzeLandings,
+#       reportDir: str output directory for the figures, created if missing
+def plotLandings(df, analysis, reportDir="project"):
+    import matplotlib.pyplot as plt
+    from Figure_Report import drawFigure, figureParams
+    from Parallel_Agg import groupSize
+    os.makedirs(reportDir, exist_ok=True)
+
+    # getting number of meteorite landings per year for the most current 400 years
+    freqSeries = groupSize(analysis["aggregates"], 'year', 1616, 2016)
+    # correlation matrix and landings per year for the figures
+    params = figureParams(analysis["corr"], freqSeries)
+
+    showTable('<h2>Visualizations</h2>')
+    showTable('<h3>Histograms for Each Numeric Variable</h3>')
+
+    # creates a histogram for each numeric variable on a 2 by 2 grid
+    drawFigure("histograms", df, params, reportDir)
+    plt.show()
+    plt.close('all')
+
+    # color matrix from the correlation table, values of 1 start at top left
+    drawFigure("corrColorMatrix", df, params, reportDir)
+    plt.show()
+    plt.close('all')
+
+    showTable('<h3>Scatter plots</h3>')
+
+    # Scatter plots are rasterized: points are binned onto a fixed size canvas
+    # and drawn with imshow, color is the number of landings per pixel (log scale)
+    # Scatter plot Mass vs Year
+    drawFigure("scatterMassYear", df, params, reportDir)
+    plt.show()
+    plt.close('all')
+
+    # Scatter plot Latitude vs Year
+    drawFigure("scatterLatYear", df, params, reportDir)
+    plt.show()
+    plt.close('all')
+
+    # Geospatial mapping of meteorite landings
+    # x and y axies are longitude and latitude
+    # A 3rd dimension (color) is added to account for the mass of the meteorite. 
+    # Rasterized onto a half degree canvas, color is the largest mass landing in
+    # each pixel, histogram equalized so the heavy tail doesn't wash out the map
+    drawFigure("geospatialMap", df, params, reportDir)
+    plt.show()
+    plt.close('all')
+
+    # number of landings per year with a line of best fit from np.polyfit
+    drawFigure("landingsPerYearLine", df, params, reportDir)
+    plt.show()
+    plt.close('all')
+
+# Runs the whole cleaning and analytics pipeline
+# Only runs when the file is executed, importing it just defines the stages
+def main():
+    from Result_Cache import openResultCache, reportResultCache, fileFingerprint, frameFingerprint
+    # Per-stage timing and memory metrics, enabled by METEORITE_METRICS_LOG,
+    # METEORITE_METRICS_PROM or METEORITE_PROFILE_STAGE (see Stage_Metrics)
+    metricsOn = metricsFromEnv()
+    # SQL database and table name
+    sqliteDB = "MeteoriteData.sqlite"
+    tableNameSQL = "meteorite_landings"
 
-# Display the title and the DataFrame
-display(HTML(title))
-corr = df.corr(numeric_only=True)
-display(corr)
+    extracted = extractLandings(sqliteDB, tableNameSQL)
+    assert extracted is not None
+    df, rawFingerprint = extracted
+    assert isinstance(df, pd.DataFrame)
 
-# Visualizations
-# Create title using HTML
-title = '<h2>Visualizations</h2>'
-# Display the title
-display(HTML(title))
-
-# HTML title
-title = '<h3>Histograms for Each Numeric Variable</h3>'
-# Display the title and the DataFrame
-display(HTML(title))
-
-# creates a 2 by 2 display for plots
-fig, axs = plt.subplots(2,2)
-
-# creates a histogram for each numeric variable and assigns it to a subplot sector
-axs[0,0].hist(df['year'], bins=12, range=(df['year'].min(), df['year'].max()), color='blue')
-axs[0,0].set_title('year')
-axs[0,1].hist(df['mass'], bins=12, range=(df['mass'].min(), df['mass'].max()), color='green')
-axs[0,1].set_title('mass')
-axs[1,0].hist(df['reclat'], bins=12, range=(df['reclat'].min(), df['reclat'].max()), color='purple')
-axs[1,0].set_title('reclat')
-axs[1,1].hist(df['reclong'], bins=12, range=(df['reclong'].min(), df['reclong'].max()), color='orange')
-axs[1,1].set_title('reclong')
-plt.tight_layout()
-plt.savefig("project/histograms.png", bbox_inches='tight')
-plt.show()
-plt.close('all')
-
-# set size to keep labels from overlapping
-plt.figure(figsize=(3, 3))
-# create color matrix from correlation table
-plt.pcolormesh(corr)
-# set x and y axis labels
-plt.xticks(range(4), corr.index, rotation=45)
-plt.yticks(range(4), corr.index)
-# inverts plot, values of 1 start at top left
-plt.ylim(4,0)
-# adds color bar
-plt.colorbar()
-# adds title
-plt.title("Meteorite Landing Correlation Matrix", loc='center')
-# saves matrix to file, bbox_inches keeps labels from being cut off
-plt.savefig("project/corrColorMatrix.png", bbox_inches='tight')
-plt.tight_layout()
-plt.show()
-plt.close('all')
-
-# HTML title
-title = '<h3>Scatter plots</h3>'
-# Display the title and the DataFrame
-display(HTML(title))
-
-# Scatter plot Mass vs Year
-figScatter = df.plot.scatter(x='mass', y='year', xlabel="Mass", ylabel="Year", title="Mass by Year", logx=False)
-figScatter.figure.savefig("project/scatterMassYear.png", bbox_inches='tight')
-plt.show()
-plt.close('all')
-
-# Scatter plot Latitude vs Year
-figScatter1 = df.plot.scatter(x='reclat', y='year', xlabel="Latitude logx", ylabel="Year", title="Latitude by Year", logx=True)
-figScatter1.figure.savefig("project/scatterLatYear.png", bbox_inches='tight')
-plt.show()
-plt.close('all')
-
-# Geospatial mapping of meteorite landings
-# x and y axies are longitude and latitude
-# A 3rd dimension (color) is added to account for the mass of the meteorite. 
-plt.scatter(df['reclong'], df['reclat'], c=df['mass'], cmap='viridis', alpha=0.5)
-# include color bar to show what the colors mean
-plt.colorbar(label='Mass of Meteorite')
-plt.title('Meteorite Landings by Location')
-plt.xlabel('Longitude')
-plt.ylabel('Latitude')
-plt.savefig("project/geospatialMap.png")
-plt.show()
-plt.close('all')
-
-# getting number of meteorite landings per year for the most current 400 years
-freqSeries= df[(df['year'] >= 1616) & (df['year'] <= 2016)].groupby('year').size()
-# Calculating line of best fit using numpy polyfit and covariance matrix
-coefficients, cov = np.polyfit(freqSeries.index, freqSeries.values, 1, full=False, cov=True) # 1 = linear regression
-# creates 1 dimensional polynomial for plotting the line
-fit = np.poly1d(coefficients)
-
-# Sets display size
-plt.figure(figsize=(4, 3))
-# plots number of meteorite landings per year using accessible color pairing
-plt.plot(freqSeries.index, freqSeries.values, 'o',color='#05fe04')
-# plots the line of best fit using accessible color pairing
-plt.plot(freqSeries.index, fit(freqSeries.index), linestyle='-', color='#d71b60')
-# Creates labels for plot
-plt.title('Number of Landings per Year with Line of Best Fit')
-plt.xlabel('Year')
-plt.ylabel('Number of Meteorite Landings')
-# saves plot to file
-plt.savefig('project/landingsPerYearLine.png')
-plt.show()
-plt.close('all')
+    # Analytics results are cached on disk keyed by a fingerprint of the data they
+    # were computed from, unchanged data is served from the cache
+    resultCache = openResultCache("result_cache")
+    # incremental runs: METEORITE_DEDUP_KEYS=id (or name,reclat,reclong,year) keeps
+    # only landings not cleaned before, the index is stored next to the database
+    dedupIndex = None
+    if os.environ.get("METEORITE_DEDUP_KEYS"):
+        from Dedup_Index import openDedupIndex
+        dedupIndex = openDedupIndex(sqliteDB, os.environ["METEORITE_DEDUP_KEYS"].split(","))
+    cleaned = cleanLandings(df, rawFingerprint, resultCache, dedupIndex=dedupIndex)
+    assert cleaned is not None
+    df, filename = cleaned
+    assert isinstance(df, pd.DataFrame)
+    if filename is None:
+        print("No new landings since the last run, skipping analysis and figures.")
+        return
+
+    # with a dedup index the file holds only the new batch, the full cleaned
+    # data is analyzed and keyed on its own checksum
+    cleanFingerprint = fileFingerprint(filename) if dedupIndex is None else frameFingerprint(df)
+    # the accumulator is stored next to the database for updateStats
+    analysis = analyzeLandings(df, cleanFingerprint, resultCache, statsFile=sqliteDB + ".stats.json")
+    # hits and misses for this run
+    reportResultCache(resultCache)
+
+    # Output directory for the figures
+    plotLandings(df, analysis, os.environ.get("METEORITE_REPORT_DIR", "project"))
+
+    # Time and memory per stage for this run
+    if metricsOn:
+        reportMetrics()
+
+if __name__ == "__main__":
+    main()
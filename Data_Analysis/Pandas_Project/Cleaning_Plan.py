@@ -0,0 +1,120 @@
+# Setup
+# Importing required libraries
+from Lazy_Import import lazyImport
+from Stage_Metrics import instrumented
+np = lazyImport("numpy")
+pd = lazyImport("pandas")
+
+# Declarative cleaning spec, compiled once and applied in a single pass
+# spec = {
+#     "fill":   {column: "mean" | "median" | constant},  "*" means every numeric column
+#     "dedup":  None (whole-row duplicates), list of key columns, or False (off)
+#     "bounds": {column: (min, max, "clip" | "drop")},   inclusive range
+# }
+# Rules run in a fixed order: fills first, duplicates are found on the
+# filled data, then bounds.
+
+# Valid ranges for the landings columns, min and max inclusive
+LANDING_BOUNDS = {
+    "reclong": (-180.000, 180.000),
+    "reclat": (-90.000, 90.000),
+    "year": (861, 2016),
+    "mass": (0, 750000)}
+
+# Cleaning spec used by scrub_a_dub
+# Missing numeric values replaced with the column mean, whole-row duplicates
+# dropped, out of range values clipped, except 'year' rows which are deleted
+# Args: bounds: dict column -> (min, max)
+# Returns: dict cleaning spec for compilePlan
+def landingSpec(bounds=LANDING_BOUNDS):
+    return {
+        "fill": {"*": "mean"},
+        "dedup": None,
+        "bounds": {col: (lo, hi, "drop" if col == "year" else "clip") for col, (lo, hi) in bounds.items()}}
+
+# Resolves a cleaning spec against a DataFrame's columns
+# Args: spec: dict cleaning spec, df: pd.DataFrame the plan will run on
+# Returns: dict plan with resolved fill columns, dedup subset, clip and drop bounds
+def compilePlan(spec, df):
+    fill = dict(spec.get("fill", {}))
+    if "*" in fill:
+        # wildcard covers every numeric column not named explicitly
+        rule = fill.pop("*")
+        for col in df.columns:
+            if pd.api.types.is_numeric_dtype(df[col]) and col not in fill:
+                fill[col] = rule
+    dedup = spec.get("dedup", None)
+    bounds = spec.get("bounds", {})
+    return {
+        "fill": {col: rule for col, rule in fill.items() if col in df.columns},
+        "dedup": dedup,
+        "clip": {col: (lo, hi) for col, (lo, hi, action) in bounds.items() if action == "clip"},
+        "drop": {col: (lo, hi) for col, (lo, hi, action) in bounds.items() if action == "drop"},
+    }
+
+# Fill value for one column
+# Args: series: pd.Series, rule: "mean", "median" or a constant
+# Returns: scalar, rounded for integer columns so the dtype is kept
+def fillValue(series, rule):
+    if rule == "mean":
+        value = series.mean()
+    elif rule == "median":
+        value = series.median()
+    else:
+        return rule
+    if pd.api.types.is_integer_dtype(series) and pd.notna(value):
+        return int(round(value))
+    return value
+
+# Runs a compiled cleaning plan
+# All masks are computed once: null counts per fill column, one duplicated()
+# hash pass and one range check per bounds column. Rows are removed with a
+# single boolean index and only columns that need it are filled or clipped.
+# Args: df: pd.DataFrame, plan: dict from compilePlan
+# Returns: tuple (cleaned pd.DataFrame, pd.DataFrame report with one row per rule)
+@instrumented()
+def runPlan(df, plan):
+    report = []
+
+    # fills, values computed on the data as loaded
+    fills = {}
+    if plan["fill"]:
+        fillCols = list(plan["fill"])
+        missing = df[fillCols].isna().sum()
+        for col in fillCols:
+            if missing[col] > 0:
+                fills[col] = fillValue(df[col], plan["fill"][col])
+            report.append({"rule": "fill", "column": col, "rows": int(missing[col]),
+                           "detail": fills.get(col)})
+    if fills:
+        # copies only the columns being filled
+        df = df.assign(**{col: df[col].fillna(value) for col, value in fills.items()})
+
+    # one keep mask for every rule that removes rows
+    keep = np.ones(len(df), dtype=bool)
+    if plan["dedup"] is not False:
+        dup = df.duplicated(subset=plan["dedup"]).to_numpy()
+        keep &= ~dup
+        report.append({"rule": "dedup", "column": ",".join(plan["dedup"] or ["*"]),
+                       "rows": int(dup.sum()), "detail": None})
+    for col, (lo, hi) in plan["drop"].items():
+        values = df[col]
+        inRange = ((values >= lo) & (values <= hi)).fillna(False).to_numpy(dtype=bool)
+        report.append({"rule": "drop", "column": col, "rows": int((keep & ~inRange).sum()),
+                       "detail": (lo, hi)})
+        keep &= inRange
+    if not keep.all():
+        df = df[keep]
+
+    # clips on the surviving rows, only columns with out-of-range values are rewritten
+    clipped = {}
+    for col, (lo, hi) in plan["clip"].items():
+        values = df[col]
+        count = int(((values < lo) | (values > hi)).sum())
+        if count > 0:
+            clipped[col] = values.clip(lower=lo, upper=hi)
+        report.append({"rule": "clip", "column": col, "rows": count, "detail": (lo, hi)})
+    if clipped:
+        df = df.assign(**clipped)
+
+    return df, pd.DataFrame(report, columns=["rule", "column", "rows", "detail"])
@@ -0,0 +1,147 @@
+# Setup
+# Importing required libraries
+import os, time, hashlib, json, tempfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
+from Stage_Metrics import instrumented
+
+# Schema metadata key holding the row count and content checksum
+META_KEY = b"meteorite"
+
+# Content checksum of a DataFrame, index included
+# Hashes every row with pandas' vectorized row hash, no text formatting
+# Args: df: pd.DataFrame
+# Returns: str hex digest
+def frameChecksum(df):
+    rowHashes = pd.util.hash_pandas_object(df, index=True).to_numpy()
+    return hashlib.sha256(rowHashes.tobytes()).hexdigest()
+
+# Picks the columnar format from the file name
+# Args: fileName: str, fmt: None, 'parquet' or 'feather'
+# Returns: str 'parquet' or 'feather'
+def columnarFormat(fileName, fmt=None):
+    if fmt is not None:
+        return fmt
+    if fileName.endswith((".feather", ".arrow")):
+        return "feather"
+    return "parquet"
+
+# Writes a DataFrame to a typed, compressed columnar file
+# Parquet rows are sorted by partitionBy and written one row group per value,
+# so readers can skip the row groups they don't need. The row count and
+# frameChecksum are stored in the schema metadata for cheap verification.
+# Written to a temp file and renamed into place.
+# Args: df: pd.DataFrame, fileName: str (.parquet, .feather or .arrow),
+#       fmt: optional 'parquet' or 'feather', partitionBy: optional str column,
+#       compression: str codec ('zstd', 'snappy', 'lz4', ...)
+# Returns: True if write is successful, None if not for error handling
+@instrumented()
+def writeColumnar(df, fileName, fmt=None, partitionBy="year", compression="zstd"):
+    fmt = columnarFormat(fileName, fmt)
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)), suffix=".tmp")
+    os.close(fd)
+    try:
+        meta = json.dumps({"rows": len(df), "checksum": frameChecksum(df)}).encode()
+        if partitionBy is not None and partitionBy in df.columns:
+            # stable sort keeps the original order inside each partition
+            df = df.sort_values(partitionBy, kind="stable")
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), META_KEY: meta})
+        if fmt == "feather":
+            feather.write_feather(table, tmpPath, compression=compression)
+        else:
+            with pq.ParquetWriter(tmpPath, table.schema, compression=compression) as writer:
+                if partitionBy is not None and partitionBy in df.columns:
+                    # one row group per partition value
+                    keys = df[partitionBy].to_numpy()
+                    start = 0
+                    for end in list((keys[1:] != keys[:-1]).nonzero()[0] + 1) + [len(df)]:
+                        writer.write_table(table.slice(start, end - start))
+                        start = end
+                else:
+                    writer.write_table(table)
+        os.replace(tmpPath, fileName)
+        return True
+    except Exception as e:
+        # Prints error statement, removes the partial file and returns None
+        os.remove(tmpPath)
+        print(f"Error writing columnar file {fileName}: {e}")
+        return None
+
+# Reads a columnar file back into a DataFrame, memory-mapped
+# Args: fileName: str, columns: optional list of columns,
+#       years: optional (min, max), only the matching Parquet row groups are read,
+#       fmt: optional 'parquet' or 'feather'
+# Returns: pd.DataFrame indexed as it was written
+def readColumnar(fileName, columns=None, years=None, fmt=None):
+    fmt = columnarFormat(fileName, fmt)
+    if fmt == "feather":
+        table = feather.read_table(fileName, columns=columns, memory_map=True)
+        if years is not None:
+            df = table.to_pandas()
+            return df[(df["year"] >= years[0]) & (df["year"] <= years[1])]
+        return table.to_pandas()
+    filters = None
+    if years is not None:
+        filters = [("year", ">=", years[0]), ("year", "<=", years[1])]
+    return pq.read_table(fileName, columns=columns, filters=filters, memory_map=True).to_pandas()
+
+# Reads the row count and checksum stored by writeColumnar
+# Only the file footer/schema is read, not the data
+# Args: fileName: str, fmt: optional 'parquet' or 'feather'
+# Returns: dict with rows and checksum, None if the file has no stored metadata
+def columnarMeta(fileName, fmt=None):
+    fmt = columnarFormat(fileName, fmt)
+    if fmt == "feather":
+        with pa.memory_map(fileName) as source:
+            schema = pa.ipc.open_file(source).schema
+    else:
+        schema = pq.read_schema(fileName)
+    meta = (schema.metadata or {}).get(META_KEY)
+    return json.loads(meta) if meta is not None else None
+
+# Verifies a written file against the DataFrame it was written from
+# Compares the stored row count and checksum, no full re-parse of the data
+# Args: fileName: str, df: pd.DataFrame, fmt: optional 'parquet' or 'feather'
+# Returns: True if row count and checksum match, False otherwise
+def verifyColumnar(fileName, df, fmt=None):
+    meta = columnarMeta(fileName, fmt)
+    if meta is None:
+        print(f"No verification metadata in {fileName}")
+        return False
+    if columnarFormat(fileName, fmt) == "parquet":
+        # footer row count must agree with the stored count
+        if pq.ParquetFile(fileName).metadata.num_rows != meta["rows"]:
+            return False
+    return meta["rows"] == len(df) and meta["checksum"] == frameChecksum(df)
+
+# Times write, read and disk size of the CSV round-trip against the columnar formats
+# Args: df: pd.DataFrame of cleaned data, baseName: str file name without extension,
+#       keep: bool keep the files written
+# Returns: pd.DataFrame with write seconds, read seconds and MB per format
+def compareOutputFormats(df, baseName="meteorite_compare", keep=False):
+    results = {}
+    csvName = baseName + ".csv"
+    start = time.perf_counter()
+    df.to_csv(csvName)
+    written = time.perf_counter()
+    # read back with the frame's own dtypes, compact dtypes included
+    dtypes = {df.index.name: df.index.dtype, **df.dtypes.to_dict()}
+    pd.read_csv(csvName, index_col=df.index.name, dtype=dtypes)
+    results["csv"] = (written - start, time.perf_counter() - written, os.path.getsize(csvName))
+    for fmt, ext in (("parquet", ".parquet"), ("feather", ".feather")):
+        fileName = baseName + ext
+        start = time.perf_counter()
+        writeColumnar(df, fileName, fmt)
+        written = time.perf_counter()
+        readColumnar(fileName, fmt=fmt)
+        results[fmt] = (written - start, time.perf_counter() - written, os.path.getsize(fileName))
+    if not keep:
+        for ext in (".csv", ".parquet", ".feather"):
+            os.remove(baseName + ext)
+    report = pd.DataFrame(results, index=["write s", "read s", "bytes"]).T
+    report["MB"] = report.pop("bytes") / 1e6
+    print(report)
+    return report
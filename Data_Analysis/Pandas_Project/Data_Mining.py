@@ -1,14 +1,47 @@
 # Setup
 # Importing required libraries
-import requests, json, pymongo, pprint, os, datetime, sqlite3
+import json, os, datetime, sqlite3, time, gzip, io, tempfile, hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from itertools import islice
+from Lazy_Import import lazyImport
+from Http_Cache import openCache, cachedGet, HTTP_TIMEOUT
+from Sqlite_Store import bulkLoadSqlite, landingIndexes
+# heavy libraries are imported on first use, importing the stages stays cheap
+requests = lazyImport("requests")
+pymongo = lazyImport("pymongo")
+bson = lazyImport("bson")
+np = lazyImport("numpy")
+pd = lazyImport("pandas")
+pa = lazyImport("pyarrow")
+from Stage_Metrics import instrumented, metricsFromEnv, reportMetrics
 
 # Uses requests library to scrape file from website
-# Args: url: string Must be url for json file
+# Args: url: string Must be url for json file,
+#       cache: optional dict from Http_Cache.openCache, revalidates a stored copy,
+#       timeout: (connect, read) seconds
 # Returns list of json objects from json file
-def scraper(url):
+@instrumented(rowsArg=None)
+def scraper(url, cache=None, timeout=HTTP_TIMEOUT):
+    if cache is not None:
+        # conditional request, a 304 or offline mode is served from disk
+        fetched = cachedGet(requests, url, None, cache, timeout)
+        if fetched is None:
+            return None
+        body, status, fromCache = fetched
+        if status == 200:
+            jData = json.loads(body)
+            print(f"Retrieved {len(jData)} documents from {'cache' if fromCache else url}")
+            return jData
+        print(f"Data retrieval error: {status}")
+        return None
     # URL request to retrieve data
-    fileData = requests.get(url)
+    try:
+        fileData = requests.get(url, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        print(f"Data retrieval error: {e}")
+        return None
     # Checks for successful status_code
     if fileData.status_code == 200:
         # deserializes data
@@ -22,25 +55,234 @@ def scraper(url):
         print(f"Data retrieval error: {fileData.status_code}")
         return None
 
-# Writes data to json file
-# Args: data: list of json objects, fileName string json file name to write to
-# Returns  True if write is successful, None if not for error handling
-def toJsonFile(data, fileName):
-    # Error handling
+# Builds one shared requests.Session for all page requests
+# Keeps connections open between pages and retries failed requests with
+# exponential backoff on 429 and 5xx responses, connection errors and read
+# timeouts (requests pass timeout=HTTP_TIMEOUT so a stalled socket times out)
+# Args: poolSize: int max pooled connections, retries: int max retries per request,
+#       backoff: float backoff factor in seconds (backoff * 2 ** (retry - 1))
+# Returns: requests.Session object
+def makeSession(poolSize=8, retries=5, backoff=0.5):
+    from urllib3.util.retry import Retry
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET",), respect_retry_after_header=True)
+    # Connection pool sized for the number of pages in flight
+    adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# Requests a single page of a Socrata endpoint
+# Args: session: requests.Session (or the requests module), url: string,
+#       offset: int first record of the page, pageSize: int records per page,
+#       cache: optional dict from Http_Cache.openCache, timeout: (connect, read) seconds
+# Returns: tuple (list of json objects, int bytes received), None if fails
+def fetchPage(session, url, offset, pageSize, cache=None, timeout=HTTP_TIMEOUT):
+    # Socrata paging parameters, :id ordering keeps offsets consistent
+    params = {"$limit": pageSize, "$offset": offset, "$order": ":id"}
+    if cache is not None:
+        fetched = cachedGet(session, url, params, cache, timeout)
+        if fetched is None:
+            return None
+        body, status, fromCache = fetched
+        if status != 200:
+            print(f"Data retrieval error at offset {offset}: {status}")
+            return None
+        # bytes received is 0 when the page came from disk
+        return json.loads(body), 0 if fromCache else len(body)
     try:
-        # opens output file and creates file object f
-        with open(fileName, 'w') as f:
-            # writes JSON formated data to output file
-            # indents JSON objects
-            f.write(json.dumps(data, indent=4))
-        # closes file
-        f.close()
-        # returns True for success
-        return True
-    except Exception:
-        # Prints error statement and returns None for failure
-        print("Error writing to JSON file.")
+        fileData = session.get(url, params=params, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        # retries exhausted, connection failure or read timeout
+        print(f"Data retrieval error at offset {offset}: {e}")
         return None
+    # Checks for successful status_code
+    if fileData.status_code != 200:
+        print(f"Data retrieval error at offset {offset}: {fileData.status_code}")
+        return None
+    # deserializes only this page
+    return fileData.json(), len(fileData.content)
+
+# Walks a Socrata endpoint page by page instead of one large request
+# Uses $limit/$offset paging ordered by :id so pages are stable
+# Each page is parsed on its own, only one page is held in memory at a time
+# Args: url: string Must be url for json endpoint, pageSize: int records per page,
+#       session: optional requests.Session to reuse connections,
+#       cache: optional dict from Http_Cache.openCache, timeout: (connect, read) seconds
+# Yields: list of json objects for each page, stops at the first short page
+def scrapePages(url, pageSize=1000, session=None, cache=None, timeout=HTTP_TIMEOUT):
+    if session is None:
+        session = requests
+    offset = 0
+    while True:
+        fetched = fetchPage(session, url, offset, pageSize, cache, timeout)
+        # stops on error, pages already yielded stay valid
+        if fetched is None:
+            return
+        page = fetched[0]
+        if len(page) > 0:
+            yield page
+        # A short (or empty) page means the end of the dataset
+        if len(page) < pageSize:
+            print(f"Retrieved {offset + len(page)} documents from {url}")
+            return
+        offset += pageSize
+
+# Downloads pages concurrently with a thread pool over one shared session
+# Keeps inFlight pages requested ahead of the consumer and yields them in
+# page order, the first short page ends the download
+# Args: url: string Must be url for json endpoint, pageSize: int records per page,
+#       workers: int threads, inFlight: int pages requested ahead (default 2 * workers),
+#       session: optional requests.Session (default makeSession(workers)),
+#       stats: optional dict filled with pages, bytes, seconds, pagesPerSec, bytesPerSec,
+#       cache: optional dict from Http_Cache.openCache, timeout: (connect, read) seconds
+# Yields: list of json objects for each page, in page order
+def scrapeConcurrent(url, pageSize=1000, workers=8, inFlight=None, session=None, stats=None,
+                     cache=None, timeout=HTTP_TIMEOUT):
+    if inFlight is None:
+        inFlight = 2 * workers
+    if session is None:
+        session = makeSession(poolSize=workers)
+    if stats is None:
+        stats = {}
+    pages = 0
+    nBytes = 0
+    start = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=workers)
+    # futures in page order, the head is always the next page to yield
+    pending = deque()
+    nextOffset = 0
+    try:
+        for _ in range(inFlight):
+            pending.append((nextOffset, pool.submit(fetchPage, session, url, nextOffset, pageSize, cache, timeout)))
+            nextOffset += pageSize
+        while pending:
+            offset, future = pending.popleft()
+            fetched = future.result()
+            # stops on error, pages already yielded stay valid
+            if fetched is None:
+                return
+            page, size = fetched
+            pages += 1
+            nBytes += size
+            if len(page) > 0:
+                yield page
+            # A short (or empty) page means the end of the dataset
+            if len(page) < pageSize:
+                print(f"Retrieved {offset + len(page)} documents from {url}")
+                return
+            # keeps the window full
+            pending.append((nextOffset, pool.submit(fetchPage, session, url, nextOffset, pageSize, cache, timeout)))
+            nextOffset += pageSize
+    finally:
+        # drops requests past the end of the dataset
+        for _, future in pending:
+            future.cancel()
+        pool.shutdown(wait=False, cancel_futures=True)
+        seconds = time.perf_counter() - start
+        stats.update(pages=pages, bytes=nBytes, seconds=seconds,
+                     pagesPerSec=pages / seconds if seconds > 0 else 0.0,
+                     bytesPerSec=nBytes / seconds if seconds > 0 else 0.0)
+        print(f"{pages} pages, {nBytes} bytes in {seconds:.2f}s "
+              f"({stats['pagesPerSec']:.1f} pages/sec, {stats['bytesPerSec'] / 1e6:.2f} MB/sec)")
+
+# Flattens pages from scrapePages into a stream of single records
+# Args: pages: iterable of lists of json objects
+# Yields: json objects one at a time, for insertSqlite and other record consumers
+def iterRecords(pages):
+    for page in pages:
+        yield from page
+
+# Picks the snapshot compression from the file name
+# Args: fileName: str, compression: None, 'gzip', 'zstd' or 'none'
+# Returns: str 'gzip', 'zstd' or 'none'
+def snapshotCompression(fileName, compression=None):
+    if compression is not None:
+        return compression
+    if fileName.endswith(".gz"):
+        return "gzip"
+    if fileName.endswith(".zst"):
+        return "zstd"
+    return "none"
+
+# Streams records to a newline-delimited JSON snapshot in a single pass
+# Lines are buffered bufferSize records at a time, so memory stays bounded
+# Written to a temp file and renamed into place, a crashed run never leaves
+# a truncated snapshot behind
+# Args: records: iterable of json objects, fileName: str e.g. "data.ndjson.gz",
+#       compression: None (from file name), 'gzip', 'zstd' or 'none',
+#       bufferSize: int records per write
+# Returns: int number of records written, None if fails
+@instrumented()
+def writeSnapshot(records, fileName, compression=None, bufferSize=1000):
+    compression = snapshotCompression(fileName, compression)
+    # temp file in the same directory so the rename is atomic
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)), suffix=".tmp")
+    count = 0
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            if compression == "gzip":
+                stream = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+            elif compression == "zstd":
+                # optional dependency, only needed for .zst snapshots
+                import zstandard
+                stream = zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+            else:
+                stream = raw
+            buffer = []
+            for rec in records:
+                # compact separators, one document per line
+                buffer.append(json.dumps(rec, separators=(',', ':')))
+                if len(buffer) >= bufferSize:
+                    stream.write(("\n".join(buffer) + "\n").encode())
+                    count += len(buffer)
+                    buffer = []
+            if buffer:
+                stream.write(("\n".join(buffer) + "\n").encode())
+                count += len(buffer)
+            if stream is not raw:
+                stream.close()
+        # replaces any previous snapshot in one step
+        os.replace(tmpPath, fileName)
+        print(f"Wrote {count} records to {fileName}")
+        return count
+    except Exception as e:
+        # Prints error statement, removes the partial file and returns None
+        os.remove(tmpPath)
+        print(f"Error writing snapshot {fileName}: {e}")
+        return None
+
+# Streams records back out of a snapshot written by writeSnapshot
+# Args: fileName: str, compression: None (from file name), 'gzip', 'zstd' or 'none'
+# Yields: json objects one at a time
+def readSnapshot(fileName, compression=None):
+    compression = snapshotCompression(fileName, compression)
+    with open(fileName, 'rb') as raw:
+        if compression == "gzip":
+            stream = gzip.GzipFile(fileobj=raw, mode='rb')
+        elif compression == "zstd":
+            import zstandard
+            stream = zstandard.ZstdDecompressor().stream_reader(raw)
+        else:
+            stream = raw
+        for line in io.TextIOWrapper(stream, encoding='utf-8'):
+            if line.strip():
+                yield json.loads(line)
+
+# Groups snapshot records into pages so it can stand in for scrapePages
+# Args: fileName: str, pageSize: int records per page
+# Yields: list of json objects for each page
+def readSnapshotPages(fileName, pageSize=1000):
+    page = []
+    for rec in readSnapshot(fileName):
+        page.append(rec)
+        if len(page) >= pageSize:
+            yield page
+            page = []
+    if page:
+        yield page
 
 # Retrieves the user name and password from local file
 # Creates a uri string with the data pulled from file
@@ -84,6 +326,7 @@ def connectMongoDB(uri):
 # adds data to the MongoDB
 # Args : data: list of json objects, db: pymongo.database.Database
 # Returns: pymongo.results.InsertManyResult
+@instrumented()
 def mdbInsert(data, db):
     # drops collection if it is in database
     if db.meteorite_landings.count_documents({}) > 0:
@@ -94,38 +337,146 @@ def mdbInsert(data, db):
     result = db.meteorite_landings.insert_many(data)
     # error handling: returns result if result set is not empty
     if result:
-        print(f"Inserted {db.meteorite_landings.count_documents({})} into meteorite_landings collection.")
+        # count comes from the insert result, no second collection scan
+        print(f"Inserted {len(result.inserted_ids)} into meteorite_landings collection.")
         return result
     # prints error message and returns None if fails
     else:
         print("Data did not load to MongoDB or dataset is empty.")
-        return None# Uses requests library to scrape file from website
+        return None
+
+# adds paged data to the MongoDB as each page arrives
+# Args : pages: iterable of lists of json objects (see scrapePages),
+#        db: pymongo.database.Database
+# Returns: int number of documents inserted, None if nothing was inserted
+@instrumented(rowsArg=None)
+def mdbInsertPages(pages, db):
+    # drops collection if it is in database
+    if db.meteorite_landings.count_documents({}) > 0:
+        # deletes collection for testing
+        db.meteorite_landings.drop()
+
+    inserted = 0
+    # inserts each page as soon as it is downloaded
+    for page in pages:
+        result = db.meteorite_landings.insert_many(page)
+        inserted += len(result.inserted_ids)
+    # error handling: returns count if anything was inserted
+    if inserted > 0:
+        print(f"Inserted {inserted} into meteorite_landings collection.")
+        return inserted
+    # prints error message and returns None if fails
+    else:
+        print("Data did not load to MongoDB or dataset is empty.")
+        return None
+
+# Splits an iterable into lists of at most size items
+# Args: iterable: any iterable, size: int items per chunk
+# Yields: list of items
+def chunked(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Content hash of a json object, stable across key order
+# Args: rec: dict json object
+# Returns: str hex digest
+def recordHash(rec):
+    return hashlib.sha1(json.dumps(rec, sort_keys=True, separators=(',', ':'), default=str).encode()).hexdigest()
+
+# Stored hash lookup for the ids of one chunk
+HASH_PROJECTION = {"_id": 0, "id": 1, "_contentHash": 1}
+
+# Builds the upserts for one chunk of records
+# Records whose hash is already stored are counted as unchanged and skipped
+# Args: latest: dict id -> record, stored: dict id -> stored content hash,
+#       counts: dict inserted/updated/unchanged counts, updated in place
+# Returns: list of pymongo.ReplaceOne
+def syncOps(latest, stored, counts):
+    ops = []
+    for recId, rec in latest.items():
+        h = recordHash(rec)
+        if stored.get(recId) == h:
+            counts["unchanged"] += 1
+            continue
+        doc = dict(rec)
+        doc["_contentHash"] = h
+        ops.append(pymongo.ReplaceOne({"id": recId}, doc, upsert=True))
+    return ops
+
+# Adds a bulk_write result to the sync counts
+# Args: counts: dict updated in place, result: pymongo BulkWriteResult
+def addSyncCounts(counts, result):
+    counts["inserted"] += result.upserted_count
+    counts["updated"] += result.modified_count
+    # matched but identical, e.g. hash field missing on an old document
+    counts["unchanged"] += result.matched_count - result.modified_count
+
+# Syncs one chunk of records into a collection
+# Args: coll: pymongo Collection, chunk: list of json objects with an id field,
+#       counts: dict inserted/updated/unchanged counts, updated in place
+def syncChunk(coll, chunk, counts):
+    # last occurrence wins if an id repeats inside the chunk
+    latest = {rec["id"]: rec for rec in chunk}
+    # stored hashes for this chunk only
+    stored = {doc["id"]: doc.get("_contentHash") for doc in
+              coll.find({"id": {"$in": list(latest)}}, HASH_PROJECTION)}
+    ops = syncOps(latest, stored, counts)
+    if ops:
+        addSyncCounts(counts, coll.bulk_write(ops, ordered=False))
+
+# Incrementally syncs records into a collection instead of drop-and-reload
+# Each record is upserted on id with its content hash stored in _contentHash,
+# records whose hash is already stored are skipped without being sent.
+# Writes go through unordered bulk_write batches of chunkSize upserts.
+# Uses ReplaceOne rather than UpdateOne $set so fields removed upstream
+# don't linger in the stored document.
+# Args: records: iterable of json objects with an id field,
+#       coll: pymongo Collection, chunkSize: int records per bulk_write
+# Returns: dict counts of inserted, updated and unchanged documents
+@instrumented()
+def mdbSync(records, coll, chunkSize=1000):
+    # id lookups for the hash comparison and the upsert filter
+    coll.create_index("id", unique=True)
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    for chunk in chunked(records, chunkSize):
+        syncChunk(coll, chunk, counts)
+    print(f"Synced {coll.name}: {counts['inserted']} inserted, "
+          f"{counts['updated']} updated, {counts['unchanged']} unchanged.")
+    return counts
+
+# Converts one raw document to a typed landing record
+# Args : rec: dict document from the find query
+# Returns: dict with name, id, mass, year, reclat and reclong
+def landingRecord(rec):
+    # Convert strings to numbers and handle missing fields
+    dateTemp = getMonthYear(rec.get("year", ""))
+    return {
+        # Inserts empty string if no value present
+        "name": rec.get("name", ""),
+        # id must exist
+        "id": int(rec["id"]),
+        # Inserts 0.0 if does no value present
+        "mass": float(rec["mass"]) if "mass" in rec else 0.0,
+        "year": dateTemp[0],
+        "reclat": float(rec["reclat"]) if "reclat" in rec else 0.0,
+        "reclong": float(rec["reclong"]) if "reclong" in rec else 0.0,
+    }
 
 # Extracts documents from MongoDB
 # Args : coll: pymongo Collection, f: str query filter
 #        proj: str query projections
 # Returns an array of dictionaries if successful, None if fail
+@instrumented(rowsArg=None)
 def extractMDB(coll, f, proj):
     # Runs a find query with the above filter and projections
     listings = coll.find(f, proj)
 
-    meteoriteList = []
-    # iterates through query results and assigns them to a dictionary
-    # the new dictionary is appended to the data array
-    for rec in listings:
-        # Convert price (Decimal128) to float and handle missing fields
-        dateTemp = getMonthYear(rec.get("year", ""))
-        meteoriteList.append({
-            # Inserts empty string if no value present
-            "name": rec.get("name", ""),
-            # id must exist
-            "id": int(rec["id"]),
-            # Inserts 0.0 if does no value present
-            "mass": float(rec["mass"]) if "mass" in rec else 0.0,
-            "year": dateTemp[0],
-            "reclat": float(rec["reclat"]) if "reclat" in rec else 0.0,
-            "reclong": float(rec["reclong"]) if "reclong" in rec else 0.0,
-        })
+    # iterates through query results and converts each one to a typed record
+    meteoriteList = [landingRecord(rec) for rec in listings]
     if len(meteoriteList) > 0:
         # Returns array of dictionaries if records found
         print(f"Retrieved {len(meteoriteList)} documents from NobgoDB.")
@@ -144,6 +495,252 @@ def getMonthYear(dateStr) :
     else :
         return [0,0]
 
+# Fields pulled from MongoDB by the columnar extraction path
+RAW_FIELDS = ["id", "name", "mass", "year", "reclat", "reclong"]
+
+# Wraps raw field values in an Arrow array, None becomes null
+# Args: values: list, numpy array or Arrow array
+# Returns: pa.Array
+def arrowColumn(values):
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        return values
+    return pa.array(values, from_pandas=True)
+
+# Converts raw field values to a numeric array in one vectorized cast
+# Args: values: sequence of str/number/None, default: value used for missing entries,
+#       dtype: numpy dtype
+# Returns: numpy array of dtype
+def numericColumn(values, default, dtype):
+    import pyarrow.compute as pc
+    try:
+        col = pc.cast(arrowColumn(values), pa.from_numpy_dtype(dtype))
+        return pc.fill_null(col, default).to_numpy(zero_copy_only=False).astype(dtype, copy=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # mixed types or unparseable strings, bad values get the default like missing ones
+        arr = pd.to_numeric(pd.Series(np.asarray(values, dtype=object)), errors='coerce')
+        return arr.fillna(default).to_numpy(dtype)
+
+# Splits date strings into year and month arrays, vectorized
+# Args: values: sequence of date strings, e.g. "1880-01-01T00:00:00.000", or None
+# Returns: tuple (year array, month array), 0 for missing dates like getMonthYear
+def yearMonthColumns(values):
+    import pyarrow.compute as pc
+    col = pc.cast(arrowColumn(values), pa.string())
+    # empty strings are missing dates
+    col = pc.if_else(pc.equal(col, ""), pa.scalar(None, pa.string()), col)
+    # only "YYYY-MM" is needed
+    parts = pc.split_pattern(pc.utf8_slice_codeunits(col, 0, 7), '-', max_splits=1)
+    years = pc.fill_null(pc.cast(pc.list_element(parts, 0), pa.int64()), 0)
+    months = pc.fill_null(pc.cast(pc.list_element(parts, 1), pa.int64()), 0)
+    return years.to_numpy(), months.to_numpy()
+
+# Converts raw ids in one vectorized cast, id is required like in extractMDB
+# Args: values: sequence of str/number/None
+# Returns: tuple (int64 numpy array, bool numpy array True where the id is valid)
+def idColumn(values):
+    import pyarrow.compute as pc
+    try:
+        col = pc.cast(arrowColumn(values), pa.int64())
+        valid = pc.is_valid(col).to_numpy(zero_copy_only=False)
+        return pc.fill_null(col, 0).to_numpy(zero_copy_only=False), valid
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # mixed types, unparseable strings or fractions are invalid, not 0
+        arr = pd.to_numeric(pd.Series(np.asarray(values, dtype=object)), errors='coerce').to_numpy(np.float64)
+        valid = ~np.isnan(arr) & (arr == np.floor(arr))
+        return np.where(valid, arr, 0).astype(np.int64), valid
+
+# Converts raw columns to typed columns, vectorized per field
+# Same defaults as extractMDB: "" for name, 0.0 for missing floats, [0,0] for no date
+# Records without a valid id are dropped with a count, extractMDB fails on them
+# and a shared 0 would merge them into one row under the id primary key
+# Args: raw: dict of field name (RAW_FIELDS) to a sequence of raw values
+# Returns: dict of column name to numpy array
+def typedColumns(raw):
+    import pyarrow.compute as pc
+    ids, valid = idColumn(raw["id"])
+    years, months = yearMonthColumns(raw["year"])
+    names = pc.fill_null(pc.cast(arrowColumn(raw["name"]), pa.string()), "")
+    typed = {
+        "id": ids,
+        "name": names.to_numpy(zero_copy_only=False),
+        "mass": numericColumn(raw["mass"], 0.0, np.float64),
+        "year": years,
+        "month": months,
+        "reclat": numericColumn(raw["reclat"], 0.0, np.float64),
+        "reclong": numericColumn(raw["reclong"], 0.0, np.float64),
+    }
+    if not valid.all():
+        print(f"Dropped {int((~valid).sum())} records without a valid id")
+        typed = {col: arr[valid] for col, arr in typed.items()}
+    return typed
+
+# Reads a real pymongo collection as raw column batches
+# Uses pymongoarrow (optional) to decode BSON straight into Arrow columns,
+# otherwise decodes raw BSON batches and picks the fields per document
+# Args: coll: pymongo Collection, f: query filter, proj: query projections,
+#       batchSize: int documents per batch
+# Yields: dict of field name to sequence of raw values
+def rawColumnBatches(coll, f, proj, batchSize):
+    try:
+        from pymongoarrow.api import Schema, find_arrow_all
+    except ImportError:
+        for raw in coll.find_raw_batches(f, proj, batch_size=batchSize):
+            batch = bson.decode_all(raw)
+            yield {fld: [rec.get(fld) for rec in batch] for fld in RAW_FIELDS}
+        return
+    # feed values are stored as strings, conversion happens in typedColumns
+    schema = Schema({fld: pa.string() for fld in RAW_FIELDS})
+    table = find_arrow_all(coll, f, schema=schema, projection=proj, batch_size=batchSize)
+    for batch in table.to_batches(max_chunksize=batchSize):
+        yield {fld: batch.column(fld) for fld in RAW_FIELDS}
+
+# Extracts documents from MongoDB into columns instead of a list of dicts
+# Pulls the cursor batchSize documents at a time (raw BSON batches on a real
+# server) and fills preallocated arrays that grow by doubling
+# Args : coll: pymongo Collection, f: query filter, proj: query projections,
+#        batchSize: int documents per batch,
+#        asFrame: bool True returns a DataFrame, False a dict of numpy arrays
+# Returns: pd.DataFrame or dict of arrays (id, name, mass, year, month, reclat, reclong),
+#          None if no records found
+@instrumented(rowsArg=None)
+def extractMDBColumnar(coll, f, proj, batchSize=10000, asFrame=True):
+    start = time.perf_counter()
+    if isinstance(coll, pymongo.collection.Collection):
+        batches = rawColumnBatches(coll, f, proj, batchSize)
+    else:
+        # mongomock and other stand-ins only have the document cursor
+        batches = ({fld: [rec.get(fld) for rec in batch] for fld in RAW_FIELDS}
+                   for batch in chunked(coll.find(f, proj, batch_size=batchSize), batchSize))
+
+    dtypes = {"id": np.int64, "name": object, "mass": np.float64, "year": np.int64,
+              "month": np.int64, "reclat": np.float64, "reclong": np.float64}
+    capacity = batchSize
+    columns = {col: np.empty(capacity, dtype=dt) for col, dt in dtypes.items()}
+    size = 0
+    for raw in batches:
+        if len(raw["id"]) == 0:
+            continue
+        typed = typedColumns(raw)
+        # records without a valid id are dropped
+        n = len(typed["id"])
+        # doubles capacity when the next batch won't fit
+        if size + n > capacity:
+            while size + n > capacity:
+                capacity *= 2
+            for col in columns:
+                grown = np.empty(capacity, dtype=dtypes[col])
+                grown[:size] = columns[col][:size]
+                columns[col] = grown
+        for col in columns:
+            columns[col][size:size + n] = typed[col]
+        size += n
+
+    if size == 0:
+        # returns None if no records found
+        return None
+    columns = {col: arr[:size] for col, arr in columns.items()}
+    seconds = time.perf_counter() - start
+    print(f"Retrieved {size} documents from MongoDB in {seconds:.2f}s "
+          f"({size / seconds if seconds > 0 else 0:.0f} records/sec).")
+    if not asFrame:
+        return columns
+    df = pd.DataFrame(columns)
+    # compact string column for name
+    df["name"] = df["name"].astype("string")
+    return df
+
+# Converts a field inside MongoDB, missing or unparseable values get the default
+# Args: expr: aggregation expression, to: str target type, default: fallback value
+# Returns: dict $convert expression
+def convertExpr(expr, to, default):
+    return {"$convert": {"input": expr, "to": to, "onError": default, "onNull": default}}
+
+# Server-side type coercion for each field extractMDB converts in Python
+# Same defaults as extractMDB: "" for name, 0.0 for missing floats, 0 for no date
+def typedFieldExprs():
+    # "1880-01-01T00:00:00.000" split on '-', index 0 year and 1 month
+    dateParts = {"$split": [{"$ifNull": ["$year", ""]}, "-"]}
+    return {
+        "id": {"$toInt": "$id"},
+        "name": {"$ifNull": ["$name", ""]},
+        "mass": convertExpr("$mass", "double", 0.0),
+        "year": convertExpr({"$arrayElemAt": [dateParts, 0]}, "int", 0),
+        "month": convertExpr({"$arrayElemAt": [dateParts, 1]}, "int", 0),
+        "reclat": convertExpr("$reclat", "double", 0.0),
+        "reclong": convertExpr("$reclong", "double", 0.0),
+    }
+
+# Builds an aggregation pipeline from a find() filter and projection
+# Type conversion and date splitting happen in the database so only typed,
+# projected documents cross the wire
+# Args : f: query filter, proj: query projections (fields marked 1 are kept,
+#        month comes with year), into: optional str staging collection name,
+#        mode: 'merge' ($merge on id, keeps other documents) or 'out' ($out, replaces)
+# Returns: list pipeline stages
+def buildTypedPipeline(f, proj, into=None, mode="merge"):
+    exprs = typedFieldExprs()
+    project = {"_id": 0}
+    for field, keep in proj.items():
+        if keep and field in exprs:
+            project[field] = exprs[field]
+            if field == "year":
+                project["month"] = exprs["month"]
+    pipeline = [{"$match": f}, {"$project": project}]
+    if into is not None:
+        if mode == "out":
+            pipeline.append({"$out": into})
+        else:
+            pipeline.append({"$merge": {"into": into, "on": "id",
+                                        "whenMatched": "replace", "whenNotMatched": "insert"}})
+    return pipeline
+
+# Extracts documents from MongoDB with the type conversion pushed to the server
+# Alternative to extractMDB, returns the same typed records plus month
+# Args : coll: pymongo Collection, f: query filter, proj: query projections,
+#        into: optional str staging collection kept for reuse, mode: 'merge' or 'out'
+# Returns an array of dictionaries if successful, None if fail
+@instrumented(rowsArg=None)
+def extractMDBAggregate(coll, f, proj, into=None, mode="merge"):
+    pipeline = buildTypedPipeline(f, proj, into, mode)
+    if into is None:
+        meteoriteList = list(coll.aggregate(pipeline))
+    else:
+        staging = coll.database[into]
+        if mode != "out":
+            # $merge on id needs a unique index on the target
+            staging.create_index("id", unique=True)
+        coll.aggregate(pipeline)
+        meteoriteList = list(staging.find({}, {"_id": 0}))
+    if len(meteoriteList) > 0:
+        print(f"Retrieved {len(meteoriteList)} typed documents from MongoDB aggregation.")
+        return meteoriteList
+    else:
+        # returns None if no records found
+        return None
+
+# Compares the Python conversion loop with the aggregation pushdown
+# Client CPU is process time for the query and the conversion, wire volume is
+# the BSON size of the documents returned, measured after the timed region
+# Args : coll: pymongo Collection, f: query filter, proj: query projections
+# Returns: dict with cpuSeconds and wireBytes for "find" and "aggregate"
+def compareExtraction(coll, f, proj):
+    results = {}
+    # current path: find() then the extractMDB conversion in Python
+    cpu = time.process_time()
+    raw = list(coll.find(f, proj))
+    records = [landingRecord(rec) for rec in raw]
+    seconds = time.process_time() - cpu
+    results["find"] = {"cpuSeconds": seconds, "wireBytes": sum(len(bson.encode(doc)) for doc in raw)}
+    # pushdown path: documents arrive typed
+    cpu = time.process_time()
+    typed = list(coll.aggregate(buildTypedPipeline(f, proj)))
+    seconds = time.process_time() - cpu
+    results["aggregate"] = {"cpuSeconds": seconds, "wireBytes": sum(len(bson.encode(doc)) for doc in typed)}
+    for path, r in results.items():
+        print(f"{path:>9}: {r['cpuSeconds']:.3f}s client CPU, {r['wireBytes'] / 1e6:.2f} MB on the wire")
+    print(f"{len(records)} records converted in Python, {len(typed)} returned typed by the server")
+    return results
+
 
 # Opens connection to SQLite database 
 # Create table for with parameters provided
@@ -151,6 +748,7 @@ def getMonthYear(dateStr) :
 #        tableName = str Table name , 
 #        keys = str Table attribute names and options
 # Returns True if successful, None if fails
+@instrumented(rowsArg=None)
 def createSqliteDB(dbName, tableName, keys):
     # Creates a SQLiite DB at the filepath specified in dbName
     conn = sqlite3.connect(dbName)
@@ -181,111 +779,117 @@ def createSqliteDB(dbName, tableName, keys):
 # Insert the extracted data into the SQLite database
 # Args: curs = cursor to SQLite DB, tableName = String
 #       data = array of dictionary items
+@instrumented(rowsArg=2)
 def insertSqlite(cursor, tableName, data):
-    # iterates through the dictionaries(documents) in the array
-    for rec in data:
-
-        # Inserts the document into the table if it isn't
-        # already there
-        cursor.execute(f'''
-            INSERT OR IGNORE INTO {tableName}
-            (id, name, mass, year, reclat, reclong)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            int(rec['id']), rec['name'], rec['mass'],
-            rec['year'], rec['reclat'], rec['reclong']
-        ))
+    # Inserts each document into the table if it isn't already there
+    # one prepared statement for all rows, fed from a generator
+    cursor.executemany(f'''
+        INSERT OR IGNORE INTO {tableName}
+        (id, name, mass, year, reclat, reclong)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', ((
+        int(rec['id']), rec['name'], rec['mass'],
+        rec['year'], rec['reclat'], rec['reclong']
+    ) for rec in data))
 
-def testAndRun():
+# NASA meteorite landings dataset and the local copies of it
+LANDINGS_URL = "https://data.nasa.gov/resource/y77d-th95.json"
+SNAPSHOT_FILE = "projectText.ndjson.gz"
+SQLITE_DB = "MeteoriteData.sqlite"
+TABLE_NAME = "meteorite_landings"
 
-    fileInfo = scraper("https://data.nasa.gov/resource/y77d-th95.json")
-    assert not fileInfo == None, "getDataFile failed"
-    assert isinstance(fileInfo, list), "getDataFile failed"
+# Filter and projections for the MongoDB query
+# Retrieves documents where the mass field exists and fall field is not "Found"
+LANDING_FILTER = {"mass": {"$exists": True}, "fall": {"$ne": "Found"}}
+# Does not return _id field, returns all fields marked 1
+LANDING_PROJECTION = {"_id": 0, "id": 1, "name": 1, "mass": 1,
+                      "year": 1, "reclat": 1, "reclong": 1}
 
-    fileCheck = toJsonFile(fileInfo, "projectText.json")
-    assert not fileCheck == None
-    assert fileCheck
+# SQLite table definition for the extracted landings
+LANDING_KEYS = '''id INTEGER PRIMARY KEY UNIQUE NOT NULL, name TEXT NOT NULL,
+    mass REAL NOT NULL, year INTEGER NOT NULL,
+    reclat REAL NOT NULL, reclong REAL NOT NULL'''
 
-    muri = getMongoURI("pwProj.txt")
-    # test getMongoURI()
-    assert muri is not None, "Geting URI failed."
-    assert len(muri) > 0, "Getting URI failed."
+# Downloads the dataset and writes a snapshot of it, the last snapshot is
+# used when the network is unavailable
+# Args: url: str dataset url, snapshotFile: str snapshot file name,
+#       cacheDir: str HTTP cache directory, the cached copy is revalidated
+# Returns: list of json objects, None if there is neither data nor a snapshot
+def fetchLandings(url=LANDINGS_URL, snapshotFile=SNAPSHOT_FILE, cacheDir="http_cache"):
+    records = scraper(url, cache=openCache(cacheDir))
+    if records is None:
+        if not os.path.exists(snapshotFile):
+            print(f"No data from {url} and no snapshot at {snapshotFile}")
+            return None
+        records = list(readSnapshot(snapshotFile))
+        print(f"Loaded {len(records)} documents from {snapshotFile}")
+        return records
+    if writeSnapshot(records, snapshotFile) is None:
+        print(f"Error writing snapshot {snapshotFile}")
+    return records
 
+# Syncs records into MongoDB and loads the extracted landings into SQLite
+# Args: records: list of json objects, credFile: str MongoDB credentials file,
+#       sqliteDB: str SQLite DB Name, tableName: str Table name
+# Returns: int rows loaded into SQLite, None if any step fails
+def loadLandings(records, credFile="pwProj.txt", sqliteDB=SQLITE_DB, tableName=TABLE_NAME):
+    muri = getMongoURI(credFile)
+    if not muri:
+        return None
     client = connectMongoDB(muri)
-    assert not client == None
-    assert isinstance(client, pymongo.mongo_client.MongoClient)
+    if client is None:
+        return None
+    coll = client.meteorite_data.meteorite_landings
+    # upserts only new or changed documents instead of reloading the collection
+    mdbSync(records, coll)
+    meteoriteList = extractMDB(coll, LANDING_FILTER, LANDING_PROJECTION)
+    if meteoriteList is None:
+        print("No documents matched the MongoDB query.")
+        return None
+    # staged and swapped in, indexes and summary tables are built once after the load
+    return bulkLoadSqlite(sqliteDB, tableName, LANDING_KEYS, meteoriteList,
+                          indexes=landingIndexes(tableName), summaries=True, spatial=True)
 
-    db = client.meteorite_data
-    results = mdbInsert(fileInfo, db)
-    assert not results == None
-    assert isinstance(results, pymongo.results.InsertManyResult)
+def testAndRun():
+    # per-stage metrics when METEORITE_METRICS_LOG, METEORITE_METRICS_PROM or
+    # METEORITE_PROFILE_STAGE are set, see Stage_Metrics
+    metricsOn = metricsFromEnv()
 
-    # Verification that data was added to MongoDB
-    # prints documents in dataset
+    # cached copy is revalidated instead of downloading the dataset every run,
+    # falls back to the last snapshot when the network is unavailable
+    fileInfo = fetchLandings(LANDINGS_URL, SNAPSHOT_FILE)
+    assert not fileInfo == None, "getDataFile failed"
+    assert isinstance(fileInfo, list), "getDataFile failed"
     print(f"There are {len(fileInfo)} entries in the dataset")
-    # prints documents in collection
-    print(f"{db.meteorite_landings.count_documents(
-        {})} documents were added to the MongoDB collection meteorite_landings")
-    # prints first document in collection
-    print("Document example:")
-    pprint.pprint(db.meteorite_landings.find_one({}), indent=4)
-
-    # Create filter and projections for MongoDB query
-    # Retrieves documents where the mass field exists and fall field is not "Found"
-    filtr = {"mass": {"$exists": True}, "fall": {"$ne": "Found"}}
-    # Does not return _id field, returns all fields marked 1
-    proj = {"_id": 0, "id": 1, "name": 1, "mass": 1,
-            "year": 1, "reclat": 1, "reclong": 1}
-
-    # Extracts the required data for analysis from the meteorite_landings
-    # MongoDB collection
-    meteoriteList = extractMDB(db.meteorite_landings, filtr, proj)
-    # Verification that data was retrieved from MongoDB
-    print(f"Number of documents returned from MongoDB query: {
-          len(meteoriteList)}")
-    # Testing extractMeteorite function
-    assert isinstance(meteoriteList, list)
-    assert not meteoriteList == []
-    assert meteoriteList is not None
-    assert isinstance(meteoriteList[0], dict)
-    # Validating that indeividual data values are the correct type
-    for rec in meteoriteList:
-        assert isinstance(rec["id"], int)
-        assert isinstance(rec["name"], str)
-        assert isinstance(rec["mass"], float)
-        assert isinstance(rec["year"], int)
-        assert isinstance(rec["reclat"], float)
-        assert isinstance(rec["reclong"], float)
-
-    sqliteDB = "MeteoriteData.sqlite"
-    tableName = "meteorite_landings"
-    keys = '''id INTEGER PRIMARY KEY UNIQUE NOT NULL, name TEXT NOT NULL,
-    mass REAL NOT NULL, year INTEGER NOT NULL,
-    reclat REAL NOT NULL, reclong REAL NOT NULL'''
+
+    sqliteDB = SQLITE_DB
+    tableName = TABLE_NAME
 
     try:
-        # Create SQLite DB for listings retrieved
-        sqlCreateRes = createSqliteDB(sqliteDB, tableName, keys)
-        assert sqlCreateRes is not None
-        assert sqlCreateRes
-        print("SQLite DB table created successfully.")
-        # connect to the new SQLite DB
+        # upserts into MongoDB, then the extracted landings are staged and
+        # swapped in, indexes and summary tables are built once after the load
+        loaded = loadLandings(fileInfo, "pwProj.txt", sqliteDB, tableName)
+        assert loaded is not None
         conn = sqlite3.connect(sqliteDB)
-        # Create a cursor object to manipulate DB with
-        cursor = conn.cursor()
-        # Insert data into the SQLite DB
-        insertSqlite(cursor, tableName, meteoriteList)
-        print("SQLite insert complete.")
-        # Commit changes to DB and close connection
-        conn.commit()
         # Getting number of rows
-        count = cursor.execute(f"SELECT COUNT(*) FROM {tableName}")
-        val = count.fetchone()
+        val = conn.execute(f"SELECT COUNT(*) FROM {tableName}").fetchone()
+        # Validating that individual data values are the correct type
+        for rec in conn.execute(f"SELECT id, name, mass, year, reclat, reclong FROM {tableName} LIMIT 1000"):
+            assert isinstance(rec[0], int)
+            assert isinstance(rec[1], str)
+            assert isinstance(rec[2], float)
+            assert isinstance(rec[3], int)
+            assert isinstance(rec[4], float)
+            assert isinstance(rec[5], float)
         conn.close()
-        print(f"{val[0]} records added to SQLite table successfully.")        
+        print(f"{val[0]} records added to SQLite table successfully.")
     except Exception as e:
         print(f"Error: {e}")
         print("Failure with SQLite DB")
+    if metricsOn:
+        reportMetrics()
 
 
-testAndRun()
+# Runs the full pipeline when executed as a script, importing only defines the stages
+if __name__ == "__main__":
+    testAndRun()
@@ -0,0 +1,239 @@
+# Setup
+# Importing required libraries
+import os, json
+import numpy as np
+import pandas as pd
+
+# Persistent dedup index for incremental loads
+# Rows are identified by a 64-bit hash of their key columns. The hashes live in
+# an open-addressing hash table (0 marks an empty slot) stored as a memory-mapped
+# .npy file, so lookups and inserts cost O(batch) no matter how much history
+# there is. An optional Bloom filter, also memory-mapped, answers most "never
+# seen" lookups without touching the table.
+# Files for basePath "MeteoriteData.sqlite":
+#   MeteoriteData.sqlite.dedup.npy        hash table (uint64)
+#   MeteoriteData.sqlite.dedup.bloom.npy  Bloom filter bits (uint64 words)
+#   MeteoriteData.sqlite.dedup.json       keys, count and Bloom settings
+# Used by the clean command (--dedup-keys) and Cleaning_Analytics.main
+# (METEORITE_DEDUP_KEYS) through cleanLandings: dedupBatch picks the new rows,
+# commitBatch records them once the file holding them is written.
+
+# Table is grown when it would be more than half full
+MAX_LOAD = 0.5
+# Table slot is taken from the high bits, Bloom bits from the low bits
+SLOT_SHIFT = np.uint64(24)
+
+# Smallest power of two >= n
+def nextPow2(n):
+    return 1 << max(int(n) - 1, 1).bit_length()
+
+# File names used by an index
+# Args: basePath: str, usually the SQLite database path
+# Returns: dict of table, bloom and meta paths
+def indexPaths(basePath):
+    return {"table": basePath + ".dedup.npy", "bloom": basePath + ".dedup.bloom.npy",
+            "meta": basePath + ".dedup.json"}
+
+# Opens a dedup index, creating it if it doesn't exist
+# Args: basePath: str, keys: list of key columns (e.g. ["id"] or ["name", "reclat", "reclong", "year"]),
+#       capacity: int initial number of keys, bloom: bool use a Bloom filter front,
+#       bloomBitsPerKey: int Bloom filter bits per key (10 gives about 1% false positives)
+# Returns: dict index state
+def openDedupIndex(basePath, keys, capacity=1 << 20, bloom=True, bloomBitsPerKey=10):
+    paths = indexPaths(basePath)
+    if os.path.exists(paths["meta"]):
+        with open(paths["meta"], 'r') as f:
+            meta = json.load(f)
+        if meta["keys"] != list(keys):
+            raise ValueError(f"Dedup index {paths['meta']} is keyed on {meta['keys']}, not {list(keys)}")
+        index = {"paths": paths, "keys": meta["keys"], "count": meta["count"],
+                 "bloomBitsPerKey": meta["bloomBitsPerKey"], "bloomHashes": meta["bloomHashes"],
+                 "table": np.load(paths["table"], mmap_mode='r+'), "bloom": None}
+        if meta["bloom"]:
+            index["bloom"] = np.load(paths["bloom"], mmap_mode='r+')
+        return index
+    index = {"paths": paths, "keys": list(keys), "count": 0, "bloomBitsPerKey": bloomBitsPerKey,
+             # optimal number of hash functions is bits per key * ln 2
+             "bloomHashes": max(1, round(bloomBitsPerKey * 0.693)), "table": None, "bloom": None}
+    index["table"] = newTable(paths["table"], nextPow2(capacity / MAX_LOAD))
+    if bloom:
+        index["bloom"] = newTable(paths["bloom"], bloomWords(capacity, bloomBitsPerKey))
+    saveDedupIndex(index)
+    return index
+
+# Creates a zeroed, memory-mapped uint64 array on disk
+# Args: path: str .npy file, size: int number of slots
+# Returns: np.memmap
+def newTable(path, size):
+    table = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint64, shape=(size,))
+    table[:] = 0
+    return table
+
+# Number of 64-bit words for a Bloom filter, a power of two for masking
+def bloomWords(capacity, bitsPerKey):
+    return nextPow2(max(capacity * bitsPerKey, 64)) // 64
+
+# Writes the index meta data and flushes the memory maps
+# Args: index: dict from openDedupIndex
+def saveDedupIndex(index):
+    index["table"].flush()
+    if index["bloom"] is not None:
+        index["bloom"].flush()
+    meta = {"keys": index["keys"], "count": index["count"], "bloom": index["bloom"] is not None,
+            "bloomBitsPerKey": index["bloomBitsPerKey"], "bloomHashes": index["bloomHashes"]}
+    tmpPath = index["paths"]["meta"] + ".tmp"
+    with open(tmpPath, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmpPath, index["paths"]["meta"])
+
+# One key column in a dtype independent form, hash_pandas_object hashes the
+# dtype's bytes, so the same values as int16/Int64 or float32/float64 or
+# Arrow/object strings would otherwise hash differently
+#   integers -> Int64, text -> python str,
+#   floats -> their float32 value: float32 is the narrowest float Dtype_Plan
+#   loads keys as, and the float64 -> float32 cast is the same whichever way
+#   the value arrived (rounding to decimals would split values on a .5 tie)
+# Args: series: pd.Series
+# Returns: pd.Series
+def normalizeKey(series):
+    if pd.api.types.is_bool_dtype(series):
+        return series.astype("boolean")
+    if pd.api.types.is_integer_dtype(series):
+        return series.astype("Int64")
+    if pd.api.types.is_float_dtype(series):
+        values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        return pd.Series(values.astype(np.float32), index=series.index)
+    # strings and categories of strings, missing values become None
+    values = series.astype(object)
+    return values.where(series.notna(), None)
+
+# 64-bit hashes of the key columns of each row, 0 is reserved for empty slots
+# Key columns can be columns or named index levels (readLandings indexes by id)
+# Args: df: pd.DataFrame, keys: list of key columns
+# Returns: numpy uint64 array
+def keyHashes(df, keys):
+    columns = {}
+    for key in keys:
+        series = df[key] if key in df.columns else pd.Series(df.index.get_level_values(key), index=df.index)
+        columns[key] = normalizeKey(series)
+    hashes = pd.util.hash_pandas_object(pd.DataFrame(columns), index=False).to_numpy(np.uint64, copy=True)
+    hashes[hashes == 0] = 1
+    return hashes
+
+# Bloom filter bit positions for each hash (double hashing)
+# Args: index: dict from openDedupIndex, hashes: uint64 array
+# Yields: uint64 array of bit positions per hash function
+def bloomBits(index, hashes):
+    nBits = np.uint64(len(index["bloom"]) * 64)
+    h1 = hashes & np.uint64(0xFFFFFFFF)
+    h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+    for i in range(index["bloomHashes"]):
+        yield (h1 + np.uint64(i) * h2) & (nBits - np.uint64(1))
+
+# Checks the Bloom filter
+# Returns: bool array, False means the hash was definitely never added
+def bloomContains(index, hashes):
+    maybe = np.ones(len(hashes), dtype=bool)
+    for bits in bloomBits(index, hashes):
+        words = index["bloom"][bits >> np.uint64(6)]
+        maybe &= ((words >> (bits & np.uint64(63))) & np.uint64(1)).astype(bool)
+    return maybe
+
+# Adds hashes to the Bloom filter
+def bloomAdd(index, hashes):
+    for bits in bloomBits(index, hashes):
+        np.bitwise_or.at(index["bloom"], bits >> np.uint64(6), np.uint64(1) << (bits & np.uint64(63)))
+
+# Looks hashes up in the hash table, all lookups probe in lockstep
+# Args: table: uint64 array, hashes: uint64 array
+# Returns: bool array, True where the hash is stored
+def tableContains(table, hashes):
+    mask = np.uint64(len(table) - 1)
+    slots = (hashes >> SLOT_SHIFT) & mask
+    found = np.zeros(len(hashes), dtype=bool)
+    pending = np.arange(len(hashes))
+    while pending.size:
+        stored = table[slots[pending]]
+        hit = stored == hashes[pending]
+        found[pending[hit]] = True
+        # a hit or an empty slot ends the probe sequence
+        pending = pending[~(hit | (stored == 0))]
+        slots[pending] = (slots[pending] + np.uint64(1)) & mask
+    return found
+
+# Inserts hashes that are not in the table yet (and unique among themselves)
+# Colliding inserts into the same free slot are resolved by re-reading the slot,
+# the losers move on to the next slot
+# Args: table: uint64 array, hashes: uint64 array
+def tableInsert(table, hashes):
+    mask = np.uint64(len(table) - 1)
+    slots = (hashes >> SLOT_SHIFT) & mask
+    done = np.zeros(len(hashes), dtype=bool)
+    pending = np.arange(len(hashes))
+    while pending.size:
+        free = pending[table[slots[pending]] == 0]
+        table[slots[free]] = hashes[free]
+        done[free[table[slots[free]] == hashes[free]]] = True
+        pending = pending[~done[pending]]
+        slots[pending] = (slots[pending] + np.uint64(1)) & mask
+
+# Grows the table (and rebuilds the Bloom filter) so extra keys fit
+# The table at least doubles. The grown table and Bloom filter are built in
+# temp files and renamed over the old ones before the meta data is saved, so
+# a crash while growing leaves the old index intact
+# Args: index: dict from openDedupIndex, extra: int number of keys about to be added
+def reserve(index, extra):
+    needed = index["count"] + extra
+    if needed <= len(index["table"]) * MAX_LOAD:
+        return
+    size = max(2 * len(index["table"]), nextPow2(needed / MAX_LOAD))
+    stored = np.asarray(index["table"][index["table"] != 0])
+    paths = index["paths"]
+    table = newTable(paths["table"] + ".tmp.npy", size)
+    tableInsert(table, stored)
+    table.flush()
+    bloom = None
+    if index["bloom"] is not None:
+        # Bloom filter sized for the new capacity keeps the false positive rate
+        bloom = newTable(paths["bloom"] + ".tmp.npy", bloomWords(int(size * MAX_LOAD), index["bloomBitsPerKey"]))
+        index["bloom"] = bloom
+        bloomAdd(index, stored)
+        bloom.flush()
+    # the maps stay valid after the rename, they follow the file
+    os.replace(paths["table"] + ".tmp.npy", paths["table"])
+    index["table"] = table
+    if bloom is not None:
+        os.replace(paths["bloom"] + ".tmp.npy", paths["bloom"])
+    saveDedupIndex(index)
+
+# Drops rows already seen in earlier batches (and repeats inside the batch)
+# The index is not changed, pass the returned hashes to commitBatch once the
+# new rows are stored, so a failed write doesn't mark them as seen
+# Args: index: dict from openDedupIndex, df: pd.DataFrame batch with the key columns
+# Returns: tuple (pd.DataFrame of new rows, dict counts of batch, seenBefore, inBatch, new,
+#          uint64 array of the new rows' hashes)
+def dedupBatch(index, df):
+    hashes = keyHashes(df, index["keys"])
+    # first occurrence of each key inside the batch
+    first = ~pd.Series(hashes).duplicated().to_numpy()
+    seen = np.zeros(len(hashes), dtype=bool)
+    if index["bloom"] is not None:
+        # only Bloom filter hits need a table probe
+        maybe = np.flatnonzero(bloomContains(index, hashes))
+        seen[maybe] = tableContains(index["table"], hashes[maybe])
+    else:
+        seen = tableContains(index["table"], hashes)
+    new = first & ~seen
+    counts = {"batch": len(df), "seenBefore": int(seen.sum()),
+              "inBatch": int((~first & ~seen).sum()), "new": int(new.sum())}
+    return df[new], counts, hashes[new]
+
+# Records the hashes of new rows in the index and saves it
+# Args: index: dict from openDedupIndex, hashes: uint64 array from dedupBatch
+def commitBatch(index, hashes):
+    reserve(index, len(hashes))
+    tableInsert(index["table"], hashes)
+    if index["bloom"] is not None:
+        bloomAdd(index, hashes)
+    index["count"] += len(hashes)
+    saveDedupIndex(index)
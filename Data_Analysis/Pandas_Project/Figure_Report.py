@@ -0,0 +1,268 @@
+# Setup
+# Importing required libraries
+import os, sys, json, time, hashlib, inspect, tempfile
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from Raster_Plot import rasterPlot
+from Parallel_Agg import poolContext, groupAggregates, groupSize
+from Stream_Stats import streamStats, statsCorr
+from Columnar_IO import readColumnar
+from Result_Cache import openResultCache, cachedResult, fileFingerprint
+from Stage_Metrics import instrumented, stageTimer, metricsFromEnv, reportMetrics
+
+# Figures for the visualization section
+# Each figure is a draw function that takes a dict of column arrays and a dict
+# of small json-compatible parameters (correlation matrix, landings per year)
+# and draws onto a new pyplot figure. The notebook calls drawFigure and shows
+# the result; renderReport renders them headless in a process pool.
+# Batch mode: python Figure_Report.py meteorite_clean_<timestamp>.parquet [outDir]
+
+# Histograms for each numeric variable on a 2 by 2 grid
+def drawHistograms(data, params):
+    # creates a 2 by 2 display for plots
+    fig, axs = plt.subplots(2,2)
+    # creates a histogram for each numeric variable and assigns it to a subplot sector
+    for ax, col, color in zip(axs.flat, ("year", "mass", "reclat", "reclong"),
+                              ("blue", "green", "purple", "orange")):
+        values = data[col]
+        ax.hist(values, bins=12, range=(np.nanmin(values), np.nanmax(values)), color=color)
+        ax.set_title(col)
+    plt.tight_layout()
+
+# Correlation matrix as a color grid
+def drawCorrMatrix(data, params):
+    labels = params["corr"]["columns"]
+    n = len(labels)
+    # set size to keep labels from overlapping
+    plt.figure(figsize=(3, 3))
+    # create color matrix from correlation table
+    plt.pcolormesh(np.array(params["corr"]["values"], dtype=np.float64))
+    # set x and y axis labels
+    plt.xticks(range(n), labels, rotation=45)
+    plt.yticks(range(n), labels)
+    # inverts plot, values of 1 start at top left
+    plt.ylim(n,0)
+    # adds color bar
+    plt.colorbar()
+    plt.title("Meteorite Landing Correlation Matrix", loc='center')
+    plt.tight_layout()
+
+# Rasterized Mass vs Year scatter, color is landings per pixel
+def drawScatterMassYear(data, params):
+    plt.figure()
+    rasterPlot(data['mass'], data['year'], how="count", scale="log", width=400, height=300,
+               xlabel="Mass", ylabel="Year", title="Mass by Year", colorLabel="Landings")
+
+# Rasterized Latitude vs Year scatter on log10 latitude
+def drawScatterLatYear(data, params):
+    plt.figure()
+    rasterPlot(data['reclat'], data['year'], how="count", scale="log", width=400, height=300, logx=True,
+               xlabel="Latitude log10", ylabel="Year", title="Latitude by Year", colorLabel="Landings")
+
+# Geospatial map, largest mass landing per half degree pixel, histogram equalized
+def drawGeospatialMap(data, params):
+    plt.figure(figsize=(8, 4))
+    rasterPlot(data['reclong'], data['reclat'], data['mass'], how="max", scale="eqhist", width=720, height=360,
+               xRange=(-180, 180), yRange=(-90, 90), cmap='viridis', colorLabel='Mass of Meteorite',
+               title='Meteorite Landings by Location', xlabel='Longitude', ylabel='Latitude')
+
+# Linear trend of landings per year
+# Args: freqSeries: dict with index (years) and values (landings) lists
+# Returns: tuple (coefficients, covariance matrix) from np.polyfit
+def landingsTrend(freqSeries):
+    # 1 = linear regression
+    return np.polyfit(freqSeries["index"], freqSeries["values"], 1, full=False, cov=True)
+
+# Landings per year with the line of best fit
+def drawLandingsPerYear(data, params):
+    years = np.array(params["freqSeries"]["index"])
+    counts = np.array(params["freqSeries"]["values"])
+    coefficients, cov = landingsTrend(params["freqSeries"])
+    # creates 1 dimensional polynomial for plotting the line
+    fit = np.poly1d(coefficients)
+    # Sets display size
+    plt.figure(figsize=(4, 3))
+    # plots number of meteorite landings per year using accessible color pairing
+    plt.plot(years, counts, 'o',color='#05fe04')
+    # plots the line of best fit using accessible color pairing
+    plt.plot(years, fit(years), linestyle='-', color='#d71b60')
+    plt.title('Number of Landings per Year with Line of Best Fit')
+    plt.xlabel('Year')
+    plt.ylabel('Number of Meteorite Landings')
+
+# Figure name -> (draw function, data columns used, parameters used, savefig options)
+FIGURES = {
+    "histograms": (drawHistograms, ("year", "mass", "reclat", "reclong"), (), {"bbox_inches": "tight"}),
+    "corrColorMatrix": (drawCorrMatrix, (), ("corr",), {"bbox_inches": "tight"}),
+    "scatterMassYear": (drawScatterMassYear, ("mass", "year"), (), {"bbox_inches": "tight"}),
+    "scatterLatYear": (drawScatterLatYear, ("reclat", "year"), (), {"bbox_inches": "tight"}),
+    "geospatialMap": (drawGeospatialMap, ("reclong", "reclat", "mass"), (), {}),
+    "landingsPerYearLine": (drawLandingsPerYear, (), ("freqSeries",), {}),
+}
+
+# Json-compatible parameters for the figures
+# Args: corr: pd.DataFrame correlation matrix, freqSeries: pd.Series landings per year
+# Returns: dict
+def figureParams(corr, freqSeries):
+    return {"corr": {"columns": [str(c) for c in corr.columns], "values": corr.to_numpy().tolist()},
+            "freqSeries": {"index": [int(i) for i in freqSeries.index],
+                           "values": [int(v) for v in freqSeries.values]}}
+
+# Draws one figure and saves it
+# Args: name: str key of FIGURES, data: pd.DataFrame or dict of column arrays,
+#       params: dict from figureParams, outDir: optional str, saved as <outDir>/<name>.png
+# Returns: matplotlib Figure
+def drawFigure(name, data, params, outDir=None):
+    draw, columns, _, saveOptions = FIGURES[name]
+    # one stage per figure, e.g. plot:histograms
+    with stageTimer("plot:" + name, len(data[columns[0]]) if columns else None):
+        if isinstance(data, pd.DataFrame):
+            # same float arrays the workers get, nullable columns become NaN
+            data = {col: data[col].to_numpy(dtype=np.float64, na_value=np.nan) for col in columns}
+        draw(data, params)
+        fig = plt.gcf()
+        if outDir is not None:
+            fig.savefig(os.path.join(outDir, name + ".png"), **saveOptions)
+    return fig
+
+# Hash of the inputs of one figure: its draw code, its parameters and its data columns
+# Args: name: str key of FIGURES, params: dict, columnHashes: dict column -> str hash
+# Returns: str hex digest
+def figureHash(name, params, columnHashes):
+    draw, columns, paramKeys, saveOptions = FIGURES[name]
+    digest = hashlib.sha256(name.encode())
+    try:
+        digest.update(inspect.getsource(draw).encode())
+    except (OSError, TypeError):
+        digest.update(draw.__qualname__.encode())
+    digest.update(json.dumps({key: params[key] for key in paramKeys}, sort_keys=True).encode())
+    digest.update(json.dumps(saveOptions, sort_keys=True).encode())
+    for col in columns:
+        digest.update(columnHashes[col].encode())
+    return digest.hexdigest()
+
+# Renders one figure in a worker process with the Agg backend
+# Args: task: dict with name, column .npy paths, params, outDir
+# Returns: tuple (name, seconds, error message or None)
+def renderFigure(task):
+    start = time.perf_counter()
+    try:
+        plt.switch_backend("Agg")
+        # read-only memory maps, the pages are shared with the other workers
+        data = {col: np.load(path, mmap_mode='r') for col, path in task["columns"].items()}
+        draw, _, _, saveOptions = FIGURES[task["name"]]
+        draw(data, task["params"])
+        # written through a temp file so a failed render never leaves a partial png
+        fd, tmpPath = tempfile.mkstemp(dir=task["outDir"], suffix=".png")
+        os.close(fd)
+        plt.gcf().savefig(tmpPath, **saveOptions)
+        # mkstemp files are private, figures get normal permissions
+        os.chmod(tmpPath, 0o644)
+        os.replace(tmpPath, os.path.join(task["outDir"], task["name"] + ".png"))
+        return task["name"], time.perf_counter() - start, None
+    except Exception as e:
+        return task["name"], time.perf_counter() - start, str(e)
+    finally:
+        plt.close('all')
+
+# Renders the report figures headless and in parallel
+# Columns are written once as .npy files in a temporary directory, removed
+# when the workers are done, and memory mapped by the workers. A figure is
+# skipped when its input hash matches the one recorded in
+# <outDir>/.figures.json and its png still exists.
+# Args: df: pd.DataFrame of cleaned data, outDir: str output directory (created if missing),
+#       params: optional dict from figureParams (computed from df if None),
+#       figures: optional list of FIGURES names, workers: int processes, force: bool render everything
+# Returns: dict name -> "rendered", "skipped" or the error message
+@instrumented()
+def renderReport(df, outDir="project", params=None, figures=None, workers=None, force=False):
+    start = time.perf_counter()
+    os.makedirs(outDir, exist_ok=True)
+    figures = list(figures or FIGURES)
+    if params is None:
+        params = reportParams(df)
+    columns = sorted({col for name in figures for col in FIGURES[name][1]})
+    arrays = {col: np.ascontiguousarray(df[col].to_numpy(dtype=np.float64, na_value=np.nan))
+              for col in columns}
+    columnHashes = {col: hashlib.sha256(arr).hexdigest() for col, arr in arrays.items()}
+
+    manifestPath = os.path.join(outDir, ".figures.json")
+    try:
+        with open(manifestPath, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    hashes = {name: figureHash(name, params, columnHashes) for name in figures}
+    results = {}
+    pending = []
+    for name in figures:
+        if (not force and manifest.get(name) == hashes[name]
+                and os.path.exists(os.path.join(outDir, name + ".png"))):
+            results[name] = "skipped"
+        else:
+            pending.append(name)
+
+    if pending:
+        # column arrays are handed to the workers as .npy files, removed once the pool is done
+        with tempfile.TemporaryDirectory(prefix="figure_data_") as dataDir:
+            paths = {}
+            for col in {col for name in pending for col in FIGURES[name][1]}:
+                paths[col] = os.path.join(dataDir, col + ".npy")
+                np.save(paths[col], arrays[col])
+            tasks = [{"name": name, "columns": {col: paths[col] for col in FIGURES[name][1]},
+                      "params": params, "outDir": outDir} for name in pending]
+            workers = min(workers or os.cpu_count() or 1, len(tasks))
+            with ProcessPoolExecutor(max_workers=workers, mp_context=poolContext()) as pool:
+                for name, seconds, error in pool.map(renderFigure, tasks):
+                    if error is None:
+                        results[name] = "rendered"
+                        manifest[name] = hashes[name]
+                        print(f"Rendered {name} in {seconds:.2f}s")
+                    else:
+                        results[name] = error
+                        manifest.pop(name, None)
+                        print(f"Error rendering {name}: {error}")
+        # the manifest is only written after the pngs it vouches for
+        fd, tmpPath = tempfile.mkstemp(dir=outDir, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmpPath, manifestPath)
+
+    skipped = sum(1 for status in results.values() if status == "skipped")
+    print(f"Report: {len(figures)} figures, {skipped} unchanged, written to {outDir} "
+          f"in {time.perf_counter() - start:.2f}s")
+    return results
+
+# Figure parameters computed from the cleaned data
+# Args: df: pd.DataFrame of cleaned data
+# Returns: dict from figureParams
+def reportParams(df):
+    corr = statsCorr(streamStats([df]))
+    freqSeries = groupSize(groupAggregates(df, keys=("year",), value="mass"), "year", 1616, 2016)
+    return figureParams(corr, freqSeries)
+
+# Batch report from a cleaned Parquet/Feather file, no IPython needed
+# Args: fileName: str cleaned .parquet/.feather file, outDir: str output directory,
+#       workers: int processes, force: bool render everything,
+#       cacheDir: str analytics result cache directory
+# Returns: bool True if every figure was rendered or unchanged
+def reportFromFile(fileName, outDir="project", workers=None, force=False, cacheDir="result_cache"):
+    plt.switch_backend("Agg")
+    df = readColumnar(fileName)
+    # correlation matrix and landings per year are reused while the file is unchanged
+    params = cachedResult(openResultCache(cacheDir), fileFingerprint(fileName), "reportParams", {},
+                          lambda: reportParams(df))
+    results = renderReport(df, outDir, params, workers=workers, force=force)
+    return all(status in ("rendered", "skipped") for status in results.values())
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python Figure_Report.py <cleaned .parquet/.feather> [outDir]")
+        sys.exit(1)
+    metricsOn = metricsFromEnv()
+    ok = reportFromFile(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else "project")
+    if metricsOn:
+        reportMetrics()
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,156 @@
+# Setup
+# Importing required libraries
+import json, os, hashlib, gzip, tempfile
+from urllib.parse import urlencode
+from Lazy_Import import lazyImport
+requests = lazyImport("requests")
+
+# Persistent on-disk cache for HTTP GET responses
+# Each entry is two files named by the sha256 of url + query:
+#   <key>.body.gz  the response body, gzip compressed
+#   <key>.meta     json with url, ETag, Last-Modified and body size
+# File modification times are used as LRU access times for eviction
+
+# (connect, read) timeouts in seconds for every GET, a stalled socket raises a
+# read timeout that urllib3 retries like a connection error instead of
+# blocking the caller forever
+HTTP_TIMEOUT = (10, 60)
+
+# Creates the cache settings used by cachedGet
+# Args: cacheDir: str directory for cache files (created if missing),
+#       maxBytes: int size cap for all compressed bodies,
+#       offline: bool True never touches the network, only cached data is returned
+# Returns: dict cache settings
+def openCache(cacheDir="http_cache", maxBytes=256 * 1024 * 1024, offline=False):
+    os.makedirs(cacheDir, exist_ok=True)
+    return {"dir": cacheDir, "maxBytes": maxBytes, "offline": offline}
+
+# Builds the cache key for a request
+# Args: url: str, params: dict query parameters or None
+# Returns: str hex digest, query parameters are sorted so order doesn't matter
+def cacheKey(url, params=None):
+    query = urlencode(sorted((params or {}).items()))
+    return hashlib.sha256(f"{url}?{query}".encode()).hexdigest()
+
+# Writes bytes to path through a temp file so readers never see partial files
+# Args: path: str destination, data: bytes
+def atomicWrite(path, data):
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmpPath, path)
+    except Exception:
+        os.remove(tmpPath)
+        raise
+
+# Reads the validators for a cached entry
+# Args: cache: dict from openCache, key: str from cacheKey
+# Returns: dict meta data, None if not cached
+def readMeta(cache, key):
+    metaPath = os.path.join(cache["dir"], key + ".meta")
+    bodyPath = os.path.join(cache["dir"], key + ".body.gz")
+    if not (os.path.exists(metaPath) and os.path.exists(bodyPath)):
+        return None
+    try:
+        with open(metaPath, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # unreadable entry is treated as a miss
+        return None
+
+# Reads a cached body and marks the entry as recently used
+# Args: cache: dict from openCache, key: str from cacheKey
+# Returns: bytes decompressed body, None if not cached
+def readBody(cache, key):
+    bodyPath = os.path.join(cache["dir"], key + ".body.gz")
+    try:
+        with gzip.open(bodyPath, 'rb') as f:
+            body = f.read()
+        # touch for LRU ordering
+        os.utime(bodyPath)
+        return body
+    except OSError:
+        return None
+
+# Stores a response body and its validators, then enforces the size cap
+# Args: cache: dict from openCache, key: str from cacheKey, url: str,
+#       body: bytes, headers: response headers (ETag and Last-Modified are kept)
+def writeEntry(cache, key, url, body, headers):
+    compressed = gzip.compress(body, compresslevel=6)
+    meta = {"url": url, "etag": headers.get("ETag"),
+            "lastModified": headers.get("Last-Modified"), "size": len(compressed)}
+    # body first, meta second, so a meta file always has its body
+    atomicWrite(os.path.join(cache["dir"], key + ".body.gz"), compressed)
+    atomicWrite(os.path.join(cache["dir"], key + ".meta"), json.dumps(meta).encode())
+    evictCache(cache)
+
+# Removes least recently used entries until the cache fits in maxBytes
+# Args: cache: dict from openCache
+# Returns: int number of entries removed
+def evictCache(cache):
+    entries = []
+    total = 0
+    for name in os.listdir(cache["dir"]):
+        if name.endswith(".body.gz"):
+            try:
+                st = os.stat(os.path.join(cache["dir"], name))
+            except OSError:
+                # removed by another thread
+                continue
+            entries.append((st.st_mtime, st.st_size, name[:-len(".body.gz")]))
+            total += st.st_size
+    removed = 0
+    # oldest access first
+    for _, size, key in sorted(entries):
+        if total <= cache["maxBytes"]:
+            break
+        for suffix in (".meta", ".body.gz"):
+            try:
+                os.remove(os.path.join(cache["dir"], key + suffix))
+            except OSError:
+                pass
+        total -= size
+        removed += 1
+    return removed
+
+# GET request backed by the on-disk cache
+# Sends If-None-Match / If-Modified-Since when the entry has validators and
+# serves a 304 straight from disk, offline mode never uses the network
+# Args: session: requests.Session (or the requests module), url: str,
+#       params: dict query parameters or None, cache: dict from openCache,
+#       timeout: (connect, read) seconds
+# Returns: tuple (bytes body, int status code, bool served from cache),
+#          None if fails or offline with no cached entry
+def cachedGet(session, url, params, cache, timeout=HTTP_TIMEOUT):
+    key = cacheKey(url, params)
+    meta = readMeta(cache, key)
+    if cache["offline"]:
+        if meta is None:
+            print(f"Offline and no cached copy of {url} {params or ''}")
+            return None
+        body = readBody(cache, key)
+        return (body, 200, True) if body is not None else None
+
+    # conditional request headers from the stored validators
+    headers = {}
+    if meta is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("lastModified"):
+            headers["If-Modified-Since"] = meta["lastModified"]
+    try:
+        response = session.get(url, params=params, headers=headers, timeout=timeout)
+        if response.status_code == 304 and meta is not None:
+            # not modified, body comes from disk
+            body = readBody(cache, key)
+            if body is not None:
+                return body, 200, True
+            # entry vanished between readMeta and readBody, fetch unconditionally
+            response = session.get(url, params=params, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        print(f"Data retrieval error: {e}")
+        return None
+    if response.status_code == 200:
+        writeEntry(cache, key, url, response.content, response.headers)
+    return response.content, response.status_code, False
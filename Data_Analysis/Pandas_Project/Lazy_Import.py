@@ -0,0 +1,30 @@
+# Setup
+# Importing required libraries
+import sys, importlib.util
+
+# Deferred imports for heavy libraries
+# pandas, pymongo, requests and friends take most of the startup time of the
+# pipeline scripts. lazyImport returns the module object right away and runs
+# the real import on first attribute access, so a module can keep its
+# `pd = lazyImport("pandas")` at the top and only pay for pandas when a
+# function actually uses it.
+# Only top-level packages are deferred: finding a submodule such as
+# matplotlib.pyplot imports its parent package, so those are imported inside
+# the functions that need them instead.
+
+# Module that is imported on first use
+# Args: name: str top-level module name, e.g. "pandas"
+# Returns: module (already imported modules are returned as they are)
+def lazyImport(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        # same error a plain import would raise, at import time rather than first use
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,205 @@
+# Setup
+# Importing required libraries
+import os, sqlite3, time
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from Stage_Metrics import instrumented
+
+# Partitioned group-by aggregation on a process pool
+# Every group key is aggregated in one pass per partition. Each partition
+# returns partial sum / non-null count / row count per key value, and the
+# partials are merged by key. Group means and sizes are read off the merged
+# partials, and they match the groupby("key")["mass"].mean() and
+# groupby("key").size() results.
+# Partitions are row ranges of a frame copied once into shared memory (workers
+# attach by name, nothing is pickled but the partials), or id ranges of a
+# SQLite table that each worker reads itself.
+
+# Group keys used by the analytics reports
+GROUP_KEYS = ("year", "reclat", "reclong")
+
+# Frames smaller than this are aggregated in-process, a pool isn't worth starting
+MIN_PARALLEL_ROWS = 200000
+
+# Process start method for the worker pools
+# fork is not safe here: pandas and pyarrow have already started threads in
+# the parent. forkserver forks workers from a clean single-threaded server,
+# spawn is used where it isn't available (Windows, macOS default). Both
+# re-import the calling script, which only runs its stages under __main__,
+# and the workers are module-level functions
+def poolContext():
+    methods = mp.get_all_start_methods()
+    return mp.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+# Partial aggregates for one partition
+# Args: keyValues: dict key column -> float64 array (NaN = missing), values: float64 array
+# Returns: dict key column -> (unique keys, value sums, non-null value counts, row counts)
+def partialAggregates(keyValues, values):
+    partials = {}
+    hasValue = ~np.isnan(values)
+    for key, keys in keyValues.items():
+        # missing keys are dropped, as groupby does by default
+        valid = ~np.isnan(keys)
+        # hash factorize, keys are only sorted once the small partials are merged
+        inverse, uniq = pd.factorize(keys[valid])
+        rows = np.bincount(inverse, minlength=len(uniq))
+        counted = hasValue[valid]
+        sums = np.bincount(inverse[counted], weights=values[valid][counted], minlength=len(uniq))
+        counts = np.bincount(inverse[counted], minlength=len(uniq))
+        partials[key] = (uniq, sums, counts, rows)
+    return partials
+
+# Merges partial aggregates from all partitions
+# Args: partials: list of dicts from partialAggregates
+# Returns: dict key column -> (unique keys, sums, counts, rows)
+def mergePartials(partials):
+    merged = {}
+    for key in partials[0]:
+        parts = [p[key] for p in partials]
+        uniq, inverse = np.unique(np.concatenate([p[0] for p in parts]), return_inverse=True)
+        merged[key] = (uniq,) + tuple(
+            np.bincount(inverse, weights=np.concatenate([p[i] for p in parts]), minlength=len(uniq))
+            for i in (1, 2, 3))
+    return merged
+
+# Worker for a shared memory partition
+# Args: task: dict with shared memory name, shape, key column names, row range
+# Returns: dict from partialAggregates
+def sharedPartition(task):
+    shm = shared_memory.SharedMemory(name=task["shm"])
+    try:
+        data = np.ndarray(task["shape"], dtype=np.float64, buffer=shm.buf)
+        rows = data[:, task["start"]:task["end"]]
+        partials = partialAggregates(dict(zip(task["keys"], rows[:-1])), rows[-1])
+        # views into the block must be gone before it is closed
+        del data, rows
+        return partials
+    finally:
+        shm.close()
+
+# Worker for a SQLite id range partition, opens its own read-only connection
+# Args: task: dict with dbName, tableName, key column names, value column, id range
+# Returns: dict from partialAggregates
+def sqlitePartition(task):
+    conn = sqlite3.connect(f"file:{task['dbName']}?mode=ro", uri=True)
+    try:
+        cols = list(task["keys"]) + [task["value"]]
+        rows = conn.execute(f"SELECT {', '.join(cols)} FROM {task['tableName']} WHERE id >= ? AND id < ?",
+                            (task["start"], task["end"])).fetchall()
+    finally:
+        conn.close()
+    # None becomes NaN
+    data = np.array(rows, dtype=np.float64).reshape(-1, len(cols)).T
+    return partialAggregates(dict(zip(task["keys"], data[:-1])), data[-1])
+
+# Splits [start, end) into at most parts contiguous ranges
+def splitRange(start, end, parts):
+    bounds = np.linspace(start, end, max(parts, 1) + 1).astype(np.int64)
+    return [(int(lo), int(hi)) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+# Runs partition tasks on a process pool, or inline for a single partition
+# Args: worker: function, tasks: list of task dicts, workers: int pool size
+# Returns: dict from mergePartials
+def runPartitions(worker, tasks, workers):
+    if len(tasks) == 1:
+        return mergePartials([worker(tasks[0])])
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=poolContext()) as pool:
+        return mergePartials(list(pool.map(worker, tasks)))
+
+# Aggregates a value column by several group keys in one parallel pass over a DataFrame
+# Args: df: pd.DataFrame, keys: group key columns, value: str column to aggregate,
+#       workers: int processes (all cores by default), partitions: int row ranges
+#       (one per worker by default), minRows: int below this the frame is aggregated in-process
+# Returns: dict key column -> pd.DataFrame indexed by key value with sum, count and size columns
+@instrumented()
+def groupAggregates(df, keys=GROUP_KEYS, value="mass", workers=None, partitions=None,
+                    minRows=MIN_PARALLEL_ROWS):
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    columns = list(keys) + [value]
+    n = len(df)
+    if n < minRows or workers == 1:
+        data = np.vstack([df[col].to_numpy(dtype=np.float64, na_value=np.nan) for col in columns])
+        merged = mergePartials([partialAggregates(dict(zip(keys, data[:-1])), data[-1])])
+    else:
+        # columns are copied once into a shared block, workers get its name and a row range
+        shm = shared_memory.SharedMemory(create=True, size=max(len(columns) * n * 8, 1))
+        try:
+            data = np.ndarray((len(columns), n), dtype=np.float64, buffer=shm.buf)
+            for i, col in enumerate(columns):
+                data[i] = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+            del data
+            tasks = [{"shm": shm.name, "shape": (len(columns), n), "keys": list(keys),
+                      "start": lo, "end": hi} for lo, hi in splitRange(0, n, partitions or workers)]
+            merged = runPartitions(sharedPartition, tasks, workers)
+        finally:
+            shm.close()
+            shm.unlink()
+    print(f"Aggregated {n} rows by {', '.join(keys)} in {time.perf_counter() - start:.2f}s")
+    return aggregateFrames(merged, {key: df[key].dtype for key in keys})
+
+# Same as groupAggregates, but each worker reads an id range of a SQLite table
+# directly, so the table is never loaded in the parent process
+# Args: dbName: str SQLite DB Name, tableName: str Table name, keys, value, workers,
+#       partitions: see groupAggregates
+# Returns: dict key column -> pd.DataFrame indexed by key value with sum, count and size columns
+@instrumented(rowsArg=None)
+def groupAggregatesSqlite(dbName, tableName, keys=GROUP_KEYS, value="mass", workers=None,
+                          partitions=None):
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    conn = sqlite3.connect(dbName)
+    try:
+        lo, hi = conn.execute(f"SELECT MIN(id), MAX(id) FROM {tableName}").fetchone()
+        # key dtypes from the declared column types, INTEGER keys stay integers
+        declared = {row[1]: row[2].upper() for row in conn.execute(f"PRAGMA table_info({tableName})")}
+    finally:
+        conn.close()
+    if lo is None:
+        ranges = [(0, 0)]
+    else:
+        ranges = splitRange(lo, hi + 1, partitions or workers)
+    tasks = [{"dbName": dbName, "tableName": tableName, "keys": list(keys), "value": value,
+              "start": a, "end": b} for a, b in ranges]
+    merged = runPartitions(sqlitePartition, tasks, workers)
+    print(f"Aggregated {tableName} by {', '.join(keys)} in {time.perf_counter() - start:.2f}s")
+    dtypes = {key: "Int64" if "INT" in declared.get(key, "") else np.float64 for key in keys}
+    return aggregateFrames(merged, dtypes)
+
+# Wraps merged partials in DataFrames
+# Args: merged: dict from mergePartials, dtypes: dict key column -> dtype for the index
+# Returns: dict key column -> pd.DataFrame
+def aggregateFrames(merged, dtypes):
+    frames = {}
+    for key, (uniq, sums, counts, rows) in merged.items():
+        dtype = dtypes[key]
+        if pd.api.types.is_integer_dtype(dtype):
+            uniq = uniq.astype(np.int64)
+        index = pd.Index(uniq, name=key).astype(dtype)
+        frames[key] = pd.DataFrame({"sum": sums, "count": counts.astype(np.int64),
+                                    "size": rows.astype(np.int64)}, index=index)
+    return frames
+
+# Mean of the value column per group, like df.groupby(key)["mass"].mean()
+# Args: aggregates: dict from groupAggregates, key: str group key, value: str name for the Series
+# Returns: pd.Series
+def groupMean(aggregates, key, value="mass"):
+    frame = aggregates[key]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(frame["count"] > 0, frame["sum"] / frame["count"], np.nan)
+    return pd.Series(means, index=frame.index, name=value)
+
+# Rows per group, like df.groupby(key).size(), optionally limited to a key range
+# Args: aggregates: dict from groupAggregates, key: str group key,
+#       start, end: optional inclusive key range
+# Returns: pd.Series
+def groupSize(aggregates, key, start=None, end=None):
+    size = aggregates[key]["size"]
+    if start is not None:
+        size = size[size.index >= start]
+    if end is not None:
+        size = size[size.index <= end]
+    return size.rename(None)
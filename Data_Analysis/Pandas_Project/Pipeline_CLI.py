@@ -0,0 +1,186 @@
+# Setup
+# Importing required libraries
+import os, sys, glob, argparse
+from Stage_Metrics import METRICS, enableMetrics, metricsFromEnv, jsonLogSink, prometheusSink, reportMetrics
+
+# Command line entry point for the meteorite pipeline
+#   python Pipeline_CLI.py fetch      download the dataset, write a snapshot
+#   python Pipeline_CLI.py load       snapshot -> MongoDB -> SQLite
+#   python Pipeline_CLI.py pipeline   fetch, snapshot, MongoDB and SQLite overlapped in one run
+#   python Pipeline_CLI.py clean      SQLite -> cleaned Parquet file
+#   python Pipeline_CLI.py analyze    statistics, group-bys and tiles of a cleaned file
+#   python Pipeline_CLI.py report     headless figures of a cleaned file
+# Each command imports only the stage modules it runs, so --help and argument
+# errors never pay for pandas, pymongo or matplotlib.
+
+# Newest cleaned file written by the clean command
+# Args: directory: str where cleaned files are written
+# Returns: str file name, None if there is none
+def latestCleanFile(directory="."):
+    # timestamped names sort in time order
+    files = sorted(glob.glob(os.path.join(directory, "meteorite_clean_*.parquet")))
+    return files[-1] if files else None
+
+# Cleaned file named on the command line, the newest one by default
+# Args: fileName: optional str, directory: str where clean wrote its files (its --out-dir)
+# Returns: str file name, None if there is none
+def cleanFileArg(fileName, directory="."):
+    fileName = fileName or latestCleanFile(directory)
+    if fileName is None or not os.path.exists(fileName):
+        print(f"No cleaned file found{f' at {fileName}' if fileName else ''}, run the clean command first")
+        return None
+    return fileName
+
+# fetch: downloads the dataset and writes a snapshot
+def runFetch(args):
+    from Data_Mining import fetchLandings
+    records = fetchLandings(args.url, args.snapshot, args.cache_dir)
+    return 0 if records else 1
+
+# load: syncs the snapshot into MongoDB and loads the extracted landings into SQLite
+def runLoad(args):
+    from Data_Mining import readSnapshot, loadLandings
+    if not os.path.exists(args.snapshot):
+        print(f"Snapshot {args.snapshot} not found, run the fetch command first")
+        return 1
+    records = list(readSnapshot(args.snapshot))
+    loaded = loadLandings(records, args.cred_file, args.db, args.table)
+    if loaded is None:
+        return 1
+    print(f"{loaded} records added to SQLite table {args.table} successfully.")
+    return 0
+
+# pipeline: downloads into the snapshot, MongoDB and SQLite with the stages overlapped
+def runPipelineCmd(args):
+    from Async_Pipeline import runPipeline
+    result = runPipeline(args.url, args.snapshot, args.cred_file, args.db, args.table,
+                         args.page_size, args.in_flight, args.queue_size, args.cache_dir,
+                         mongo=not args.skip_mongo)
+    if result is None:
+        return 1
+    print(f"{result['loaded']} records added to SQLite table {args.table} successfully.")
+    return 0
+
+# clean: reads the SQLite table, cleans it and writes a timestamped Parquet file
+def runClean(args):
+    from Cleaning_Analytics import extractLandings, cleanLandings
+    from Result_Cache import openResultCache
+    extracted = extractLandings(args.db, args.table)
+    if extracted is None:
+        return 1
+    df, rawFingerprint = extracted
+    dedupIndex = None
+    if args.dedup_keys:
+        # index stored next to the database, each run keeps only landings not cleaned before
+        from Dedup_Index import openDedupIndex
+        try:
+            dedupIndex = openDedupIndex(args.db, args.dedup_keys.split(","))
+        except ValueError as e:
+            print(e)
+            return 1
+    cleaned = cleanLandings(df, rawFingerprint, openResultCache(args.cache_dir), args.out_dir, dedupIndex)
+    if cleaned is None:
+        return 1
+    if cleaned[1] is not None:
+        print(f"Cleaned data written to {cleaned[1]}")
+    return 0
+
+# analyze: statistics, group-bys and grid tiles of a cleaned file
+def runAnalyze(args):
+    fileName = cleanFileArg(args.file, args.clean_dir)
+    if fileName is None:
+        return 1
+    from Cleaning_Analytics import analyzeLandings
+    from Columnar_IO import readColumnar
+    from Result_Cache import openResultCache, reportResultCache, fileFingerprint
+    resultCache = openResultCache(args.cache_dir)
+    analyzeLandings(readColumnar(fileName), fileFingerprint(fileName), resultCache, args.stats_file)
+    reportResultCache(resultCache)
+    return 0
+
+# report: renders the figures of a cleaned file headless and in parallel
+def runReport(args):
+    fileName = cleanFileArg(args.file, args.clean_dir)
+    if fileName is None:
+        return 1
+    from Figure_Report import reportFromFile
+    return 0 if reportFromFile(fileName, args.out_dir, args.workers, args.force, args.cache_dir) else 1
+
+# Builds the argument parser
+# Returns: argparse.ArgumentParser
+def buildParser():
+    parser = argparse.ArgumentParser(description="Meteorite landings pipeline")
+    parser.add_argument("--metrics-log", help="append per-stage metrics to this JSON lines file")
+    parser.add_argument("--metrics-prom", help="write per-stage totals to this Prometheus text file")
+    parser.add_argument("--profile-stage", help="run this stage under cProfile, stats go to <stage>.prof")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    fetch = commands.add_parser("fetch", help="download the dataset and write a snapshot")
+    fetch.add_argument("--url", default="https://data.nasa.gov/resource/y77d-th95.json")
+    fetch.add_argument("--snapshot", default="projectText.ndjson.gz")
+    fetch.add_argument("--cache-dir", default="http_cache", help="HTTP cache directory")
+    fetch.set_defaults(run=runFetch)
+
+    load = commands.add_parser("load", help="sync the snapshot into MongoDB and SQLite")
+    load.add_argument("--snapshot", default="projectText.ndjson.gz")
+    load.add_argument("--cred-file", default="pwProj.txt", help="MongoDB credentials file")
+    load.add_argument("--db", default="MeteoriteData.sqlite")
+    load.add_argument("--table", default="meteorite_landings")
+    load.set_defaults(run=runLoad)
+
+    pipeline = commands.add_parser("pipeline", help="fetch, snapshot, MongoDB and SQLite in one overlapped run")
+    pipeline.add_argument("--url", default="https://data.nasa.gov/resource/y77d-th95.json")
+    pipeline.add_argument("--snapshot", default="projectText.ndjson.gz")
+    pipeline.add_argument("--cred-file", default="pwProj.txt", help="MongoDB credentials file")
+    pipeline.add_argument("--db", default="MeteoriteData.sqlite")
+    pipeline.add_argument("--table", default="meteorite_landings")
+    pipeline.add_argument("--cache-dir", default="http_cache", help="HTTP cache directory")
+    pipeline.add_argument("--page-size", type=int, default=1000, help="records per page")
+    pipeline.add_argument("--in-flight", type=int, default=8, help="pages requested ahead")
+    pipeline.add_argument("--queue-size", type=int, default=4, help="pages buffered between stages")
+    pipeline.add_argument("--skip-mongo", action="store_true", help="leave MongoDB out of the run")
+    pipeline.set_defaults(run=runPipelineCmd)
+
+    clean = commands.add_parser("clean", help="clean the SQLite table into a Parquet file")
+    clean.add_argument("--db", default="MeteoriteData.sqlite")
+    clean.add_argument("--table", default="meteorite_landings")
+    clean.add_argument("--out-dir", default=".")
+    clean.add_argument("--cache-dir", default="result_cache", help="analytics result cache directory")
+    clean.add_argument("--dedup-keys", help="comma separated key columns, e.g. id or name,reclat,reclong,year; "
+                                            "keeps only landings not cleaned in an earlier run")
+    clean.set_defaults(run=runClean)
+
+    analyze = commands.add_parser("analyze", help="statistics, group-bys and tiles of a cleaned file")
+    analyze.add_argument("file", nargs="?", help="cleaned Parquet file, the newest one by default")
+    analyze.add_argument("--clean-dir", default=".", help="where to look for the newest cleaned file, "
+                                                          "the --out-dir given to clean")
+    analyze.add_argument("--stats-file", help="save the statistics accumulator to this file")
+    analyze.add_argument("--cache-dir", default="result_cache", help="analytics result cache directory")
+    analyze.set_defaults(run=runAnalyze)
+
+    report = commands.add_parser("report", help="render the figures of a cleaned file")
+    report.add_argument("file", nargs="?", help="cleaned Parquet file, the newest one by default")
+    report.add_argument("--clean-dir", default=".", help="where to look for the newest cleaned file, "
+                                                         "the --out-dir given to clean")
+    report.add_argument("--out-dir", default="project")
+    report.add_argument("--cache-dir", default="result_cache", help="analytics result cache directory")
+    report.add_argument("--workers", type=int, help="render processes, all cores by default")
+    report.add_argument("--force", action="store_true", help="render unchanged figures too")
+    report.set_defaults(run=runReport)
+    return parser
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+    if args.metrics_log or args.metrics_prom or args.profile_stage:
+        sinks = [jsonLogSink(args.metrics_log)] if args.metrics_log else []
+        sinks += [prometheusSink(args.metrics_prom)] if args.metrics_prom else []
+        enableMetrics(sinks, profileStage=args.profile_stage)
+    else:
+        metricsFromEnv()
+    status = args.run(args)
+    if METRICS["enabled"]:
+        reportMetrics()
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+# Setup
+# Importing required libraries
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm, Normalize
+
+# Rasterized plots for large point sets
+# Points are binned into a fixed width x height canvas with bincount and the
+# canvas is drawn with imshow, so matplotlib only ever sees width * height
+# pixels. Binning is one vectorized pass over the points and everything after
+# it is sized by the canvas, not by the number of landings.
+
+# Bins points onto a canvas
+# Args: x, y: array-likes of coordinates, values: optional array-like weights,
+#       how: "count", "sum", "mean" or "max" of values per pixel,
+#       width, height: int canvas size in pixels,
+#       xRange, yRange: optional (min, max), data limits by default,
+#       logx: bool bin log10(x), points with x <= 0 are dropped
+# Returns: tuple (canvas 2D float array height x width with NaN for empty pixels,
+#          extent (xMin, xMax, yMin, yMax) for imshow)
+def rasterize(x, y, values=None, how="count", width=800, height=400, xRange=None, yRange=None,
+              logx=False):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    keep = ~(np.isnan(x) | np.isnan(y))
+    if values is not None:
+        values = np.asarray(values, dtype=np.float64)
+        keep &= ~np.isnan(values)
+    if logx:
+        keep &= x > 0
+        x = np.log10(np.where(keep, x, 1.0))
+    x, y = x[keep], y[keep]
+    if values is not None:
+        values = values[keep]
+    if len(x) == 0:
+        return np.full((height, width), np.nan), (0.0, 1.0, 0.0, 1.0)
+    xMin, xMax = xRange if xRange is not None else (x.min(), x.max())
+    yMin, yMax = yRange if yRange is not None else (y.min(), y.max())
+    if logx and xRange is not None:
+        xMin, xMax = np.log10(xMin), np.log10(xMax)
+    # zero-width ranges still get one pixel's worth of extent
+    xSpan = (xMax - xMin) or 1.0
+    ySpan = (yMax - yMin) or 1.0
+
+    # pixel of each point, points outside the ranges are dropped
+    inside = (x >= xMin) & (x <= xMax) & (y >= yMin) & (y <= yMax)
+    cols = np.minimum(((x[inside] - xMin) / xSpan * width).astype(np.int64), width - 1)
+    rows = np.minimum(((y[inside] - yMin) / ySpan * height).astype(np.int64), height - 1)
+    pixels = rows * width + cols
+    size = width * height
+    counts = np.bincount(pixels, minlength=size).astype(np.float64)
+    if how == "count":
+        canvas = counts
+    elif how == "max":
+        canvas = np.full(size, -np.inf)
+        np.maximum.at(canvas, pixels, values[inside])
+    else:
+        canvas = np.bincount(pixels, weights=values[inside], minlength=size)
+        if how == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                canvas = canvas / counts
+    canvas[counts == 0] = np.nan
+    return canvas.reshape(height, width), (xMin, xMin + xSpan, yMin, yMin + ySpan)
+
+# Histogram equalization of a canvas, each pixel becomes the fraction of
+# non-empty pixels at or below its value
+# Args: canvas: 2D float array with NaN for empty pixels
+# Returns: tuple (2D array in [0, 1] with NaN kept, sorted pixel values, their cdf)
+def eqHist(canvas):
+    filled = canvas[~np.isnan(canvas)]
+    levels, counts = np.unique(filled, return_counts=True)
+    cdf = np.cumsum(counts) / len(filled)
+    image = np.full(canvas.shape, np.nan)
+    mask = ~np.isnan(canvas)
+    image[mask] = np.interp(canvas[mask], levels, cdf)
+    return image, levels, cdf
+
+# Draws a canvas with imshow and a color bar
+# Args: canvas, extent: from rasterize, scale: "log", "eqhist" or "linear",
+#       cmap: str color map, colorLabel: str color bar label, ax: optional Axes
+# Returns: matplotlib Axes
+def showRaster(canvas, extent, scale="log", cmap="viridis", colorLabel=None, ax=None):
+    if ax is None:
+        ax = plt.gca()
+    # empty pixels are left transparent
+    image = np.ma.masked_invalid(canvas)
+    ticks = None
+    if scale == "eqhist" and image.count():
+        image, levels, cdf = eqHist(canvas)
+        image = np.ma.masked_invalid(image)
+        norm = Normalize(0, 1)
+        # color bar labelled with the data values at evenly spaced quantiles
+        ticks = np.linspace(0, 1, 5)
+        tickLabels = [f"{v:.3g}" for v in np.interp(ticks, cdf, levels)]
+    elif scale == "log" and (image > 0).any():
+        positive = image[image > 0]
+        image = np.ma.masked_less_equal(image, 0)
+        norm = LogNorm(vmin=positive.min(), vmax=positive.max())
+    else:
+        norm = Normalize()
+    drawn = ax.imshow(image, extent=extent, origin="lower", aspect="auto", cmap=cmap,
+                      norm=norm, interpolation="nearest")
+    colorBar = plt.colorbar(drawn, ax=ax, label=colorLabel)
+    if ticks is not None:
+        colorBar.set_ticks(ticks)
+        colorBar.set_ticklabels(tickLabels)
+    return ax
+
+# Rasterized replacement for a scatter plot
+# Args: x, y, values, how, width, height, xRange, yRange, logx: see rasterize,
+#       scale, cmap, colorLabel: see showRaster, title, xlabel, ylabel: str labels,
+#       fileName: optional str, the figure is saved there
+# Returns: matplotlib Axes
+def rasterPlot(x, y, values=None, how="count", width=800, height=400, xRange=None, yRange=None,
+               logx=False, scale="log", cmap="viridis", colorLabel=None, title=None, xlabel=None,
+               ylabel=None, fileName=None, ax=None):
+    canvas, extent = rasterize(x, y, values, how, width, height, xRange, yRange, logx)
+    ax = showRaster(canvas, extent, scale, cmap, colorLabel or how.capitalize(), ax)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    if fileName is not None:
+        ax.figure.savefig(fileName, bbox_inches='tight')
+    return ax
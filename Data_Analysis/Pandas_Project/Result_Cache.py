@@ -0,0 +1,144 @@
+# Setup
+# Importing required libraries
+import os, json, pickle, hashlib, time
+from Http_Cache import atomicWrite
+from Columnar_IO import frameChecksum, columnarMeta
+
+# Content-addressed cache for analytics results
+# A result is stored under the fingerprint of the data it was computed from,
+# the name of the computation and a hash of its parameters:
+#   <fingerprint[:16]>_<name>_<params hash[:16]>.pkl
+# so unchanged data and parameters always hit, and any change to either
+# misses. File modification times are used as LRU access times for eviction,
+# the same way as the HTTP cache.
+
+# Creates the cache settings used by cachedResult
+# Args: cacheDir: str directory for result files (created if missing),
+#       maxBytes: int size cap for all stored results
+# Returns: dict cache settings
+def openResultCache(cacheDir="result_cache", maxBytes=64 * 1024 * 1024):
+    os.makedirs(cacheDir, exist_ok=True)
+    return {"dir": cacheDir, "maxBytes": maxBytes, "hits": 0, "misses": 0}
+
+# Fingerprint of a DataFrame's contents, index included
+# Args: df: pd.DataFrame
+# Returns: str hex digest
+def frameFingerprint(df):
+    return frameChecksum(df)
+
+# Fingerprint of a file written by writeColumnar, read from its footer
+# Falls back to hashing the file bytes for files without stored metadata
+# Args: fileName: str
+# Returns: str hex digest
+def fileFingerprint(fileName):
+    meta = columnarMeta(fileName)
+    if meta is not None:
+        return hashlib.sha256(json.dumps(meta, sort_keys=True).encode()).hexdigest()
+    digest = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Cache file for a result
+# Args: cache: dict from openResultCache, fingerprint: str data fingerprint,
+#       name: str computation name, params: json-compatible dict
+# Returns: str path
+def resultPath(cache, fingerprint, name, params):
+    paramHash = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+    return os.path.join(cache["dir"], f"{fingerprint[:16]}_{name}_{paramHash[:16]}.pkl")
+
+# Returns a cached result, computing and storing it on a miss
+# Args: cache: dict from openResultCache (None computes without caching),
+#       fingerprint: str data fingerprint, name: str computation name (no underscores),
+#       params: json-compatible dict of the parameters that change the result,
+#       compute: function with no arguments that computes the result
+# Returns: the result
+def cachedResult(cache, fingerprint, name, params, compute):
+    if cache is None:
+        return compute()
+    path = resultPath(cache, fingerprint, name, params)
+    try:
+        with open(path, 'rb') as f:
+            result = pickle.load(f)
+        # touch for LRU ordering
+        os.utime(path)
+        cache["hits"] += 1
+        return result
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        # missing or unreadable entry is a miss
+        pass
+    cache["misses"] += 1
+    result = compute()
+    try:
+        atomicWrite(path, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        evictResults(cache)
+    except Exception as e:
+        print(f"Error caching {name}: {e}")
+    return result
+
+# Removes least recently used files until a directory fits in maxBytes
+# Args: directory: str, maxBytes: int size cap, suffix: str only files ending with it count
+# Returns: int number of files removed
+def evictFiles(directory, maxBytes, suffix):
+    entries = []
+    total = 0
+    for name in os.listdir(directory):
+        if name.endswith(suffix):
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+    removed = 0
+    # oldest access first
+    for _, size, name in sorted(entries):
+        if total <= maxBytes:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+# Removes least recently used results until the cache fits in maxBytes
+# Args: cache: dict from openResultCache
+# Returns: int number of results removed
+def evictResults(cache):
+    return evictFiles(cache["dir"], cache["maxBytes"], ".pkl")
+
+# Tile directory inside a result cache, gridTiles stores its Parquet tiles there
+# Args: cache: dict from openResultCache, None for no tile cache
+# Returns: str directory, None when cache is None
+def tileCacheDir(cache):
+    return os.path.join(cache["dir"], "tiles") if cache is not None else None
+
+# Removes cached results, all of them by default
+# Args: cache: dict from openResultCache, fingerprint: optional str, only results for this data,
+#       name: optional str, only results of this computation
+# Returns: int number of results removed
+def invalidateResults(cache, fingerprint=None, name=None):
+    removed = 0
+    for fileName in os.listdir(cache["dir"]):
+        if not fileName.endswith(".pkl"):
+            continue
+        entryPrint, entryName, _ = fileName[:-len(".pkl")].split("_", 2)
+        if fingerprint is not None and entryPrint != fingerprint[:16]:
+            continue
+        if name is not None and entryName != name:
+            continue
+        try:
+            os.remove(os.path.join(cache["dir"], fileName))
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+# Prints hit and miss counts for a run
+# Args: cache: dict from openResultCache, start: optional float perf_counter at the start of the run
+def reportResultCache(cache, start=None):
+    elapsed = f" in {time.perf_counter() - start:.2f}s" if start is not None else ""
+    print(f"Result cache: {cache['hits']} hits, {cache['misses']} misses{elapsed}")
@@ -0,0 +1,198 @@
+# Setup
+# Importing required libraries
+import os, time
+import numpy as np
+import pandas as pd
+from Columnar_IO import frameChecksum, writeColumnar, readColumnar
+from Result_Cache import evictFiles
+from Stage_Metrics import instrumented
+
+# Binned spatial aggregation
+# Landings are binned into lat/long grid cells (or geohash cells) with integer
+# arithmetic in NumPy and aggregated with bincount, giving one row per
+# non-empty cell instead of one per distinct float coordinate.
+# Grid cells start at (-90, -180) and are cellDeg degrees on a side. Cell sizes
+# that divide each other nest, so coarser zoom levels are rolled up from the
+# finer ones instead of re-reading the points.
+# Rows missing the coordinates or the value are skipped.
+
+# Zoom levels in degrees per cell, coarse to fine
+ZOOM_LEVELS = (10.0, 5.0, 1.0, 0.25)
+
+# Geohash base32 alphabet
+GEOHASH_ALPHABET = np.array(list("0123456789bcdefghjkmnpqrstuvwxyz"))
+
+# Coordinates and values as float64 arrays, restricted to usable rows
+# Args: df: pd.DataFrame, value, lat, long: str column names
+# Returns: tuple (lats, longs, values) numpy arrays
+def pointArrays(df, value="mass", lat="reclat", long="reclong"):
+    lats = df[lat].to_numpy(dtype=np.float64, na_value=np.nan)
+    longs = df[long].to_numpy(dtype=np.float64, na_value=np.nan)
+    values = df[value].to_numpy(dtype=np.float64, na_value=np.nan)
+    # NaN fails every comparison, so this drops missing values too
+    keep = (lats >= -90) & (lats <= 90) & (longs >= -180) & (longs <= 180) & ~np.isnan(values)
+    return lats[keep], longs[keep], values[keep]
+
+# Grid cell of each point, the north and east edges fall in the last cell
+# Args: lats, longs: numpy arrays, cellDeg: float degrees per cell
+# Returns: tuple (latCells, longCells) int64 arrays, int number of longitude cells
+def gridCells(lats, longs, cellDeg):
+    nLat = int(np.ceil(180 / cellDeg))
+    nLong = int(np.ceil(360 / cellDeg))
+    latCells = np.minimum(((lats + 90) // cellDeg).astype(np.int64), nLat - 1)
+    longCells = np.minimum(((longs + 180) // cellDeg).astype(np.int64), nLong - 1)
+    return latCells, longCells, nLong
+
+# Count, value sum and mean per non-empty cell code
+# Args: codes: int64 cell code per point, values: float64 array
+# Returns: tuple (unique codes sorted, counts, sums)
+def binCodes(codes, values):
+    inverse, uniq = pd.factorize(codes)
+    counts = np.bincount(inverse, minlength=len(uniq))
+    sums = np.bincount(inverse, weights=values, minlength=len(uniq))
+    order = np.argsort(uniq)
+    return uniq[order], counts[order], sums[order]
+
+# Builds a tile DataFrame from per-cell grid aggregates
+# Args: latCells, longCells: int64 arrays, counts, sums: arrays, cellDeg: float
+# Returns: pd.DataFrame with latCell, longCell, latMin, longMin, count, sum and mean columns
+def tileFrame(latCells, longCells, counts, sums, cellDeg):
+    return pd.DataFrame({
+        "latCell": latCells, "longCell": longCells,
+        # south-west corner of each cell
+        "latMin": latCells * cellDeg - 90.0, "longMin": longCells * cellDeg - 180.0,
+        "count": counts.astype(np.int64), "sum": sums, "mean": sums / counts})
+
+# Aggregates a value over a lat/long grid
+# Args: df: pd.DataFrame, cellDeg: float degrees per cell, value, lat, long: str column names
+# Returns: pd.DataFrame, one row per non-empty cell (see tileFrame)
+def gridAggregate(df, cellDeg=1.0, value="mass", lat="reclat", long="reclong"):
+    lats, longs, values = pointArrays(df, value, lat, long)
+    latCells, longCells, nLong = gridCells(lats, longs, cellDeg)
+    codes, counts, sums = binCodes(latCells * nLong + longCells, values)
+    return tileFrame(codes // nLong, codes % nLong, counts, sums, cellDeg)
+
+# Rolls a tile up to a coarser grid whose cells are a whole number of the tile's cells
+# Args: tile: pd.DataFrame from gridAggregate, fromDeg: float tile cell size,
+#       toDeg: float coarser cell size
+# Returns: pd.DataFrame tile at toDeg, None if the grids don't nest
+def rollUp(tile, fromDeg, toDeg):
+    factor = toDeg / fromDeg
+    if factor < 1 or abs(factor - round(factor)) > 1e-9:
+        print(f"Cannot roll a {fromDeg:g} degree grid up to {toDeg:g} degrees")
+        return None
+    factor = int(round(factor))
+    nLong = int(np.ceil(360 / toDeg))
+    # the clamp keeps the last partial cell of a non-dividing grid inside the grid
+    latCells = np.minimum(tile["latCell"].to_numpy() // factor, int(np.ceil(180 / toDeg)) - 1)
+    longCells = np.minimum(tile["longCell"].to_numpy() // factor, nLong - 1)
+    codes = latCells * nLong + longCells
+    inverse, uniq = pd.factorize(codes)
+    counts = np.bincount(inverse, weights=tile["count"].to_numpy(), minlength=len(uniq))
+    sums = np.bincount(inverse, weights=tile["sum"].to_numpy(), minlength=len(uniq))
+    order = np.argsort(uniq)
+    uniq = uniq[order]
+    return tileFrame(uniq // nLong, uniq % nLong, counts[order], sums[order], toDeg)
+
+# Geohash cell of each point as an integer, bits interleaved longitude first
+# Args: lats, longs: numpy arrays, precision: int geohash characters (at most 12)
+# Returns: uint64 array
+def geohashCodes(lats, longs, precision):
+    bits = 5 * precision
+    longBits, latBits = (bits + 1) // 2, bits // 2
+    longQ = np.minimum(((longs + 180) / 360 * 2.0 ** longBits).astype(np.uint64), np.uint64(2 ** longBits - 1))
+    latQ = np.minimum(((lats + 90) / 180 * 2.0 ** latBits).astype(np.uint64), np.uint64(2 ** latBits - 1))
+    codes = np.zeros(len(lats), dtype=np.uint64)
+    one = np.uint64(1)
+    for i in range(bits):
+        if i % 2 == 0:
+            bit = (longQ >> np.uint64(longBits - 1 - i // 2)) & one
+        else:
+            bit = (latQ >> np.uint64(latBits - 1 - i // 2)) & one
+        codes = (codes << one) | bit
+    return codes
+
+# Geohash strings for integer codes from geohashCodes
+# Args: codes: uint64 array, precision: int geohash characters
+# Returns: numpy array of str
+def geohashStrings(codes, precision):
+    hashes = np.full(len(codes), "", dtype=f"<U{precision}")
+    for p in range(precision):
+        digits = (codes >> np.uint64(5 * (precision - 1 - p))) & np.uint64(31)
+        hashes = np.char.add(hashes, GEOHASH_ALPHABET[digits.astype(np.int64)])
+    return hashes
+
+# Aggregates a value over geohash cells
+# Args: df: pd.DataFrame, precision: int geohash characters, value, lat, long: str column names
+# Returns: pd.DataFrame indexed by geohash with count, sum and mean columns
+def geohashAggregate(df, precision=4, value="mass", lat="reclat", long="reclong"):
+    lats, longs, values = pointArrays(df, value, lat, long)
+    codes, counts, sums = binCodes(geohashCodes(lats, longs, precision), values)
+    # strings are only built for the non-empty cells
+    index = pd.Index(geohashStrings(codes, precision), name="geohash")
+    return pd.DataFrame({"count": counts.astype(np.int64), "sum": sums, "mean": sums / counts}, index=index)
+
+# Tile file for a cached zoom level
+# Args: cacheDir: str, fingerprint: str data checksum, level: float cell size or str geohash name
+# Returns: str path
+def tilePath(cacheDir, fingerprint, level):
+    name = level if isinstance(level, str) else f"{level:g}deg"
+    return os.path.join(cacheDir, f"{fingerprint[:24]}_{name}.parquet")
+
+# Grid tiles at several zoom levels, and optionally geohash tiles
+# The finest grid is aggregated from the points, coarser ones are rolled up
+# from it when the cell sizes nest. With cacheDir set, tiles are stored as
+# Parquet files keyed by a checksum of the coordinate and value columns and
+# read back on the next call with the same data. The directory is kept under
+# maxBytes by removing the least recently used tiles.
+# Args: df: pd.DataFrame, levels: cell sizes in degrees, value, lat, long: str column names,
+#       geohash: optional list of geohash precisions, cacheDir: optional str tile directory,
+#       e.g. Result_Cache.tileCacheDir(cache), maxBytes: int size cap for the tile directory
+# Returns: dict cell size (or "geohash<precision>") -> pd.DataFrame tile
+@instrumented()
+def gridTiles(df, levels=ZOOM_LEVELS, value="mass", lat="reclat", long="reclong", geohash=None,
+              cacheDir=None, maxBytes=64 * 1024 * 1024):
+    start = time.perf_counter()
+    names = sorted(levels) + [f"geohash{p}" for p in (geohash or [])]
+    tiles = {}
+    fingerprint = None
+    if cacheDir is not None:
+        os.makedirs(cacheDir, exist_ok=True)
+        fingerprint = frameChecksum(df[[lat, long, value]])
+        for level in names:
+            path = tilePath(cacheDir, fingerprint, level)
+            if os.path.exists(path):
+                tiles[level] = readColumnar(path)
+                # touch for LRU ordering
+                os.utime(path)
+    missing = [level for level in names if level not in tiles]
+    if missing:
+        finest = None
+        for level in sorted(levels):
+            if level not in tiles:
+                tile = rollUp(finest[1], finest[0], level) if finest is not None else None
+                # nothing finer to roll up from, or the grids don't nest
+                tiles[level] = tile if tile is not None else gridAggregate(df, level, value, lat, long)
+            if finest is None:
+                finest = (level, tiles[level])
+        for p in geohash or []:
+            if f"geohash{p}" not in tiles:
+                tiles[f"geohash{p}"] = geohashAggregate(df, p, value, lat, long)
+        if cacheDir is not None:
+            for level in missing:
+                writeColumnar(tiles[level], tilePath(cacheDir, fingerprint, level), partitionBy=None)
+            evictFiles(cacheDir, maxBytes, ".parquet")
+    print(f"{len(names)} tile levels ready in {time.perf_counter() - start:.3f}s "
+          f"({len(names) - len(missing)} from cache)")
+    return {level: tiles[level] for level in names}
+
+# Value mean per latitude (or longitude) band from a grid tile
+# Answers questions like "are larger hits closer to the equator?" from the
+# tile's cells without touching the points
+# Args: tile: pd.DataFrame from gridAggregate, axis: "lat" or "long"
+# Returns: pd.DataFrame indexed by band start with count, sum and mean columns
+def bandProfile(tile, axis="lat"):
+    key = "latMin" if axis == "lat" else "longMin"
+    bands = tile.groupby(key)[["count", "sum"]].sum()
+    bands["mean"] = bands["sum"] / bands["count"]
+    return bands
@@ -0,0 +1,439 @@
+# Setup
+# Importing required libraries
+import sqlite3, time, math
+from itertools import islice
+from operator import itemgetter
+from Lazy_Import import lazyImport
+from Stage_Metrics import instrumented
+from Dtype_Plan import compactFrame, compactChunks
+np = lazyImport("numpy")
+pd = lazyImport("pandas")
+
+# Column order used for meteorite_landings rows
+LANDING_COLUMNS = ("id", "name", "mass", "year", "reclat", "reclong")
+
+# PRAGMA profile for bulk loads, durability is traded for speed while loading
+# (a crash mid-load only loses the staging table, the live table is untouched)
+LOAD_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "OFF",
+    # negative cache_size is KiB, 256 MB page cache
+    "cache_size": -262144,
+    "temp_store": "MEMORY",
+}
+
+# Materialized summary tables kept next to a landings table
+# name suffix -> (key column, key expression over a row alias, band start expression)
+# Latitude and longitude are shifted to be non-negative so CAST truncation is a floor
+SUMMARIES = {
+    "by_year": ("year", "{row}.year", "{key}"),
+    "by_lat_band": ("band", "CAST(({row}.reclat + 90.0) / {width} AS INTEGER)", "{key} * {width} - 90.0"),
+    "by_long_band": ("band", "CAST(({row}.reclong + 180.0) / {width} AS INTEGER)", "{key} * {width} - 180.0"),
+}
+
+# Secondary indexes for the analytics queries on a landings table
+# Args: tableName: str Table name
+# Returns: dict index name to indexed column list, for bulkLoadSqlite or createIndexes
+def landingIndexes(tableName):
+    return {
+        f"{tableName}_year_idx": "year",
+        f"{tableName}_mass_idx": "mass",
+        f"{tableName}_latlong_idx": "reclat, reclong",
+    }
+
+# Creates the secondary indexes on an existing landings table
+# Args: conn: sqlite3.Connection, tableName: str Table name
+def createIndexes(conn, tableName):
+    for name, indexed in landingIndexes(tableName).items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {tableName} ({indexed})")
+    conn.commit()
+
+# Rebuilds the summary tables (count, mass sum and mean per year, latitude band
+# and longitude band) from the landings table and optionally installs triggers
+# that keep them current on every insert, update and delete
+# count is landings, mass_count the ones with a mass, the mean is over those
+# (0 when there are none); rows with a NULL key are left out
+# Runs inside a savepoint, so it can be part of a bigger transaction
+# Args: conn: sqlite3.Connection, tableName: str Table name,
+#       bandWidth: float degrees per latitude/longitude band, triggers: bool
+def refreshSummaries(conn, tableName, bandWidth=1.0, triggers=True):
+    conn.execute("SAVEPOINT refresh_summaries")
+    for suffix, (keyCol, keyExpr, startExpr) in SUMMARIES.items():
+        summary = f"{tableName}_{suffix}"
+        key = keyExpr.format(row=tableName, width=bandWidth)
+        conn.execute(f"DROP TABLE IF EXISTS {summary}")
+        conn.execute(f'''
+            CREATE TABLE {summary} (
+                {keyCol} INTEGER PRIMARY KEY, start REAL NOT NULL, count INTEGER NOT NULL,
+                mass_count INTEGER NOT NULL, mass_sum REAL NOT NULL, mass_mean REAL NOT NULL)''')
+        # one grouped scan per summary
+        conn.execute(f'''
+            INSERT INTO {summary} ({keyCol}, start, count, mass_count, mass_sum, mass_mean)
+            SELECT {key}, {startExpr.format(key=key, width=bandWidth)}, COUNT(*), COUNT(mass),
+                TOTAL(mass), COALESCE(AVG(mass), 0)
+            FROM {tableName} WHERE {key} IS NOT NULL GROUP BY 1''')
+        if triggers:
+            createSummaryTriggers(conn, tableName, suffix, bandWidth)
+    conn.execute("RELEASE refresh_summaries")
+
+# Installs the triggers that maintain one summary table incrementally
+# Args: conn: sqlite3.Connection, tableName: str Table name,
+#       suffix: str key of SUMMARIES, bandWidth: float degrees per band
+def createSummaryTriggers(conn, tableName, suffix, bandWidth):
+    keyCol, keyExpr, startExpr = SUMMARIES[suffix]
+    summary = f"{tableName}_{suffix}"
+    newKey = keyExpr.format(row="NEW", width=bandWidth)
+    oldKey = keyExpr.format(row="OLD", width=bandWidth)
+    # a NULL mass counts as a landing but adds nothing to mass_count or mass_sum
+    add = f'''
+        INSERT INTO {summary} ({keyCol}, start, count, mass_count, mass_sum, mass_mean)
+        SELECT {newKey}, {startExpr.format(key=newKey, width=bandWidth)}, 1, NEW.mass IS NOT NULL,
+            TOTAL(NEW.mass), TOTAL(NEW.mass)
+        WHERE {newKey} IS NOT NULL
+        ON CONFLICT({keyCol}) DO UPDATE SET count = count + 1,
+            mass_count = mass_count + excluded.mass_count, mass_sum = mass_sum + excluded.mass_sum,
+            mass_mean = CASE WHEN mass_count + excluded.mass_count > 0
+                THEN (mass_sum + excluded.mass_sum) / (mass_count + excluded.mass_count) ELSE 0 END;'''
+    remove = f'''
+        UPDATE {summary} SET count = count - 1, mass_count = mass_count - (OLD.mass IS NOT NULL),
+            mass_sum = mass_sum - COALESCE(OLD.mass, 0),
+            mass_mean = CASE WHEN mass_count - (OLD.mass IS NOT NULL) > 0
+                THEN (mass_sum - COALESCE(OLD.mass, 0)) / (mass_count - (OLD.mass IS NOT NULL)) ELSE 0 END
+        WHERE {keyCol} = {oldKey};
+        DELETE FROM {summary} WHERE {keyCol} = {oldKey} AND count <= 0;'''
+    for event, body in (("INSERT", add), ("DELETE", remove), ("UPDATE", remove + add)):
+        trigger = f"{summary}_{event.lower()}"
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.execute(f"CREATE TRIGGER {trigger} AFTER {event} ON {tableName} BEGIN {body} END")
+
+# Drops the summary tables of a landings table, their triggers went with the old table
+# Args: conn: sqlite3.Connection, tableName: str Table name
+def dropSummaries(conn, tableName):
+    for suffix in SUMMARIES:
+        conn.execute(f"DROP TABLE IF EXISTS {tableName}_{suffix}")
+
+# Reads a materialized summary table instead of scanning the landings
+# Args: conn: sqlite3.Connection, tableName: str Table name,
+#       suffix: str key of SUMMARIES ("by_year", "by_lat_band", "by_long_band")
+# Returns: pd.DataFrame indexed by year or band
+def readSummary(conn, tableName, suffix="by_year"):
+    keyCol = SUMMARIES[suffix][0]
+    return pd.read_sql(f"SELECT * FROM {tableName}_{suffix} ORDER BY {keyCol}", conn, index_col=keyCol)
+
+# Landings per year from the year summary, the input to the trend line
+# Args: conn: sqlite3.Connection, tableName: str Table name,
+#       start: int first year, end: int last year (inclusive)
+# Returns: pd.Series count of landings indexed by year
+def landingsPerYear(conn, tableName, start=1616, end=2016):
+    byYear = readSummary(conn, tableName, "by_year")
+    return byYear.loc[(byYear.index >= start) & (byYear.index <= end), "count"]
+
+# Mean earth radius used for great-circle distances
+EARTH_RADIUS_KM = 6371.0088
+
+# Creates (or rebuilds) the R*Tree over reclat/reclong for a landings table,
+# plus triggers that keep it in sync with inserts, updates and deletes
+# Each landing is a degenerate box (min == max) keyed by the landing id
+# Args: conn: sqlite3.Connection, tableName: str Table name
+def createSpatialIndex(conn, tableName):
+    rtree = f"{tableName}_rtree"
+    conn.execute("SAVEPOINT spatial_index")
+    conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {rtree} USING rtree(id, minLat, maxLat, minLong, maxLong)")
+    conn.execute(f"DELETE FROM {rtree}")
+    conn.execute(f"INSERT INTO {rtree} SELECT id, reclat, reclat, reclong, reclong FROM {tableName}")
+    triggers = {
+        "INSERT": f"INSERT INTO {rtree} VALUES (NEW.id, NEW.reclat, NEW.reclat, NEW.reclong, NEW.reclong);",
+        "DELETE": f"DELETE FROM {rtree} WHERE id = OLD.id;",
+        "UPDATE": f'''DELETE FROM {rtree} WHERE id = OLD.id;
+            INSERT INTO {rtree} VALUES (NEW.id, NEW.reclat, NEW.reclat, NEW.reclong, NEW.reclong);''',
+    }
+    for event, body in triggers.items():
+        trigger = f"{rtree}_{event.lower()}"
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.execute(f"CREATE TRIGGER {trigger} AFTER {event} ON {tableName} BEGIN {body} END")
+    conn.execute("RELEASE spatial_index")
+
+# Drops the R*Tree of a landings table, its triggers go with it
+# Args: conn: sqlite3.Connection, tableName: str Table name
+def dropSpatialIndex(conn, tableName):
+    conn.execute(f"DROP TABLE IF EXISTS {tableName}_rtree")
+
+# Splits a longitude range into ranges that don't cross the antimeridian
+# Args: longMin: float, longMax: float (longMin > longMax means the box wraps past 180)
+# Returns: list of (low, high) tuples
+def longitudeRanges(longMin, longMax):
+    if longMin <= longMax:
+        return [(longMin, longMax)]
+    return [(longMin, 180.0), (-180.0, longMax)]
+
+# Looks up landings inside a bounding box through the R*Tree
+# The R*Tree stores 32-bit floats, so the exact bounds are rechecked on the table
+# Args: conn: sqlite3.Connection, tableName: str Table name,
+#       latMin, latMax, longMin, longMax: float box (longMin > longMax wraps past 180),
+#       massRange: optional (min, max) mass filter, yearRange: optional (min, max) year filter
+# Returns: pd.DataFrame of matching landings indexed by id
+def bboxQuery(conn, tableName, latMin, latMax, longMin, longMax, massRange=None, yearRange=None):
+    frames = []
+    for low, high in longitudeRanges(longMin, longMax):
+        # CROSS JOIN keeps the R*Tree as the outer loop, the planner would
+        # otherwise pick the year or mass index for wide filter ranges
+        sql = f'''
+            SELECT t.* FROM {tableName}_rtree r CROSS JOIN {tableName} t ON t.id = r.id
+            WHERE r.maxLat >= ? AND r.minLat <= ? AND r.maxLong >= ? AND r.minLong <= ?
+            AND t.reclat BETWEEN ? AND ? AND t.reclong BETWEEN ? AND ?'''
+        params = [latMin, latMax, low, high, latMin, latMax, low, high]
+        if massRange is not None:
+            sql += " AND t.mass BETWEEN ? AND ?"
+            params += list(massRange)
+        if yearRange is not None:
+            sql += " AND t.year BETWEEN ? AND ?"
+            params += list(yearRange)
+        frames.append(pd.read_sql(sql, conn, params=params, index_col="id"))
+    return frames[0] if len(frames) == 1 else pd.concat(frames)
+
+# Great-circle (haversine) distance from one point to arrays of points
+# Args: lat, long: float degrees, lats, longs: numpy arrays of degrees
+# Returns: numpy array of distances in km
+def haversineKm(lat, long, lats, longs):
+    lat1, long1 = np.radians(lat), np.radians(long)
+    lat2, long2 = np.radians(lats), np.radians(longs)
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+# Looks up landings within radiusKm of a point
+# An R*Tree box that encloses the circle narrows the candidates, then the
+# exact haversine distance filters them
+# Args: conn: sqlite3.Connection, tableName: str Table name,
+#       lat, long: float center in degrees, radiusKm: float,
+#       massRange: optional (min, max) mass filter, yearRange: optional (min, max) year filter
+# Returns: pd.DataFrame of matching landings with distance_km, nearest first
+def radiusQuery(conn, tableName, lat, long, radiusKm, massRange=None, yearRange=None):
+    angle = radiusKm / EARTH_RADIUS_KM
+    latMin = lat - math.degrees(angle)
+    latMax = lat + math.degrees(angle)
+    if latMin <= -90.0 or latMax >= 90.0 or angle >= math.pi / 2:
+        # circle reaches a pole, every longitude is in range
+        latMin, latMax = max(latMin, -90.0), min(latMax, 90.0)
+        longMin, longMax = -180.0, 180.0
+    else:
+        # widest longitude span of the circle
+        dLong = math.degrees(math.asin(min(1.0, math.sin(angle) / math.cos(math.radians(lat)))))
+        if dLong >= 180.0:
+            longMin, longMax = -180.0, 180.0
+        else:
+            longMin = (long - dLong + 180.0) % 360.0 - 180.0
+            longMax = (long + dLong + 180.0) % 360.0 - 180.0
+    candidates = bboxQuery(conn, tableName, latMin, latMax, longMin, longMax, massRange, yearRange)
+    distance = haversineKm(lat, long, candidates["reclat"].to_numpy(), candidates["reclong"].to_numpy())
+    result = candidates.assign(distance_km=distance)
+    return result[result["distance_km"] <= radiusKm].sort_values("distance_km")
+
+# Looks up the k landings nearest to a point
+# Searches a growing radius until at least k landings fall inside the circle,
+# every landing closer than the k-th one is then guaranteed to be in the result
+# Args: conn: sqlite3.Connection, tableName: str Table name,
+#       lat, long: float point in degrees, k: int number of landings,
+#       massRange: optional (min, max) mass filter, yearRange: optional (min, max) year filter,
+#       startKm: float first search radius
+# Returns: pd.DataFrame of up to k landings with distance_km, nearest first
+def nearestQuery(conn, tableName, lat, long, k, massRange=None, yearRange=None, startKm=100.0):
+    radiusKm = startKm
+    # half the circumference covers the whole globe
+    maxKm = math.pi * EARTH_RADIUS_KM
+    while True:
+        found = radiusQuery(conn, tableName, lat, long, radiusKm, massRange, yearRange)
+        if len(found) >= k or radiusKm >= maxKm:
+            return found.head(k)
+        radiusKm = min(radiusKm * 4, maxKm)
+
+# Builds a projected, filtered SELECT over a landings table
+# Args: tableName: str Table name, columns: optional list of columns (id is always read),
+#       yearRange: optional (min, max), massRange: optional (min, max),
+#       bbox: optional (latMin, latMax, longMin, longMax), longMin > longMax wraps past 180
+# Returns: tuple (str sql, list params)
+def landingQuery(tableName, columns=None, yearRange=None, massRange=None, bbox=None):
+    selected = "*" if columns is None else ", ".join(["id"] + [c for c in columns if c != "id"])
+    where = []
+    params = []
+    if yearRange is not None:
+        where.append("year BETWEEN ? AND ?")
+        params += list(yearRange)
+    if massRange is not None:
+        where.append("mass BETWEEN ? AND ?")
+        params += list(massRange)
+    if bbox is not None:
+        latMin, latMax, longMin, longMax = bbox
+        where.append("reclat BETWEEN ? AND ?")
+        params += [latMin, latMax]
+        if longMin <= longMax:
+            where.append("reclong BETWEEN ? AND ?")
+        else:
+            where.append("(reclong >= ? OR reclong <= ?)")
+        params += [longMin, longMax]
+    sql = f"SELECT {selected} FROM {tableName}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql, params
+
+# Reads landings with the column list and filters pushed into the SQL
+# Args: conn: sqlite3.Connection, tableName: str Table name, columns, yearRange,
+#       massRange, bbox: see landingQuery,
+#       chunksize: optional int, returns an iterator of DataFrames of that many rows,
+#       dtypes: optional Dtype_Plan schema, e.g. LANDING_DTYPES, frames are cast to its
+#       compact dtypes as they are read (chunks all get the dtypes planned from the first one)
+# Returns: pd.DataFrame indexed by id, or an iterator of them when chunksize is set
+def readLandings(conn, tableName, columns=None, yearRange=None, massRange=None, bbox=None,
+                 chunksize=None, dtypes=None):
+    sql, params = landingQuery(tableName, columns, yearRange, massRange, bbox)
+    # nullable year survives missing values
+    dtype = {'year': 'Int64'} if columns is None or "year" in columns else None
+    frames = pd.read_sql(sql, conn, params=params, index_col="id", dtype=dtype, chunksize=chunksize)
+    if dtypes is None:
+        return frames
+    if chunksize is not None:
+        return compactChunks(frames, dtypes)
+    return compactFrame(frames, dtypes)[0]
+
+# Applies a dict of PRAGMA settings to a connection
+# Args: conn: sqlite3.Connection, pragmas: dict PRAGMA name to value
+def applyPragmas(conn, pragmas):
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name}={value}")
+
+# Turns records into row tuples in column order without materializing them
+# Args: records: iterable of dicts, or a pd.DataFrame, columns: sequence of column names
+# Returns: iterator of tuples
+def recordRows(records, columns):
+    if hasattr(records, "columns"):
+        # DataFrame, e.g. from extractMDBColumnar, zipped from plain python lists
+        return zip(*(records[col].tolist() for col in columns))
+    # itemgetter builds each tuple in C
+    return map(itemgetter(*columns), records)
+
+# Swaps the loaded {tableName}_staging table in for tableName in one transaction
+# readers see the old table until COMMIT
+# Args: conn: sqlite3.Connection in autocommit mode, tableName: str Table name,
+#       indexes, summaries, bandWidth, spatial: see bulkLoadSqlite
+def swapStaging(conn, tableName, indexes=None, summaries=False, bandWidth=1.0, spatial=False):
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute(f"DROP TABLE IF EXISTS {tableName}")
+    conn.execute(f"ALTER TABLE {tableName}_staging RENAME TO {tableName}")
+    # deferred index builds, one sorted pass each instead of per-row updates
+    for name, indexed in (indexes or {}).items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {tableName} ({indexed})")
+    # summaries are rebuilt after the load rather than row by row through triggers
+    if summaries:
+        refreshSummaries(conn, tableName, bandWidth)
+    else:
+        dropSummaries(conn, tableName)
+    if spatial:
+        createSpatialIndex(conn, tableName)
+    else:
+        # its triggers went with the old table, the boxes would go stale
+        dropSpatialIndex(conn, tableName)
+    conn.execute("COMMIT")
+
+# Swaps in a staging table left by bulkLoadSqlite(..., swap=False)
+# Args: dbName: str SQLite DB Name, tableName: str Table name,
+#       indexes, summaries, bandWidth, spatial: see bulkLoadSqlite
+# Returns: True if successful, None if fails (the staging table is dropped)
+def commitStaging(dbName, tableName, indexes=None, summaries=False, bandWidth=1.0, spatial=False):
+    conn = sqlite3.connect(dbName, isolation_level=None)
+    try:
+        swapStaging(conn, tableName, indexes, summaries, bandWidth, spatial)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return True
+    except Exception as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.execute(f"DROP TABLE IF EXISTS {tableName}_staging")
+        print(f"Error swapping in SQLite table {tableName}.")
+        print(f"Error: {e}")
+        return None
+    finally:
+        conn.close()
+
+# Drops a staging table left by bulkLoadSqlite(..., swap=False), the live table is untouched
+# Args: dbName: str SQLite DB Name, tableName: str Table name
+def dropStaging(dbName, tableName):
+    conn = sqlite3.connect(dbName, isolation_level=None)
+    try:
+        conn.execute(f"DROP TABLE IF EXISTS {tableName}_staging")
+    finally:
+        conn.close()
+
+# Bulk loads records into a SQLite table through a staging table
+# Rows go in with executemany, chunkSize rows per transaction, under the
+# LOAD_PRAGMAS profile. Indexes are built after the load, then the staging
+# table is swapped in for tableName in one transaction. With swap=False the
+# loaded staging table is left for commitStaging, or dropStaging to discard it.
+# Args : dbName: str SQLite DB Name, tableName: str Table name,
+#        keys: str Table attribute names and options, records: iterable of dicts or DataFrame,
+#        columns: sequence of column names to insert,
+#        indexes: optional dict index name to indexed column list, e.g. {"idx_year": "year"},
+#        chunkSize: int rows per transaction, pragmas: dict load-time PRAGMA profile,
+#        summaries: bool rebuild the summary tables and triggers in the swap transaction,
+#        when False summary tables left from an earlier load are dropped,
+#        bandWidth: float degrees per latitude/longitude summary band,
+#        spatial: bool rebuild the reclat/reclong R*Tree in the swap transaction, when
+#        False an R*Tree left from an earlier load is dropped, it no longer matches the table,
+#        swap: bool swap the staging table in, False leaves it as {tableName}_staging
+# Returns: int rows loaded if successful, None if fails
+@instrumented(rowsArg=3)
+def bulkLoadSqlite(dbName, tableName, keys, records, columns=LANDING_COLUMNS, indexes=None,
+                   chunkSize=50000, pragmas=LOAD_PRAGMAS, summaries=False, bandWidth=1.0,
+                   spatial=False, swap=True):
+    start = time.perf_counter()
+    staging = f"{tableName}_staging"
+    # autocommit mode, transactions are opened explicitly below
+    conn = sqlite3.connect(dbName, isolation_level=None)
+    try:
+        applyPragmas(conn, pragmas)
+        conn.execute(f"DROP TABLE IF EXISTS {staging}")
+        conn.execute(f"CREATE TABLE {staging} ({keys})")
+        # statement is parsed once and reused for every row
+        sql = (f"INSERT OR IGNORE INTO {staging} ({', '.join(columns)}) "
+               f"VALUES ({', '.join('?' * len(columns))})")
+        rows = recordRows(records, columns)
+        submitted = 0
+        # rows ignored on a duplicate id are not changes, the staging table has no triggers
+        changesBefore = conn.total_changes
+        while True:
+            chunk = list(islice(rows, chunkSize))
+            if not chunk:
+                break
+            conn.execute("BEGIN")
+            conn.executemany(sql, chunk)
+            conn.execute("COMMIT")
+            submitted += len(chunk)
+        total = conn.total_changes - changesBefore
+        loaded = time.perf_counter()
+
+        if swap:
+            # swap staging into place, readers see the old table until COMMIT
+            swapStaging(conn, tableName, indexes, summaries, bandWidth, spatial)
+            # back to a durable setting for whoever uses the connection next
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+        seconds = time.perf_counter() - start
+        if swap:
+            print(f"Loaded {total} rows into {tableName} in {seconds:.2f}s "
+                  f"({total / seconds if seconds > 0 else 0:.0f} rows/sec, "
+                  f"{time.perf_counter() - loaded:.2f}s swap and index builds)")
+        else:
+            print(f"Staged {total} rows into {staging} in {seconds:.2f}s "
+                  f"({total / seconds if seconds > 0 else 0:.0f} rows/sec)")
+        if submitted > total:
+            print(f"Ignored {submitted - total} rows with a duplicate key")
+        return total
+    except Exception as e:
+        # Print error message, drop the partial staging table and return None
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.execute(f"DROP TABLE IF EXISTS {staging}")
+        print(f"Error bulk loading SQLite table {tableName}.")
+        print(f"Error: {e}")
+        return None
+    finally:
+        conn.close()
@@ -0,0 +1,250 @@
+# Setup
+# Importing required libraries
+import os, json, time, socket, tempfile, tracemalloc, cProfile, functools, contextlib, numbers
+
+# Per-stage timing and memory instrumentation
+# Pipeline stages are wrapped with the instrumented decorator (or a
+# stageTimer block) and each run produces one record:
+#   {"stage", "start", "seconds", "cpuSeconds", "rowsIn", "rowsOut",
+#    "peakMemoryBytes", "status", "error", "host", "pid"}
+# which is kept in METRICS["records"] and passed to every sink. Sinks are
+# functions taking a record: jsonLogSink appends JSON lines, prometheusSink
+# rewrites a Prometheus text file of running totals. One stage can also be
+# run under cProfile with its stats dumped to a file.
+# Instrumentation is off until enableMetrics is called, a disabled stage is
+# one dict lookup before the call.
+# Environment variables read by metricsFromEnv:
+#   METEORITE_METRICS_LOG=<file.jsonl>, METEORITE_METRICS_PROM=<file.prom>,
+#   METEORITE_PROFILE_STAGE=<stage>, METEORITE_METRICS_MEMORY=0 (skip tracemalloc)
+
+# Instrumentation state, shared by every instrumented module in the process
+METRICS = {"enabled": False, "memory": False, "sinks": [], "records": [], "profileStage": None,
+           "profileFile": None, "profiling": False, "memoryStack": []}
+
+# Turns instrumentation on
+# Args: sinks: list of functions taking a stage record, memory: bool track the
+#       tracemalloc peak of each stage (slows allocation heavy stages down),
+#       profileStage: optional str stage run under cProfile,
+#       profileFile: optional str cProfile stats file, <profileStage>.prof by default
+# Returns: dict METRICS
+def enableMetrics(sinks=None, memory=True, profileStage=None, profileFile=None):
+    METRICS["sinks"] = list(sinks or [])
+    METRICS["memory"] = memory
+    METRICS["profileStage"] = profileStage
+    METRICS["profileFile"] = profileFile or (f"{profileStage}.prof" if profileStage else None)
+    METRICS["memoryStack"] = []
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    METRICS["enabled"] = True
+    return METRICS
+
+# Turns instrumentation off, records already collected are kept
+def disableMetrics():
+    METRICS["enabled"] = False
+    if METRICS["memory"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    METRICS["memory"] = False
+
+# Enables instrumentation from the METEORITE_METRICS_* environment variables
+# Returns: bool True if any sink or profile was configured
+def metricsFromEnv():
+    sinks = []
+    if os.environ.get("METEORITE_METRICS_LOG"):
+        sinks.append(jsonLogSink(os.environ["METEORITE_METRICS_LOG"]))
+    if os.environ.get("METEORITE_METRICS_PROM"):
+        sinks.append(prometheusSink(os.environ["METEORITE_METRICS_PROM"]))
+    profileStage = os.environ.get("METEORITE_PROFILE_STAGE") or None
+    if not sinks and profileStage is None:
+        return False
+    enableMetrics(sinks, memory=os.environ.get("METEORITE_METRICS_MEMORY", "1") != "0",
+                  profileStage=profileStage)
+    return True
+
+# Row count of a stage input or output
+# Lists and DataFrames count their length, ints count themselves, tuples count
+# their first item (e.g. runPlan's (df, report)), insert results count their ids
+# Args: obj: any value
+# Returns: int rows, None if the value has no row count
+def rowCount(obj):
+    if obj is None or isinstance(obj, (bool, str, bytes, dict)):
+        return None
+    if isinstance(obj, numbers.Integral):
+        return int(obj)
+    if isinstance(obj, tuple):
+        return rowCount(obj[0]) if obj else None
+    if hasattr(obj, "inserted_ids"):
+        return len(obj.inserted_ids)
+    try:
+        return len(obj)
+    except TypeError:
+        # generators, cursors and connections
+        return None
+
+# Starts a stage record
+# Args: stage: str stage name, rowsIn: optional int
+# Returns: dict stage record
+def startStage(stage, rowsIn=None):
+    record = {"stage": stage, "start": time.time(), "rowsIn": rowsIn, "rowsOut": None,
+              "peakMemoryBytes": None, "status": "ok", "error": None}
+    if METRICS["memory"] and tracemalloc.is_tracing():
+        stack = METRICS["memoryStack"]
+        current, peak = tracemalloc.get_traced_memory()
+        # the enclosing stage keeps the peak reached so far before it is reset
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        stack.append([current, current])
+    record["_wall"] = time.perf_counter()
+    record["_cpu"] = time.process_time()
+    return record
+
+# Finishes a stage record and sends it to the sinks
+# Args: record: dict from startStage
+# Returns: dict finished record
+def finishStage(record):
+    record["seconds"] = time.perf_counter() - record.pop("_wall")
+    record["cpuSeconds"] = time.process_time() - record.pop("_cpu")
+    stack = METRICS["memoryStack"]
+    if METRICS["memory"] and stack and tracemalloc.is_tracing():
+        start, peak = stack.pop()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        # nested stages count towards the enclosing stage's peak
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        record["peakMemoryBytes"] = peak - start
+    record["host"] = socket.gethostname()
+    record["pid"] = os.getpid()
+    METRICS["records"].append(record)
+    for sink in METRICS["sinks"]:
+        try:
+            sink(record)
+        except Exception as e:
+            print(f"Error writing metrics for {record['stage']}: {e}")
+    return record
+
+# Times a block of code as one stage, the caller can set record["rowsOut"]
+# Usage: with stageTimer("plot:histograms", len(df)) as record: ...
+# Args: stage: str stage name, rowsIn: optional int
+# Yields: dict stage record, an unused dict when instrumentation is off
+@contextlib.contextmanager
+def stageTimer(stage, rowsIn=None):
+    if not METRICS["enabled"]:
+        yield {}
+        return
+    record = startStage(stage, rowsIn)
+    try:
+        yield record
+    except BaseException as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        finishStage(record)
+
+# Runs a stage function under cProfile and dumps the stats
+# Args: fn: function, args, kwargs: its arguments
+# Returns: the function's result
+def profiledCall(fn, args, kwargs):
+    profile = cProfile.Profile()
+    METRICS["profiling"] = True
+    try:
+        return profile.runcall(fn, *args, **kwargs)
+    finally:
+        METRICS["profiling"] = False
+        profile.dump_stats(METRICS["profileFile"])
+        print(f"Profile of {METRICS['profileStage']} written to {METRICS['profileFile']}")
+
+# Decorator recording a stage record for every call of a function
+# Usage: @instrumented() or @instrumented(rowsArg=2)
+# Args: fn: function (when used without parentheses), stage: optional str, the function name by default,
+#       rowsArg: optional int position of the argument whose rowCount is rowsIn, None for no rows in
+# Returns: decorated function
+def instrumented(fn=None, stage=None, rowsArg=0):
+    if fn is None:
+        return functools.partial(instrumented, stage=stage, rowsArg=rowsArg)
+    name = stage or fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not METRICS["enabled"]:
+            return fn(*args, **kwargs)
+        rowsIn = rowCount(args[rowsArg]) if rowsArg is not None and rowsArg < len(args) else None
+        record = startStage(name, rowsIn)
+        try:
+            if METRICS["profileStage"] == name and not METRICS["profiling"]:
+                result = profiledCall(fn, args, kwargs)
+            else:
+                result = fn(*args, **kwargs)
+        except BaseException as e:
+            record["status"] = "error"
+            record["error"] = f"{type(e).__name__}: {e}"
+            finishStage(record)
+            raise
+        record["rowsOut"] = rowCount(result)
+        finishStage(record)
+        return result
+    return wrapper
+
+# Sink appending one JSON line per stage record
+# Args: fileName: str .jsonl log file, appended to
+# Returns: function taking a stage record
+def jsonLogSink(fileName):
+    def sink(record):
+        with open(fileName, 'a') as f:
+            f.write(json.dumps(record, default=str) + "\n")
+    return sink
+
+# Prometheus metric name -> (type, help, record field)
+PROMETHEUS_METRICS = {
+    "meteorite_stage_runs_total": ("counter", "Stage runs", None),
+    "meteorite_stage_failures_total": ("counter", "Stage runs that raised", None),
+    "meteorite_stage_seconds_total": ("counter", "Wall clock seconds spent in the stage", "seconds"),
+    "meteorite_stage_cpu_seconds_total": ("counter", "CPU seconds spent in the stage", "cpuSeconds"),
+    "meteorite_stage_rows_in_total": ("counter", "Rows passed into the stage", "rowsIn"),
+    "meteorite_stage_rows_out_total": ("counter", "Rows returned by the stage", "rowsOut"),
+    "meteorite_stage_peak_memory_bytes": ("gauge", "Python heap peak of the last run", "peakMemoryBytes"),
+}
+
+# Sink keeping running totals per stage in a Prometheus text exposition file,
+# for the node_exporter textfile collector. The file is rewritten atomically
+# after every stage.
+# Args: fileName: str .prom file
+# Returns: function taking a stage record
+def prometheusSink(fileName):
+    totals = {}
+
+    def sink(record):
+        stage = totals.setdefault(record["stage"], {name: 0 for name in PROMETHEUS_METRICS})
+        stage["meteorite_stage_runs_total"] += 1
+        stage["meteorite_stage_failures_total"] += record["status"] != "ok"
+        for name, (kind, _, field) in PROMETHEUS_METRICS.items():
+            if field is None or record.get(field) is None:
+                continue
+            if kind == "counter":
+                stage[name] += record[field]
+            else:
+                stage[name] = record[field]
+        lines = []
+        for name, (kind, helpText, _) in PROMETHEUS_METRICS.items():
+            lines.append(f"# HELP {name} {helpText}")
+            lines.append(f"# TYPE {name} {kind}")
+            for stageName in sorted(totals):
+                lines.append(f'{name}{{stage="{stageName}"}} {totals[stageName][name]:g}')
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)), suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        # the collector reads the file at any time, it never sees a partial one
+        os.chmod(tmpPath, 0o644)
+        os.replace(tmpPath, fileName)
+    return sink
+
+# Prints one line per stage record collected so far
+# Args: records: optional list of stage records, METRICS["records"] by default
+def reportMetrics(records=None):
+    records = METRICS["records"] if records is None else records
+    print(f"{'stage':>24} {'seconds':>9} {'cpu':>9} {'rows in':>10} {'rows out':>10} {'peak MB':>9}  status")
+    for r in records:
+        rows = [("" if r[k] is None else str(r[k])) for k in ("rowsIn", "rowsOut")]
+        peak = "" if r["peakMemoryBytes"] is None else f"{r['peakMemoryBytes'] / 1e6:.1f}"
+        print(f"{r['stage']:>24} {r['seconds']:>9.3f} {r['cpuSeconds']:>9.3f} {rows[0]:>10} {rows[1]:>10} "
+              f"{peak:>9}  {r['status']}")
@@ -0,0 +1,282 @@
+# Setup
+# Importing required libraries
+import os, json, tempfile
+import numpy as np
+import pandas as pd
+from Stage_Metrics import instrumented
+
+# Mergeable streaming statistics
+# One pass over DataFrame chunks gives count, min, max, mean, variance,
+# skewness, the pairwise covariance/correlation matrix and approximate
+# quantiles. Chunk moments are combined with Chan's parallel update, so
+# accumulators built on separate partitions (or on yesterday's data and
+# today's new landings) can be merged in any order.
+# Missing values are skipped per column, pairwise statistics use the rows where
+# both columns are present, the same as df.std / df.skew / df.cov / df.corr.
+# Quantiles come from a t-digest style sketch: sorted (mean, weight) centroids,
+# small near the tails and larger near the median, re-compressed after each merge.
+
+# Default sketch compression, about delta/2 centroids per column
+DIGEST_DELTA = 1000
+
+# Creates an empty accumulator
+# Args: columns: list of numeric columns to track, delta: int sketch compression
+# Returns: dict stats state
+def newStats(columns, delta=DIGEST_DELTA):
+    k = len(columns)
+    return {
+        "columns": list(columns), "delta": delta,
+        # per column moments
+        "n": np.zeros(k), "min": np.full(k, np.inf), "max": np.full(k, -np.inf),
+        "mean": np.zeros(k), "m2": np.zeros(k), "m3": np.zeros(k),
+        # pairwise moments, [i, j] is over the rows where columns i and j are both present
+        # pairMean[i, j] and pairM2[i, j] are the mean and M2 of column i on those rows
+        "pairN": np.zeros((k, k)), "pairMean": np.zeros((k, k)),
+        "pairM2": np.zeros((k, k)), "comoment": np.zeros((k, k)),
+        # quantile sketch per column, (centroid means, centroid weights)
+        "digests": [(np.empty(0), np.empty(0)) for _ in columns],
+    }
+
+# Numeric columns of a DataFrame, as picked by numeric_only=True
+def numericColumns(df):
+    return [col for col in df.columns
+            if pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col])]
+
+# Merges sketch centroids so no centroid covers more than one unit of the scale function
+# k(q) = delta / (2 pi) * asin(2q - 1), which keeps tail centroids small
+# Args: means, weights: numpy arrays, delta: int compression
+# Returns: tuple (means, weights) sorted by mean
+def compressDigest(means, weights, delta):
+    if len(means) == 0:
+        return means, weights
+    order = np.argsort(means, kind="stable")
+    means, weights = means[order], weights[order]
+    cum = np.cumsum(weights)
+    q = (cum - weights / 2) / cum[-1]
+    bucket = np.floor(delta / (2 * np.pi) * np.arcsin(2 * q - 1))
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    w = np.add.reduceat(weights, starts)
+    return np.add.reduceat(means * weights, starts) / w, w
+
+# Accumulator for a single chunk, moments computed exactly on the chunk
+# Args: df: pd.DataFrame chunk, columns: list of columns, delta: int sketch compression
+# Returns: dict stats state
+def chunkStats(df, columns, delta=DIGEST_DELTA):
+    stats = newStats(columns, delta)
+    x = df[columns].to_numpy(dtype=np.float64)
+    valid = ~np.isnan(x)
+    n = valid.sum(axis=0).astype(np.float64)
+    if not n.any():
+        return stats
+    nSafe = np.maximum(n, 1)
+    with np.errstate(invalid="ignore"):
+        stats["min"] = np.where(n > 0, np.nanmin(np.where(valid, x, np.inf), axis=0), np.inf)
+        stats["max"] = np.where(n > 0, np.nanmax(np.where(valid, x, -np.inf), axis=0), -np.inf)
+    mean = np.where(valid, x, 0).sum(axis=0) / nSafe
+    d = np.where(valid, x - mean, 0)
+    stats["n"], stats["mean"] = n, mean
+    stats["m2"], stats["m3"] = (d ** 2).sum(axis=0), (d ** 3).sum(axis=0)
+
+    # pairwise moments from matrix products over the presence mask,
+    # values are centered on the column means first to avoid cancellation
+    m = valid.astype(np.float64)
+    pairN = m.T @ m
+    pairSafe = np.maximum(pairN, 1)
+    s = d.T @ m
+    stats["pairN"] = pairN
+    stats["pairMean"] = mean[:, None] + s / pairSafe
+    stats["pairM2"] = (d ** 2).T @ m - s ** 2 / pairSafe
+    stats["comoment"] = d.T @ d - s * s.T / pairSafe
+
+    for i in range(len(columns)):
+        values = x[valid[:, i], i]
+        stats["digests"][i] = compressDigest(values, np.ones(len(values)), delta)
+    return stats
+
+# Combines two accumulators over the same columns (Chan et al. parallel update)
+# Args: a, b: dict stats states
+# Returns: dict stats state for the union of both inputs
+def mergeStats(a, b):
+    if a["columns"] != b["columns"]:
+        raise ValueError(f"Cannot merge stats over {a['columns']} and {b['columns']}")
+    n = a["n"] + b["n"]
+    nSafe = np.maximum(n, 1)
+    delta = b["mean"] - a["mean"]
+    stats = newStats(a["columns"], a["delta"])
+    stats["n"] = n
+    stats["min"] = np.minimum(a["min"], b["min"])
+    stats["max"] = np.maximum(a["max"], b["max"])
+    stats["mean"] = a["mean"] + delta * b["n"] / nSafe
+    stats["m2"] = a["m2"] + b["m2"] + delta ** 2 * a["n"] * b["n"] / nSafe
+    stats["m3"] = (a["m3"] + b["m3"]
+                   + delta ** 3 * a["n"] * b["n"] * (a["n"] - b["n"]) / nSafe ** 2
+                   + 3 * delta * (a["n"] * b["m2"] - b["n"] * a["m2"]) / nSafe)
+
+    pairN = a["pairN"] + b["pairN"]
+    pairSafe = np.maximum(pairN, 1)
+    pairDelta = b["pairMean"] - a["pairMean"]
+    weight = a["pairN"] * b["pairN"] / pairSafe
+    stats["pairN"] = pairN
+    stats["pairMean"] = a["pairMean"] + pairDelta * b["pairN"] / pairSafe
+    stats["pairM2"] = a["pairM2"] + b["pairM2"] + pairDelta ** 2 * weight
+    # pairDelta.T[i, j] is the mean shift of column j on the (i, j) rows
+    stats["comoment"] = a["comoment"] + b["comoment"] + pairDelta * pairDelta.T * weight
+
+    stats["digests"] = [compressDigest(np.concatenate([ma, mb]), np.concatenate([wa, wb]), a["delta"])
+                        for (ma, wa), (mb, wb) in zip(a["digests"], b["digests"])]
+    return stats
+
+# Adds a chunk of rows to an accumulator
+# Args: stats: dict stats state, df: pd.DataFrame with the tracked columns
+# Returns: dict updated stats state
+def updateStats(stats, df):
+    return mergeStats(stats, chunkStats(df, stats["columns"], stats["delta"]))
+
+# Builds an accumulator in one pass over an iterable of DataFrame chunks,
+# e.g. sqlToDataframe(..., chunksize=100000)
+# Args: chunks: iterable of pd.DataFrame, columns: optional list, numeric columns of the
+#       first chunk by default, delta: int sketch compression
+# Returns: dict stats state, None if there were no chunks
+@instrumented(rowsArg=None)
+def streamStats(chunks, columns=None, delta=DIGEST_DELTA):
+    stats = None
+    for chunk in chunks:
+        if stats is None:
+            stats = newStats(columns if columns is not None else numericColumns(chunk), delta)
+        stats = updateStats(stats, chunk)
+    return stats
+
+# Summaries, each mirrors the matching pandas call with numeric_only=True
+
+# Returns: pd.Series like df.count()
+def statsCount(stats):
+    return pd.Series(stats["n"].astype(np.int64), index=stats["columns"])
+
+# Returns: pd.Series like df.min(numeric_only=True)
+def statsMin(stats):
+    return pd.Series(np.where(stats["n"] > 0, stats["min"], np.nan), index=stats["columns"])
+
+# Returns: pd.Series like df.max(numeric_only=True)
+def statsMax(stats):
+    return pd.Series(np.where(stats["n"] > 0, stats["max"], np.nan), index=stats["columns"])
+
+# Returns: pd.Series like df.mean(numeric_only=True)
+def statsMean(stats):
+    return pd.Series(np.where(stats["n"] > 0, stats["mean"], np.nan), index=stats["columns"])
+
+# Sample standard deviation
+# Args: stats: dict stats state, ddof: int delta degrees of freedom
+# Returns: pd.Series like df.std(numeric_only=True)
+def statsStd(stats, ddof=1):
+    n = stats["n"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var = np.where(n > ddof, stats["m2"] / (n - ddof), np.nan)
+    return pd.Series(np.sqrt(var), index=stats["columns"])
+
+# Adjusted Fisher-Pearson skewness, the estimator pandas uses
+# Returns: pd.Series like df.skew(numeric_only=True)
+def statsSkew(stats):
+    n, m2, m3 = stats["n"], stats["m2"], stats["m3"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        g1 = (m3 / n) / (m2 / n) ** 1.5
+        skew = np.sqrt(n * (n - 1)) / (n - 2) * g1
+    # constant columns have zero skew, fewer than 3 values have none
+    skew = np.where(m2 == 0, 0.0, skew)
+    return pd.Series(np.where(n < 3, np.nan, skew), index=stats["columns"])
+
+# Pairwise sample covariance
+# Returns: pd.DataFrame like df.cov(numeric_only=True)
+def statsCov(stats, ddof=1):
+    n = stats["pairN"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = np.where(n > ddof, stats["comoment"] / (n - ddof), np.nan)
+    return pd.DataFrame(cov, index=stats["columns"], columns=stats["columns"])
+
+# Pairwise Pearson correlation
+# Returns: pd.DataFrame like df.corr(numeric_only=True)
+def statsCorr(stats):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = stats["comoment"] / np.sqrt(stats["pairM2"] * stats["pairM2"].T)
+    corr = np.where(stats["pairN"] > 1, np.clip(corr, -1, 1), np.nan)
+    return pd.DataFrame(corr, index=stats["columns"], columns=stats["columns"])
+
+# Approximate quantiles from the sketches, linear interpolation between
+# centroids like pandas' default; exact while a column has fewer values than
+# the sketch keeps centroids
+# Args: stats: dict stats state, q: float or list of floats in [0, 1]
+# Returns: pd.Series (float q) or pd.DataFrame (list q) like df.quantile
+def statsQuantile(stats, q=0.5):
+    qs = np.atleast_1d(q).astype(np.float64)
+    result = np.full((len(qs), len(stats["columns"])), np.nan)
+    for i, (means, weights) in enumerate(stats["digests"]):
+        n = weights.sum()
+        if n == 0:
+            continue
+        # 0-based rank of each centroid's center, bounded by the exact min and max
+        centers = np.cumsum(weights) - weights / 2 - 0.5
+        ranks = np.r_[0.0, centers, n - 1]
+        values = np.r_[stats["min"][i], means, stats["max"][i]]
+        result[:, i] = np.interp(qs * (n - 1), ranks, values)
+    if np.ndim(q) == 0:
+        return pd.Series(result[0], index=stats["columns"], name=q)
+    return pd.DataFrame(result, index=qs, columns=stats["columns"])
+
+# Summary table with the same layout as df.describe()
+# Args: stats: dict stats state, percentiles: list of floats
+# Returns: pd.DataFrame
+def statsDescribe(stats, percentiles=(0.25, 0.5, 0.75)):
+    quantiles = statsQuantile(stats, list(percentiles))
+    quantiles.index = [f"{p * 100:g}%" for p in percentiles]
+    rows = [statsCount(stats).rename("count").astype(np.float64), statsMean(stats).rename("mean"),
+            statsStd(stats).rename("std"), statsMin(stats).rename("min")]
+    frame = pd.concat([pd.DataFrame(rows), quantiles, pd.DataFrame([statsMax(stats).rename("max")])])
+    return frame
+
+# Serialization, plain json so accumulators can be stored and shipped between processes
+
+# Converts an accumulator to json-compatible types
+# Args: stats: dict stats state
+# Returns: dict of lists and numbers
+def statsToDict(stats):
+    out = {key: (value.tolist() if isinstance(value, np.ndarray) else value)
+           for key, value in stats.items() if key != "digests"}
+    out["digests"] = [[means.tolist(), weights.tolist()] for means, weights in stats["digests"]]
+    return out
+
+# Rebuilds an accumulator from statsToDict output
+# Args: data: dict from statsToDict
+# Returns: dict stats state
+def statsFromDict(data):
+    stats = newStats(data["columns"], data["delta"])
+    for key in ("n", "min", "max", "mean", "m2", "m3", "pairN", "pairMean", "pairM2", "comoment"):
+        stats[key] = np.array(data[key], dtype=np.float64).reshape(stats[key].shape)
+    stats["digests"] = [(np.array(means, dtype=np.float64), np.array(weights, dtype=np.float64))
+                        for means, weights in data["digests"]]
+    return stats
+
+# Saves an accumulator next to the data it summarizes, written atomically
+# Args: stats: dict stats state, fileName: str e.g. "MeteoriteData.sqlite.stats.json"
+# Returns: True if successful, None if not for error handling
+def saveStats(stats, fileName):
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fileName)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(statsToDict(stats), f)
+        os.replace(tmpPath, fileName)
+        return True
+    except Exception as e:
+        # Prints error statement, removes the partial file and returns None
+        os.remove(tmpPath)
+        print(f"Error saving stats to {fileName}: {e}")
+        return None
+
+# Loads an accumulator written by saveStats
+# Args: fileName: str
+# Returns: dict stats state, None if the file is missing or unreadable
+def loadStats(fileName):
+    try:
+        with open(fileName, 'r') as f:
+            return statsFromDict(json.load(f))
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error loading stats from {fileName}: {e}")
+        return None